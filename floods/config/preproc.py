@@ -1,6 +1,6 @@
 from enum import Enum
 from pathlib import Path
-from typing import List, Set
+from typing import List, Set, Tuple
 
 from pydantic import Field
 
@@ -13,9 +13,46 @@ class ImageType(Enum):
     MASK = ("mask", 255)
 
 
+class TileFormat(str, Enum):
+    tif = "tif"
+    packed = "packed"
+    virtual = "virtual"
+    stacked = "stacked"
+
+
+class Compression(str, Enum):
+    none = "none"
+    lzw = "lzw"
+    deflate = "deflate"
+    zstd = "zstd"
+
+
+class Denoiser(str, Enum):
+    nlmeans = "nlmeans"
+    opencv = "opencv"
+    lee = "lee"
+    box = "box"
+
+
+class PseudolabelMethod(str, Enum):
+    fixed = "fixed"
+    otsu = "otsu"
+
+
+class OtsuLevel(str, Enum):
+    scene = "scene"
+    emsr = "emsr"
+
+
 class StatsConfig(EnvConfig):
     data_root: Path = Field(description="Path where the processed tiles are stored (train set most likely)")
     subset: str = Field("train", description="Which subset to use for statistics, usually  training set")
+    packed: bool = Field(False, description="Read tiles from the packed store (preprocess with packed format)")
+    workers: int = Field(1, description="Number of parallel processes, each one accumulates a batch of tiles")
+    batch_size: int = Field(64, description="Number of tiles sent to each job")
+    output: Path = Field(None, description="Where to store the JSON results (default: data_root/stats_<subset>.json)")
+    clip_percentiles: Tuple[float, float] = Field((1.0, 99.0), description="Percentiles used as clipping limits")
+    relative_accuracy: float = Field(0.01, description="Relative error of the quantile estimates (bins size)")
 
 
 class PreparationConfig(EnvConfig):
@@ -25,6 +62,17 @@ class PreparationConfig(EnvConfig):
                              description="Select which subset to preprocess (requires an existing split)")
     summary_file: str = Field(description="JSON file containing all th required information on the dataset")
     tiling: bool = Field(True, description="whether to skip the tiling or not (also skips mask preprocessing)")
+    force: bool = Field(False, description="Process every scene again, even if up to date according to the manifest")
+    workers: int = Field(1, description="Number of parallel processes, each scene is processed independently")
+    streaming: bool = Field(False, description="Read, process and write one block row at a time (bounded memory)")
+    output_format: TileFormat = Field(TileFormat.tif,
+                                      description="One GeoTIFF per tile, packed memory-mapped arrays, virtual tiles "
+                                      "(processed scenes, tiles are windows listed in the catalog), or stacked "
+                                      "tiles (one raster per tile, every modality as bands)")
+    compact_tiles: bool = Field(False, description="Store SAR in half precision and DEM as scaled int16 (tif format)")
+    compression: Compression = Field(Compression.none,
+                                     description="Compression of the tiles, with predictor and internal tiling "
+                                     "(tif format)")
     scale: List[int] = Field([1], description="Scaling multipliers for each tile (before resizing to tile_size).")
     tile_size: int = Field(512, description="base dimension of the squared tile")
     tile_max_overlap: int = Field(400, description="how much the tiles can overlap before skipping the next one")
@@ -37,6 +85,16 @@ class PreparationConfig(EnvConfig):
     nan_threshold: float = Field(0.75, description="Percentage of invalid pixels before discaring the tile")
     vv_multiplier: float = Field(5.0, description="Fixed multiplier for threshold-based pseudolabeling (1st channel)")
     vh_multiplier: float = Field(10.0, description="Fixed multiplier for threshold-based pseudolabeling (2nd channel)")
+    method: PseudolabelMethod = Field(PseudolabelMethod.fixed, description="Fixed multipliers or Otsu thresholds")
+    otsu_level: OtsuLevel = Field(OtsuLevel.scene, description="Compute Otsu thresholds for each scene or EMSR code")
+    hist_bins: int = Field(256, description="Number of histogram bins for Otsu thresholds")
+    hist_min: float = Field(0.0, description="Lower bound of the histograms (SAR values below go in the first bin)")
+    hist_max: float = Field(1.0, description="Upper bound of the histograms (SAR values above go in the last bin)")
+    denoiser: Denoiser = Field(Denoiser.nlmeans, description="Denoising method applied before pseudolabeling")
+    denoise_kernel: int = Field(5, description="Window size for the filter-based denoisers (lee, box)")
+    scene_pseudolabels: bool = Field(False, description="Denoise each source scene once, then cut the weight tiles")
+    batch_size: int = Field(64, description="Number of tiles sent to each pseudolabeling job")
+    benchmark: int = Field(0, description="If > 0, only report speed and agreement of each denoiser on N tiles")
 
     def subset_exists(cls, v):
         allowed = {"train", "test", "val"}
@@ -114,6 +114,27 @@ class DatasetConfig(EnvConfig):
     path: str = Field(required=True, description="Path to the dataset")
     in_channels: int = Field(3, description="How many input channels, including extras")
     include_dem: bool = Field(False, description="whether to include the DEM as extra input")
+    packed: bool = Field(False, description="Read tiles from the packed store (preprocess with packed format)")
+    catalog: bool = Field(False, description="List tiles, filters and sampling weights from the preprocessing catalog")
+    virtual: bool = Field(False, description="Read tiles as windows of the processed scenes (virtual format)")
+    crop_window: bool = Field(False, description="Sample the random crop first, then read only its window")
+    scene_crops: bool = Field(False, description="Train on random crops read from the source scenes (no tiling)")
+    source_path: str = Field(None, description="Path to the source scenes (data_source of the preprocessing)")
+    summary_file: str = Field(None, description="JSON file with the subset of each EMSR code, for scene crops")
+    crop_scales: List[int] = Field([1], description="Scaling multipliers of the scene crops (before resizing)")
+    crops_per_epoch: int = Field(4000, description="Number of scene crops in each training epoch")
+    nan_threshold: float = Field(0.75, description="Percentage of invalid pixels before discarding a scene crop")
+    cache_bytes: int = Field(0, description="Byte budget of the shared-memory cache of decoded tiles (0 = disabled)")
+    cache_dir: str = Field(None, description="Folder of the tile cache, shared by workers and runs (default /dev/shm)")
+    eval_cache: bool = Field(False, description="Store the normalized validation tensors once, in memory-mapped files")
+    eval_cache_dir: str = Field("data/cache", description="Folder of the cached validation tensors")
+    stats_file: str = Field(None, description="Optional JSON file with mean and std, produced by the stats command")
+    robust_stats: bool = Field(False, description="Normalize with median and clip percentiles from the stats file")
+    device_normalize: bool = Field(False, description="Workers emit float16 images, normalized in batches on device")
+    batch_augmentation: bool = Field(False, description="Augment whole batches on device, after collation "
+                                     "(requires device_normalize)")
+    elastic_bank: int = Field(0, description="Elastic displacements drawn from a bank of precomputed fields "
+                              "of this size, in shared memory (0 = new field for every sample)")
     class_weights: str = Field(None, description="Optional path to a class weight array (npy format)")
     mask_body_ratio: float = Field(None, description="Percentage of ones in the mask before discarding the tile")
     weighted_sampling: bool = Field(False, description="Whether to sample images based on flooded ratio")
@@ -1,12 +1,34 @@
+import hashlib
+import json
+import os
+from contextlib import ExitStack
 from glob import glob
 from pathlib import Path
-from typing import Callable, Dict, List, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
+import rasterio
+import torch
+from numpy.lib.format import open_memmap
+from rasterio.enums import Resampling
+from rasterio.io import DatasetReader
+from rasterio.windows import Window
 from torch import Tensor
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+from tqdm import tqdm
 
 from floods.datasets.base import DatasetBase
-from floods.utils.gis import imread
+from floods.transforms import RandomCropWindow
+from floods.utils.cache import SharedTileCache, pack_mask, unpack_mask
+from floods.utils.catalog import CATALOG_FILE, TileCatalog
+from floods.utils.common import check_or_make_dir
+from floods.utils.gis import decode_tile, imread, tile_encoding
+from floods.utils.index import TileFiles, index_tiles
+from floods.utils.manifest import fingerprint
+from floods.utils.ml import identity
+from floods.utils.scenes import SCENES_DIR, WindowSequence
+from floods.utils.stacked import STACKED_DIR, StackedSequence, stacked_roles
+from floods.utils.store import INDEX_FILE, PackedTileStore, TileSequence
 
 
 class FloodDataset(DatasetBase):
@@ -18,6 +40,7 @@ class FloodDataset(DatasetBase):
     # actually using the median, more stable given the input data
     _mean = (4.9329374e-02, 1.1776519e-02, 1.4241237e+02)
     _std = (3.91287043e-02, 1.03687926e-02, 8.11010422e+01)
+    _clip = (-30.0, 30.0)
 
     def __init__(self,
                  path: Path,
@@ -26,7 +49,12 @@ class FloodDataset(DatasetBase):
                  transform_base: Callable = None,
                  transform_sar: Callable = None,
                  transform_dem: Callable = None,
-                 normalization: Callable = None) -> None:
+                 normalization: Callable = None,
+                 packed: bool = False,
+                 catalog: bool = False,
+                 virtual: bool = False,
+                 transform_crop: RandomCropWindow = None,
+                 cache: SharedTileCache = None) -> None:
         super().__init__()
         self._include_dem = include_dem
         self._name = "flood"
@@ -35,26 +63,68 @@ class FloodDataset(DatasetBase):
         self.transform_sar = transform_sar
         self.transform_dem = transform_dem
         self.normalization = normalization
-        # gather files to build the list of available pairs
+        self.transform_crop = transform_crop
+        self.cache = cache
+        self.store = None
+        self.catalog = None
+        self._encodings = dict()
         path = path / subset
-        self.image_files = sorted(glob(str(path / "sar" / "*.tif")))
-        self.label_files = sorted(glob(str(path / "mask" / "*.tif")))
-        assert len(self.image_files) > 0, f"No images found, is the given path correct? ({str(path)})"
-        assert len(self.image_files) == len(self.label_files), \
-            f"Length mismatch between tiles and masks: {len(self.image_files)} != {len(self.label_files)}"
-        # check matching tiles, just in case
-        for image, mask in zip(self.image_files, self.label_files):
-            image_tile = Path(image).stem
-            label_tile = Path(mask).stem
-            assert image_tile == label_tile, f"image: {image_tile} != mask: {label_tile}"
+        # packed stores are already consistent by construction, tiles are served as views on memory maps
+        if packed:
+            self.store = PackedTileStore(path / "packed")
+            assert len(self.store) > 0, f"No images found, is the given path correct? ({str(path)})"
+            self.image_files = self.store.sequence("sar")
+            self.label_files = self.store.sequence("mask")
+            if self._include_dem:
+                self.dem_files = self.store.sequence("dem")
+            if catalog:
+                self.catalog = TileCatalog(path / CATALOG_FILE)
+                self.catalog = self.catalog.take(self.catalog.lookup(self.image_files.names()))
+            return
+        # virtual tiles are windows of the processed scenes, as listed in the catalog
+        if virtual:
+            self.catalog = TileCatalog(path / CATALOG_FILE)
+            assert len(self.catalog) > 0, f"No images found, is the given path correct? ({str(path)})"
+            self.image_files = WindowSequence(path, "sar", self.catalog)
+            self.label_files = WindowSequence(path, "mask", self.catalog)
+            if self._include_dem:
+                self.dem_files = WindowSequence(path, "dem", self.catalog)
+            return
+        # the catalog produced by the preprocessing already lists matching tiles, no need to check the folders
+        if catalog:
+            self.catalog = TileCatalog(path / CATALOG_FILE)
+            assert len(self.catalog) > 0, f"No images found, is the given path correct? ({str(path)})"
+            if (path / STACKED_DIR).is_dir():
+                self._init_stacked(TileFiles(path / STACKED_DIR, self.catalog["name"]))
+                return
+            self.image_files = TileFiles(path / "sar", self.catalog["name"])
+            self.label_files = TileFiles(path / "mask", self.catalog["name"])
+            if self._include_dem:
+                self.dem_files = TileFiles(path / "dem", self.catalog["name"])
+            return
+        # stacked tiles hold every modality in a single raster, the separate folders are the fallback
+        stacked = index_tiles(path, groups=[STACKED_DIR])[STACKED_DIR]
+        if len(stacked) > 0:
+            self._init_stacked(TileFiles(path / STACKED_DIR, stacked))
+            return
+        # gather files to build the list of available pairs, with a single scan of each folder
+        # names are checked all at once, and reused while the folders are unchanged
+        groups = ["sar", "mask"] + (["dem"] if self._include_dem else [])
+        tiles = index_tiles(path, groups=groups)
+        assert len(tiles["sar"]) > 0, f"No images found, is the given path correct? ({str(path)})"
+        self.image_files = TileFiles(path / "sar", tiles["sar"])
+        self.label_files = TileFiles(path / "mask", tiles["mask"])
         # add the optional digital elevation map (DEM)
         if self._include_dem:
-            self.dem_files = sorted(glob(str(path / "dem" / "*.tif")))
-            assert len(self.image_files) == len(self.dem_files), "Length mismatch between tiles and DEMs"
-            for image, dem in zip(self.image_files, self.dem_files):
-                image_tile = Path(image).stem
-                dem_tile = Path(dem).stem
-                assert image_tile == dem_tile, f"image: {image_tile} != dem: {dem_tile}"
+            self.dem_files = TileFiles(path / "dem", tiles["dem"])
+
+    def _init_stacked(self, files: TileFiles) -> None:
+        # every group is a view on the same rasters, the band roles are the same for every tile
+        roles = stacked_roles(files[0])
+        self.image_files = StackedSequence(files, "sar", roles)
+        self.label_files = StackedSequence(files, "mask", roles)
+        if self._include_dem:
+            self.dem_files = StackedSequence(files, "dem", roles)
 
     @classmethod
     def name(cls) -> str:
@@ -80,31 +150,183 @@ class FloodDataset(DatasetBase):
     def std(cls) -> Tuple[float, ...]:
         return cls._std
 
+    @classmethod
+    def _load_statistics(cls, stats_file: Union[str, Path]) -> dict:
+        with open(stats_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    @classmethod
+    def statistics(cls,
+                   stats_file: Optional[Union[str, Path]] = None,
+                   robust: bool = False) -> Tuple[Tuple[float, ...], Tuple[float, ...]]:
+        """Per-channel center and standard deviation: the default ones, or the ones stored by the `stats` command
+        when a JSON file is given, using the median as center when robust. Channels follow the same order
+        of the inputs (SAR first, then DEM).
+        """
+        if stats_file is None:
+            assert not robust, "Robust statistics require a stats file"
+            return cls.mean(), cls.std()
+        stats = cls._load_statistics(stats_file)
+        return tuple(stats["median" if robust else "mean"]), tuple(stats["std"])
+
+    @classmethod
+    def clip_limits(cls,
+                    stats_file: Optional[Union[str, Path]] = None,
+                    robust: bool = False) -> Tuple[Tuple[float, ...], Tuple[float, ...]]:
+        """Per-channel clipping limits, applied after normalization: a fixed number of standard deviations,
+        or the percentiles stored in the stats file when robust, in normalized units.
+        """
+        center, std = cls.statistics(stats_file, robust=robust)
+        if not robust:
+            low, high = cls._clip
+            return (low, ) * len(center), (high, ) * len(center)
+        stats = cls._load_statistics(stats_file)
+        clip_min = tuple((value - c) / s for value, c, s in zip(stats["clip_low"], center, std))
+        clip_max = tuple((value - c) / s for value, c, s in zip(stats["clip_high"], center, std))
+        return clip_min, clip_max
+
     def stage(self) -> str:
         return self._subset
 
+    def _select(self, items: Union[List[str], TileFiles, TileSequence, WindowSequence, StackedSequence],
+                mask: List[bool]) -> Union[List[str], TileFiles, TileSequence, WindowSequence, StackedSequence]:
+        if isinstance(items, (TileFiles, TileSequence, WindowSequence, StackedSequence)):
+            return items.select(mask)
+        return [x for include, x in zip(mask, items) if include]
+
+    def _cache_key(self, items: Sequence, index: int) -> str:
+        # source file and window, with size and modification time so that updated tiles are never served
+        suffix = ""
+        if isinstance(items, WindowSequence):
+            path = items.path / SCENES_DIR / items.group / items.raster(index)
+            suffix = str(items.window(index))
+        else:
+            path = Path(items[index])
+        stat = os.stat(path)
+        return f"{path.resolve()}:{suffix}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _encoding(self, group: str) -> dict:
+        # compact tiles (half precision SAR, scaled DEM) are detected once, from the header of the first tile
+        if group not in self._encodings:
+            items = self._groups()[group]
+            if isinstance(items, (TileSequence, WindowSequence, StackedSequence)):
+                self._encodings[group] = dict(half=False, scale=None)
+            else:
+                self._encodings[group] = tile_encoding(items[0])
+        return self._encodings[group]
+
+    def _compact(self, group: Optional[str], image: np.ndarray) -> np.ndarray:
+        # cached entries are kept as small as possible: bit-packed masks, half precision SAR when stored as such
+        if group == "mask":
+            packed = pack_mask(image, ignore_index=self._ignore_index)
+            return image if packed is None else packed
+        if group == "sar" and self._encoding(group)["half"]:
+            return image.astype(np.float16)
+        return image
+
+    def _expand(self, group: Optional[str], image: np.ndarray) -> np.ndarray:
+        # values are widened to float32 only by the transforms, here masks are simply unpacked
+        if group == "mask" and image.ndim == 1:
+            return unpack_mask(image, ignore_index=self._ignore_index)
+        return image
+
+    def _read(self,
+              items: Sequence,
+              index: int,
+              channels_first: bool = True,
+              window: Window = None,
+              group: str = None) -> np.ndarray:
+        # decoded tiles are cached whole, windows are sliced in memory (packed tiles do not need decoding)
+        # stacked tiles are cached as whole stacks, when read through their files
+        if self.cache is not None and not isinstance(items, (TileSequence, StackedSequence)):
+            key = self._cache_key(items, index)
+            image = self.cache.get(key)
+            if image is None:
+                image = self._read_source(items, index)
+                self.cache.put(key, self._compact(group, image))
+            else:
+                image = self._expand(group, image)
+            if window is not None:
+                rows, cols = window.toslices()
+                image = image[:, rows, cols]
+            return image if channels_first else image.transpose(1, 2, 0)
+        return self._read_source(items, index, channels_first=channels_first, window=window)
+
+    def _read_source(self,
+                     items: Sequence,
+                     index: int,
+                     channels_first: bool = True,
+                     window: Window = None) -> np.ndarray:
+        # tiles are either file paths, read-only views on a packed store, windows of the scene rasters
+        # or bands of stacked rasters: in every case, only the given window is actually read, if any
+        # files are read with the stored values, scaled tiles are decoded by the transforms
+        if isinstance(items, (TileSequence, WindowSequence, StackedSequence)):
+            image = items.read(index, window=window)
+            return image if channels_first else image.transpose(1, 2, 0)
+        return imread(items[index], channels_first=channels_first, window=window, decode=False)
+
+    def _shape(self, items: Sequence, index: int) -> Tuple[int, int]:
+        # tile dimensions, without reading any pixel
+        if self.catalog is not None:
+            return int(self.catalog["height"][index]), int(self.catalog["width"][index])
+        if isinstance(items, (TileSequence, WindowSequence, StackedSequence)):
+            return items.shape(index)
+        with rasterio.open(str(items[index]), mode="r", driver="GTiff") as src:
+            return src.height, src.width
+
+    def fingerprint(self) -> List[dict]:
+        """Cheap identity of the tiles in the dataset, in order: names and file fingerprints (path, size and
+        modification time) of the single tiles, or of the packed store index and catalog they are read from.
+        """
+        groups = [self.image_files, self.label_files] + ([self.dem_files] if self._include_dem else [])
+        records = list()
+        for items in groups:
+            if isinstance(items, TileSequence):
+                records.append(dict(names=items.names(), source=fingerprint(items.store.path / INDEX_FILE)))
+            elif isinstance(items, WindowSequence):
+                records.append(dict(names=items.names(), source=fingerprint(items.path / CATALOG_FILE)))
+            elif isinstance(items, StackedSequence):
+                records.append(dict(role=items.role, source=fingerprint(*items.paths())))
+            else:
+                records.append(dict(source=fingerprint(*items)))
+        return records
+
     def add_mask(self, mask: List[bool], stage: str = None) -> None:
         assert len(mask) == len(self.image_files), \
             f"Mask is the wrong size! Expected {len(self.image_files)}, got {len(mask)}"
-        self.image_files = [x for include, x in zip(mask, self.image_files) if include]
-        self.label_files = [x for include, x in zip(mask, self.label_files) if include]
+        self.image_files = self._select(self.image_files, mask)
+        self.label_files = self._select(self.label_files, mask)
         if self._include_dem:
-            self.dem_files = [x for include, x in zip(mask, self.dem_files) if include]
+            self.dem_files = self._select(self.dem_files, mask)
+        if self.catalog is not None:
+            self.catalog = self.catalog.take(np.asarray(mask, dtype=bool))
         if stage:
             self._subset = stage
 
-    def __getitem__(self, index: int) -> Tuple[Tensor, Tensor]:
-        """Get the image/label pair, with optional augmentations and preprocessing steps.
-        Augmentations should be provided for a training dataset, while preprocessing should contain
-        the transforms required in both cases (normalizations, ToTensor, ...)
-        :param index:   integer pointing to the tile
-        :type index:    int
-        :return:        image, mask tuple
-        :rtype: Tuple[torch.Tensor, torch.Tensor]
+    def _groups(self) -> Dict[str, Sequence]:
+        groups = dict(sar=self.image_files, mask=self.label_files)
+        if self._include_dem:
+            groups["dem"] = self.dem_files
+        return groups
+
+    def _read_tiles(self, index: int, window: Window = None) -> Dict[str, np.ndarray]:
+        """Reads every group of the given tile (channels first), or only the given window of it.
+        Stacked tiles are read with a single open and a single read, then split by band role.
         """
+        tiles, stack = dict(), None
+        for group, items in self._groups().items():
+            if isinstance(items, StackedSequence):
+                if stack is None:
+                    stack = self._read(items.files, index, window=window)
+                tiles[group] = items.take(stack)
+            else:
+                tiles[group] = self._read(items, index, window=window, group=group)
+        return tiles
+
+    def _transform(self, tiles: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
         # read SAR image and corresponding label, augment with SAR-specific processing
-        image = imread(self.image_files[index], channels_first=False).astype(np.float32)
-        label = imread(self.label_files[index]).squeeze(0).astype(np.uint8)
+        image = tiles["sar"].transpose(1, 2, 0).astype(np.float32)
+        label = tiles["mask"].squeeze(0).astype(np.uint8)
         if self.transform_sar is not None:
             pair = self.transform_sar(image=image, mask=label)
             image = pair.get("image")
@@ -112,12 +334,17 @@ class FloodDataset(DatasetBase):
         # if requested, add digital elevation map as extra channel to the image
         # also transform with DEM-specific augmentations, if any
         if self._include_dem:
-            dem = imread(self.dem_files[index], channels_first=False).astype(np.float32)
+            dem = decode_tile(tiles["dem"].transpose(1, 2, 0), self._encoding("dem")["scale"]).astype(np.float32)
             if self.transform_dem is not None:
                 pair = self.transform_dem(image=dem, mask=label)
                 dem = pair.get("image")
                 label = pair.get("mask")
             image = np.dstack((image, dem))
+        # bring the crop to the output size, before the remaining shared transforms
+        if self.transform_crop is not None:
+            pair = self.transform_crop.resize(image=image, mask=label)
+            image = pair.get("image")
+            label = pair.get("mask")
         # last, apply shared transforms (affine transformations) and standardize
         if self.transform_base is not None:
             pair = self.transform_base(image=image, mask=label)
@@ -129,6 +356,21 @@ class FloodDataset(DatasetBase):
             label = pair.get("mask")
         return image, label
 
+    def __getitem__(self, index: int) -> Tuple[Tensor, Tensor]:
+        """Get the image/label pair, with optional augmentations and preprocessing steps.
+        Augmentations should be provided for a training dataset, while preprocessing should contain
+        the transforms required in both cases (normalizations, ToTensor, ...)
+        :param index:   integer pointing to the tile
+        :type index:    int
+        :return:        image, mask tuple
+        :rtype: Tuple[torch.Tensor, torch.Tensor]
+        """
+        # when random crops are required, the crop window is sampled first, so that only its pixels are read
+        window = None
+        if self.transform_crop is not None:
+            window = self.transform_crop(*self._shape(self.image_files, index))
+        return self._transform(self._read_tiles(index, window=window))
+
     def __len__(self) -> int:
         return len(self.image_files)
 
@@ -148,6 +390,10 @@ class WeightedFloodDataset(FloodDataset):
                  transform_sar: Callable = None,
                  transform_dem: Callable = None,
                  normalization: Callable = None,
+                 packed: bool = False,
+                 catalog: bool = False,
+                 virtual: bool = False,
+                 cache: SharedTileCache = None,
                  class_weights: Tuple[float, float, float] = (1.0, 0.5, 5.0)) -> None:
         super().__init__(path,
                          subset=subset,
@@ -155,21 +401,343 @@ class WeightedFloodDataset(FloodDataset):
                          transform_base=transform_base,
                          transform_sar=transform_sar,
                          transform_dem=transform_dem,
-                         normalization=normalization)
+                         normalization=normalization,
+                         packed=packed,
+                         catalog=catalog,
+                         virtual=virtual,
+                         cache=cache)
         # we need 256 positions to account for 255 indices (ignore index)
         weights_array = np.zeros(256, dtype=np.float32)
         weights_array[:len(class_weights)] = np.array(class_weights)
         self.class_weights = weights_array
-        self.weight_files = sorted(glob(str(path / subset / "weight" / "*.tif")))
+        if self.store is not None:
+            self.weight_files = self.store.sequence("weight")
+        elif isinstance(self.image_files, StackedSequence) and "weight" in self.image_files.roles:
+            self.weight_files = StackedSequence(self.image_files.files, "weight", self.image_files.roles)
+        elif self.catalog is not None:
+            self.weight_files = [str(path / subset / "weight" / f"{name}.tif") for name in self.catalog["name"]]
+        else:
+            self.weight_files = TileFiles(path / subset / "weight", index_tiles(path / subset, groups=["weight"])["weight"])
         assert len(self.image_files) == len(self.weight_files), \
             f"Length mismatch between tiles and weights: {len(self.image_files)} != {len(self.weight_files)}"
 
+    def _groups(self) -> Dict[str, Sequence]:
+        return dict(super()._groups(), weight=self.weight_files)
+
     def __getitem__(self, index: int) -> Tuple[Tensor, Tensor]:
-        image, label = super().__getitem__(index)
-        # read the weight map from file
+        tiles = self._read_tiles(index)
+        image, label = self._transform(tiles)
+        # read the weight map from file (or from the same stacked raster)
         # 0 = background, 1 = thresholded water U ground truth 2 = threshold ∩ ground truth
         # based on this, we produce a pixel-wise weight map, where we aim at giving more weight
         # to areas where it's flooded and the threshold agrees, less where it's confused
-        weight_indices = imread(self.weight_files[index]).squeeze(0).astype(np.uint8)
+        weight_indices = tiles["weight"].squeeze(0).astype(np.uint8)
         weight = self.class_weights[weight_indices]
         return image, label, weight
+
+
+class TensorCacheDataset(DatasetBase):
+    """Evaluation dataset materialized once: every sample of the wrapped dataset, already transformed
+    (e.g. normalized tensors), is stored in a pair of memory-mapped .npy files, named after the content
+    of the dataset and its transforms. Later epochs, and later runs on the same tiles, read samples straight
+    from the maps, without decoding or normalizing anything. Only deterministic transforms make sense here.
+    Memory maps are not pickled, each process opens its own on first access.
+    """
+    def __init__(self, dataset: FloodDataset, path: Path, workers: int = 0) -> None:
+        """Materializes the given dataset, unless an up-to-date copy already exists.
+
+        Args:
+            dataset (FloodDataset): dataset with evaluation transforms, all samples with the same size.
+            path (Path): folder of the cached files.
+            workers (int, optional): dataloader workers used to build the cache. Defaults to 0.
+        """
+        super().__init__()
+        self.dataset = dataset
+        key = json.dumps(dict(tiles=dataset.fingerprint(),
+                              include_dem=dataset._include_dem,
+                              transforms=[repr(dataset.transform_base), repr(dataset.normalization)]),
+                         sort_keys=True)
+        key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        self.path = check_or_make_dir(path)
+        self.image_path = self.path / f"eval_{dataset.stage()}_{key}_image.npy"
+        self.label_path = self.path / f"eval_{dataset.stage()}_{key}_label.npy"
+        if not (self.image_path.exists() and self.label_path.exists()):
+            self._materialize(workers)
+        self._arrays = dict()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_arrays"] = dict()
+        return state
+
+    def _materialize(self, workers: int) -> None:
+        # labels are completed first, the image file is only renamed in place when everything is done
+        images, labels = None, None
+        loader = DataLoader(self.dataset, batch_size=None, shuffle=False, num_workers=workers)
+        for index, (image, label) in enumerate(tqdm(loader, desc=f"Caching {self.dataset.stage()} set")):
+            image, label = np.asarray(image), np.asarray(label)
+            if images is None:
+                shape = (len(self.dataset), )
+                images = open_memmap(f"{self.image_path}.tmp", mode="w+", dtype=image.dtype, shape=shape + image.shape)
+                labels = open_memmap(f"{self.label_path}.tmp", mode="w+", dtype=label.dtype, shape=shape + label.shape)
+            assert image.shape == images.shape[1:], \
+                f"Every sample requires the same shape: {image.shape} != {images.shape[1:]}"
+            images[index] = image
+            labels[index] = label
+        for array, path in ((labels, self.label_path), (images, self.image_path)):
+            array.flush()
+            os.replace(f"{path}.tmp", path)
+
+    def _array(self, name: str) -> np.ndarray:
+        if name not in self._arrays:
+            path = self.image_path if name == "image" else self.label_path
+            # copy-on-write, tensors share the pages of the file, which is never modified
+            self._arrays[name] = np.load(path, mmap_mode="c")
+        return self._arrays[name]
+
+    def name(self) -> str:
+        return self.dataset.name()
+
+    def categories(self) -> Dict[int, str]:
+        return self.dataset.categories()
+
+    def palette(self) -> Dict[int, tuple]:
+        return self.dataset.palette()
+
+    def ignore_index(self) -> int:
+        return self.dataset.ignore_index()
+
+    def mean(self) -> Tuple[float, ...]:
+        return self.dataset.mean()
+
+    def std(self) -> Tuple[float, ...]:
+        return self.dataset.std()
+
+    def stage(self) -> str:
+        return self.dataset.stage()
+
+    def __getitem__(self, index: int) -> Tuple[Tensor, Tensor]:
+        return torch.from_numpy(self._array("image")[index]), torch.from_numpy(self._array("label")[index])
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+
+class SceneCropDataset(IterableDataset, DatasetBase):
+    """Random crops drawn on the fly from the source scenes (SAR, DEM and mask GeoTIFFs of each EMSR activation),
+    instead of the processed tiles: crop size and scales are free parameters, nothing needs to be tiled first.
+    Each crop is read as a window of the scene, decimated by GDAL for scales larger than one, then processed
+    as in the preprocessing (same functions, invalid pixels replaced by the ignore values).
+    With multiple workers, each one draws its share of crops from its own shard of scenes.
+    """
+    _name = "flood"
+    _categories = FloodDataset._categories
+    _palette = FloodDataset._palette
+    _ignore_index = FloodDataset._ignore_index
+    _mean = FloodDataset._mean
+    _std = FloodDataset._std
+    _resampling = dict(sar=Resampling.bilinear, dem=Resampling.bilinear, mask=Resampling.nearest)
+
+    def __init__(self,
+                 path: Path,
+                 summary_file: Union[str, Path],
+                 subset: str = "train",
+                 include_dem: bool = False,
+                 crop_size: int = 512,
+                 scales: Sequence[int] = (1, ),
+                 crops_per_epoch: int = 1000,
+                 nan_threshold: Optional[float] = None,
+                 max_attempts: int = 10,
+                 halo: int = 0,
+                 sar_process: Callable = None,
+                 dem_process: Callable = None,
+                 msk_process: Callable = None,
+                 transform_base: Callable = None,
+                 transform_sar: Callable = None,
+                 transform_dem: Callable = None,
+                 normalization: Callable = None,
+                 seed: Optional[int] = None) -> None:
+        """Lists the scenes of the given subset, only reading their dimensions.
+
+        Args:
+            path (Path): path to the source data (EMSR folders with s1_raw, DEM and mask subfolders).
+            summary_file (Union[str, Path]): JSON file with the subset of each EMSR code.
+            subset (str, optional): which subset to draw crops from. Defaults to "train".
+            include_dem (bool, optional): whether to include the DEM as extra channel. Defaults to False.
+            crop_size (int, optional): side of the square crops, at any scale. Defaults to 512.
+            scales (Sequence[int], optional): multipliers, a crop at scale 2 covers twice the area. Defaults to (1, ).
+            crops_per_epoch (int, optional): number of crops in each epoch, among every worker. Defaults to 1000.
+            nan_threshold (Optional[float], optional): ratio of invalid pixels before discarding a crop, None keeps
+                all of them. Defaults to None.
+            max_attempts (int, optional): crops drawn before keeping the last one anyway. Defaults to 10.
+            halo (int, optional): extra pixels read around each crop, for neighbourhood operations. Defaults to 0.
+            sar_process (Callable, optional): preprocessing function for SAR images. Defaults to None.
+            dem_process (Callable, optional): preprocessing function for DEM images. Defaults to None.
+            msk_process (Callable, optional): preprocessing function for masks. Defaults to None.
+            seed (Optional[int], optional): fixed seed for the crop positions, otherwise taken from torch.
+        """
+        super().__init__()
+        self._include_dem = include_dem
+        self._subset = subset
+        self.crop_size = crop_size
+        self.scales = list(scales)
+        self.crops_per_epoch = crops_per_epoch
+        self.nan_threshold = nan_threshold
+        self.max_attempts = max_attempts
+        self.halo = halo
+        self.process_fns = dict(sar=sar_process or identity, dem=dem_process or identity, mask=msk_process or identity)
+        self.transform_base = transform_base
+        self.transform_sar = transform_sar
+        self.transform_dem = transform_dem
+        self.normalization = normalization
+        self.seed = seed
+        self._iterations = 0
+        with open(summary_file, "r", encoding="utf-8") as f:
+            codes = {code for code, info in json.load(f).items() if info["subset"] == subset}
+        # same layout of the preprocessing, matching images share the same name in sibling folders
+        self.scenes = list()
+        for sar_path in sorted(glob(str(Path(path) / "*" / "s1_raw" / "*.tif"))):
+            sar_path = Path(sar_path)
+            if sar_path.stem.split("-")[0] not in codes:
+                continue
+            with rasterio.open(str(sar_path), mode="r", driver="GTiff") as src:
+                shape = src.shape
+            root = sar_path.parent.parent
+            self.scenes.append(
+                dict(sar=sar_path, dem=root / "DEM" / sar_path.name, mask=root / "mask" / sar_path.name, shape=shape))
+        assert len(self.scenes) > 0, f"No scenes found, is the given path correct? ({str(path)})"
+
+    @classmethod
+    def name(cls) -> str:
+        return cls._name
+
+    @classmethod
+    def categories(cls) -> Dict[int, str]:
+        return cls._categories
+
+    @classmethod
+    def palette(cls) -> Dict[int, tuple]:
+        return cls._palette
+
+    @classmethod
+    def ignore_index(cls) -> int:
+        return cls._ignore_index
+
+    @classmethod
+    def mean(cls) -> Tuple[float, ...]:
+        return cls._mean
+
+    @classmethod
+    def std(cls) -> Tuple[float, ...]:
+        return cls._std
+
+    def stage(self) -> str:
+        return self._subset
+
+    def __len__(self) -> int:
+        return self.crops_per_epoch
+
+    def _shard(self) -> Tuple[List[int], int, int]:
+        # scenes are split among workers, unless there are not enough of them
+        info = get_worker_info()
+        if info is None:
+            return list(range(len(self.scenes))), 0, 1
+        if len(self.scenes) < info.num_workers:
+            return list(range(len(self.scenes))), info.id, info.num_workers
+        return list(range(info.id, len(self.scenes), info.num_workers)), info.id, info.num_workers
+
+    def _candidates(self, scenes: List[int]) -> Tuple[List[Tuple[int, int]], np.ndarray]:
+        # every (scene, scale) pair large enough for a crop, weighted by its area at that scale
+        candidates, areas = list(), list()
+        for index in scenes:
+            height, width = self.scenes[index]["shape"]
+            for scale in self.scales:
+                shape = (int(height * (1.0 / scale)), int(width * (1.0 / scale)))
+                if min(shape) >= self.crop_size:
+                    candidates.append((index, scale))
+                    areas.append(shape[0] * shape[1])
+        assert len(candidates) > 0, f"Every scene is smaller than the crop size ({self.crop_size})"
+        areas = np.array(areas, dtype=np.float64)
+        return candidates, areas / areas.sum()
+
+    def read_crop(self, datasets: Dict[str, DatasetReader], scale: int, row: int,
+                  col: int) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """Reads and processes a single crop from the given scene, using windowed and decimated reads.
+
+        Args:
+            datasets (Dict[str, DatasetReader]): open rasters of the scene, one for each group (sar, dem, mask).
+            scale (int): tile multiplier, the scene is downscaled by this factor.
+            row (int): first row of the crop, at the given scale.
+            col (int): first column of the crop, at the given scale.
+
+        Returns:
+            Tuple[Dict[str, np.ndarray], np.ndarray]: processed crops (channels first) and mask of invalid pixels
+        """
+        source_height, source_width = datasets["sar"].shape
+        height, width = int(source_height * (1.0 / scale)), int(source_width * (1.0 / scale))
+        row_ratio, col_ratio = source_height / float(height), source_width / float(width)
+        size = self.crop_size
+        top, left = max(row - self.halo, 0), max(col - self.halo, 0)
+        bottom, right = min(row + size + self.halo, height), min(col + size + self.halo, width)
+        window = Window(left * col_ratio, top * row_ratio, (right - left) * col_ratio, (bottom - top) * row_ratio)
+        crops = dict()
+        for group, dataset in datasets.items():
+            data = dataset.read(window=window,
+                                out_shape=(dataset.count, bottom - top, right - left),
+                                resampling=self._resampling[group])
+            data = self.process_fns[group](data)
+            crops[group] = data[:, row - top:row - top + size, col - left:col - left + size]
+        return crops, np.isnan(crops["sar"].sum(axis=0))
+
+    def _sample(self, crops: Dict[str, np.ndarray], invalid: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # same pipeline of the tiles: invalid pixels replaced with the ignore values, then augmentations
+        image = np.where(invalid, 0, crops["sar"]).transpose(1, 2, 0).astype(np.float32)
+        label = np.where(invalid, self._ignore_index, crops["mask"][0]).astype(np.uint8)
+        if self.transform_sar is not None:
+            pair = self.transform_sar(image=image, mask=label)
+            image = pair.get("image")
+            label = pair.get("mask")
+        if self._include_dem:
+            dem = np.where(invalid, 0, crops["dem"]).transpose(1, 2, 0).astype(np.float32)
+            if self.transform_dem is not None:
+                pair = self.transform_dem(image=dem, mask=label)
+                dem = pair.get("image")
+                label = pair.get("mask")
+            image = np.dstack((image, dem))
+        if self.transform_base is not None:
+            pair = self.transform_base(image=image, mask=label)
+            image = pair.get("image")
+            label = pair.get("mask")
+        if self.normalization:
+            pair = self.normalization(image=image, mask=label)
+            image = pair.get("image")
+            label = pair.get("mask")
+        return image, label
+
+    def __iter__(self) -> Iterator[Tuple[Tensor, Tensor]]:
+        scenes, worker_id, num_workers = self._shard()
+        candidates, probabilities = self._candidates(scenes)
+        # a different sequence for every worker and every epoch
+        seed = torch.initial_seed() if self.seed is None else self.seed
+        rng = np.random.default_rng([seed, worker_id, self._iterations])
+        self._iterations += 1
+        count = self.crops_per_epoch // num_workers + int(worker_id < self.crops_per_epoch % num_workers)
+        groups = ("sar", "dem", "mask") if self._include_dem else ("sar", "mask")
+        with ExitStack() as stack:
+            # rasters are opened on first use, then kept open until the end of the epoch
+            opened = dict()
+            for _ in range(count):
+                for _ in range(self.max_attempts):
+                    index, scale = candidates[rng.choice(len(candidates), p=probabilities)]
+                    if index not in opened:
+                        opened[index] = {
+                            group: stack.enter_context(rasterio.open(str(self.scenes[index][group]), mode="r"))
+                            for group in groups
+                        }
+                    height, width = (int(dim * (1.0 / scale)) for dim in self.scenes[index]["shape"])
+                    row = int(rng.integers(0, height - self.crop_size + 1))
+                    col = int(rng.integers(0, width - self.crop_size + 1))
+                    crops, invalid = self.read_crop(opened[index], scale, row, col)
+                    if self.nan_threshold is None or invalid.mean() < self.nan_threshold:
+                        break
+                yield self._sample(crops, invalid)
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 
 import albumentations as alb
 import numpy as np
@@ -10,26 +10,43 @@ from torch.utils.data.sampler import WeightedRandomSampler
 
 from floods.config import TestConfig, TrainConfig
 from floods.datasets.base import DatasetBase
-from floods.datasets.flood import FloodDataset, RGBFloodDataset
+from floods.datasets.flood import FloodDataset, RGBFloodDataset, SceneCropDataset, TensorCacheDataset
 from floods.metrics import ConfusionMatrix, F1Score, IoU, Metric, Precision, Recall
 from floods.models import create_decoder, create_encoder, create_multi_encoder
 from floods.models.base import MultiBranchSegmenter, Segmenter
 from floods.models.modules import SegmentationHead
-from floods.transforms import ClipNormalize, Denormalize
+from floods.preproc import processing_functions
+from floods.transforms import (BankElasticTransform, BatchAugmentation, ClipNormalize, Denormalize, DeviceNormalize,
+                               RandomCropWindow, ToHalf)
+from floods.utils.cache import SharedTileCache
 from floods.utils.common import get_logger
-from floods.utils.tiling.functional import entropy_weights, mask_body_ratio_from_threshold
+from floods.utils.fields import DisplacementBank
+from floods.utils.tiling.functional import (entropy_weights, label_scan_cache, mask_body_ratio_from_threshold,
+                                            smooth_weights)
 
 LOG = get_logger(__name__)
 
 
-def train_transforms_base(image_size: int):
+def train_transforms_crop(image_size: int):
+    # same crop as the base transforms, but sampled by the dataset before reading the tiles
+    return RandomCropWindow(min_max_height=(image_size // 2, image_size), height=image_size, width=image_size, p=0.8)
+
+
+def train_transforms_base(image_size: int, crop_window: bool = False, bank: DisplacementBank = None):
     min_crop = image_size // 2
     max_crop = image_size
-    transforms = [
-        alb.RandomSizedCrop(min_max_height=(min_crop, max_crop), height=image_size, width=image_size, p=0.8),
+    transforms = [] if crop_window else [
+        alb.RandomSizedCrop(min_max_height=(min_crop, max_crop), height=image_size, width=image_size, p=0.8)
+    ]
+    # with a bank of displacement fields, the elastic transform only needs a remap
+    if bank is not None:
+        elastic = BankElasticTransform(bank, alpha=1, alpha_affine=50)
+    else:
+        elastic = alb.ElasticTransform(alpha=1, sigma=50, alpha_affine=50)
+    transforms += [
         alb.Flip(p=0.5),
         alb.RandomRotate90(p=0.5),
-        alb.ElasticTransform(alpha=1, sigma=50, alpha_affine=50),
+        elastic,
         alb.GridDistortion(p=0.5)
     ]
     # if input channels are 4 and mean and std are for RGB only, copy red for IR
@@ -46,6 +63,23 @@ def train_transforms_sar():
     return alb.Compose(transforms)
 
 
+def train_transforms_batch(sar_channels: int, crop_window: bool = False) -> BatchAugmentation:
+    # same transforms and probabilities of base and SAR transforms, applied to whole batches
+    return BatchAugmentation(sar_channels=sar_channels,
+                             crop_scale=(0.5, 1.0),
+                             crop_p=0.0 if crop_window else 0.8,
+                             flip_p=0.5,
+                             rotate_p=0.5,
+                             sar_p=0.6,
+                             blur_limit=(3, 13),
+                             multiplier=(0.7, 1.3),
+                             elastic_p=0.5,
+                             elastic_alpha=1,
+                             elastic_sigma=50,
+                             elastic_alpha_affine=50,
+                             grid_p=0.5)
+
+
 def train_transforms_dem(channel_dropout: float = 0.0):
     transforms = []
     if channel_dropout > 0:
@@ -56,11 +90,19 @@ def train_transforms_dem(channel_dropout: float = 0.0):
 def eval_transforms(mean: tuple,
                     std: tuple,
                     clip_min: tuple,
-                    clip_max: tuple) -> alb.Compose:
+                    clip_max: tuple,
+                    on_device: bool = False) -> alb.Compose:
+    # on device, workers only cast the images to half precision, see `device_transforms`
+    if on_device:
+        return alb.Compose([ToHalf(), ToTensorV2()])
     return alb.Compose([ClipNormalize(mean=mean, std=std, clip_min=clip_min, clip_max=clip_max),
                         ToTensorV2()])
 
 
+def device_transforms(mean: tuple, std: tuple, clip_min: tuple, clip_max: tuple) -> DeviceNormalize:
+    return DeviceNormalize(mean=mean, std=std, clip_min=clip_min, clip_max=clip_max)
+
+
 def inverse_transform(mean: tuple, std: tuple):
     return Denormalize(mean=mean, std=std)
 
@@ -75,70 +117,180 @@ def prepare_datasets(config: TrainConfig, use_rgb: bool = False) -> Tuple[Datase
     # instantiate transforms for training and evaluation
     # adapt hardcoded tensors to the current number of channels
     data_root = Path(config.data.path)
-    mean = dataset_cls.mean()[:config.data.in_channels]
-    std = dataset_cls.std()[:config.data.in_channels]
+    mean, std, clip_min, clip_max = prepare_statistics(config, use_rgb=use_rgb)
     # 3 different blocks required:
     # - base is applied to everything (affine transforms mainly)
     # - sar, dem are only applied to the namesake components
-    base_trf = train_transforms_base(image_size=config.image_size)
+    # with batch augmentation, base and sar transforms are applied by the trainer, see `prepare_batch_augmentation`
+    base_trf = train_transforms_base(image_size=config.image_size,
+                                     crop_window=config.data.crop_window,
+                                     bank=prepare_elastic_bank(config))
+    crop_trf = train_transforms_crop(image_size=config.image_size) if config.data.crop_window else None
     sar_trf = train_transforms_sar()
     dem_trf = train_transforms_dem(channel_dropout=0)
+    if config.data.batch_augmentation:
+        base_trf, sar_trf = None, None
     # store here just for config logging purposes
-    config.model.transforms = str(base_trf) + str(sar_trf) + str(dem_trf)
+    config.model.transforms = str(crop_trf or "") + str(base_trf or "") + str(sar_trf or "") + str(dem_trf)
     normalize = eval_transforms(mean=mean,
                                 std=std,
-                                clip_min=-30.0,
-                                clip_max=30.0,)
+                                clip_min=clip_min,
+                                clip_max=clip_max,
+                                on_device=config.data.device_normalize)
     # also print them, just in case
     LOG.info("Train transforms: %s", config.model.transforms)
     LOG.info("Eval. transforms: %s", str(normalize))
     # create train and validation sets
-    train_dataset = dataset_cls(path=data_root,
-                                subset="train",
-                                include_dem=config.data.include_dem,
-                                transform_base=base_trf,
-                                transform_sar=sar_trf,
-                                transform_dem=dem_trf,
-                                normalization=normalize)
+    if config.data.scene_crops:
+        train_dataset = prepare_scene_crops(config, use_rgb=use_rgb, transform_base=base_trf,
+                                            transform_sar=sar_trf, transform_dem=dem_trf, normalization=normalize)
+    else:
+        train_dataset = dataset_cls(path=data_root,
+                                    subset="train",
+                                    include_dem=config.data.include_dem,
+                                    packed=config.data.packed,
+                                    catalog=config.data.catalog,
+                                    virtual=config.data.virtual,
+                                    transform_crop=crop_trf,
+                                    transform_base=base_trf,
+                                    transform_sar=sar_trf,
+                                    transform_dem=dem_trf,
+                                    normalization=normalize,
+                                    cache=prepare_cache(config))
     valid_dataset = dataset_cls(path=data_root,
                                 subset="val",
                                 include_dem=config.data.include_dem,
-                                normalization=normalize)
+                                packed=config.data.packed,
+                                catalog=config.data.catalog,
+                                virtual=config.data.virtual,
+                                normalization=normalize,
+                                cache=prepare_cache(config))
     # create a temporary dataset to generate a mask useful to filter all the images
     # for which the amout of segmentation is lower than a given percentage
     if(config.data.mask_body_ratio is not None and config.data.mask_body_ratio > 0):
+        assert not config.data.scene_crops, "Scene crops are drawn on the fly, they cannot be filtered in advance"
         # get and apply mask to the training set
         # we are directly iterating filenames to avoid transforms
-        train_imgs_mask, train_counts = mask_body_ratio_from_threshold(labels=train_dataset.label_files,
-                                                                       ratio_threshold=config.data.mask_body_ratio,
-                                                                       label="train",
-                                                                       cache_hash=config.data.cache_hash)
+        train_imgs_mask, train_counts = _body_ratio_mask(train_dataset,
+                                                         ratio_threshold=config.data.mask_body_ratio,
+                                                         label="train",
+                                                         cache_hash=config.data.cache_hash,
+                                                         workers=config.trainer.num_workers)
         train_dataset.add_mask(train_imgs_mask)
         LOG.info("Filtering training set with %d images", len(train_imgs_mask))
         LOG.info(f"Number of elements kept: {train_counts[1]}")
         LOG.info(f"Ratio: {train_counts[1]/len(train_imgs_mask):.2f}%")
         # get and apply mask to the validation set
-        val_imgs_mask, val_counts = mask_body_ratio_from_threshold(labels=valid_dataset.label_files,
-                                                                   ratio_threshold=config.data.mask_body_ratio,
-                                                                   label="val",
-                                                                   cache_hash=config.data.cache_hash)
+        val_imgs_mask, val_counts = _body_ratio_mask(valid_dataset,
+                                                     ratio_threshold=config.data.mask_body_ratio,
+                                                     label="val",
+                                                     cache_hash=config.data.cache_hash,
+                                                     workers=config.trainer.num_workers)
         valid_dataset.add_mask(val_imgs_mask)
         LOG.info("Filtering validation set with %d images", len(val_imgs_mask))
         LOG.info(f"Number of elements kept: {val_counts[1]}")
         LOG.info(f"Ratio: {val_counts[1]/len(val_imgs_mask):.2f}%")
 
+    # the validation set is deterministic, transformed samples can be stored once and reused by later runs
+    if config.data.eval_cache:
+        valid_dataset = TensorCacheDataset(valid_dataset,
+                                           path=Path(config.data.eval_cache_dir),
+                                           workers=config.trainer.num_workers)
+        LOG.info("Validation tensors cached in: %s", str(valid_dataset.image_path))
     return train_dataset, valid_dataset
 
 
-def prepare_sampler(dataset: FloodDataset, cache_hash: str, smoothing: float = 0.8) -> WeightedRandomSampler:
-    target_file = Path("data/cache") / f"sample-weights_{cache_hash}.npy"
-    if target_file.exists() and target_file.is_file():
-        LOG.info("Found an existing array of sample weights")
-        weights = np.load(str(target_file))
+def prepare_statistics(config: TrainConfig, use_rgb: bool = False) -> Tuple[tuple, tuple, tuple, tuple]:
+    # center, standard deviation and clipping limits, for the configured number of channels
+    dataset_cls = RGBFloodDataset if use_rgb else FloodDataset
+    mean, std = dataset_cls.statistics(config.data.stats_file, robust=config.data.robust_stats)
+    clip_min, clip_max = dataset_cls.clip_limits(config.data.stats_file, robust=config.data.robust_stats)
+    channels = config.data.in_channels
+    return mean[:channels], std[:channels], clip_min[:channels], clip_max[:channels]
+
+
+def prepare_device_normalization(config: TrainConfig, use_rgb: bool = False) -> Optional[DeviceNormalize]:
+    # normalization of whole batches on the target device, when workers only emit raw images
+    if not config.data.device_normalize:
+        return None
+    mean, std, clip_min, clip_max = prepare_statistics(config, use_rgb=use_rgb)
+    return device_transforms(mean=mean, std=std, clip_min=clip_min, clip_max=clip_max)
+
+
+def prepare_batch_augmentation(config: TrainConfig) -> Optional[BatchAugmentation]:
+    # augmentations of whole training batches on device, on raw images: normalization must follow them
+    if not config.data.batch_augmentation:
+        return None
+    assert config.data.device_normalize, "Batch augmentation requires the normalization on device"
+    sar_channels = config.data.in_channels - int(config.data.include_dem)
+    return train_transforms_batch(sar_channels=sar_channels, crop_window=config.data.crop_window)
+
+
+def prepare_elastic_bank(config: TrainConfig) -> Optional[DisplacementBank]:
+    # generated once by the main process, then mapped read-only by every worker
+    if config.data.elastic_bank <= 0 or config.data.batch_augmentation:
+        return None
+    return DisplacementBank(size=config.image_size, count=config.data.elastic_bank, sigma=50, seed=config.seed)
+
+
+def prepare_cache(config: TrainConfig) -> Optional[SharedTileCache]:
+    # every dataset counts its own hits and misses, while entries and budget are shared through the folder
+    if config.data.cache_bytes <= 0:
+        return None
+    return SharedTileCache(config.data.cache_dir, max_bytes=config.data.cache_bytes)
+
+
+def prepare_scene_crops(config: TrainConfig, use_rgb: bool = False, **transforms) -> SceneCropDataset:
+    # crops are processed on the fly with the default preprocessing, colorized when RGB inputs are required
+    assert config.data.source_path and config.data.summary_file, "Scene crops require source path and summary file"
+    sar_process, dem_process, morph = processing_functions(decibel=not use_rgb, colorize=use_rgb)
+    LOG.info("Drawing training crops from the source scenes, scales: %s", str(config.data.crop_scales))
+    return SceneCropDataset(path=Path(config.data.source_path),
+                            summary_file=config.data.summary_file,
+                            subset="train",
+                            include_dem=config.data.include_dem,
+                            crop_size=config.image_size,
+                            scales=config.data.crop_scales,
+                            crops_per_epoch=config.data.crops_per_epoch,
+                            nan_threshold=config.data.nan_threshold,
+                            halo=morph.kernel.shape[0],
+                            sar_process=sar_process,
+                            dem_process=dem_process,
+                            msk_process=morph,
+                            **transforms)
+
+
+def _body_ratio_mask(dataset: FloodDataset,
+                     ratio_threshold: float,
+                     label: str,
+                     cache_hash: str,
+                     workers: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    # the catalog already holds the flooded ratio of every tile, otherwise the labels need to be read
+    if dataset.catalog is None:
+        return mask_body_ratio_from_threshold(labels=dataset.label_files,
+                                              ratio_threshold=ratio_threshold,
+                                              label=label,
+                                              cache_hash=cache_hash,
+                                              workers=workers)
+    mask = dataset.catalog.flood_ratio() >= ratio_threshold
+    _, counts = np.unique(mask, return_counts=True)
+    return mask, counts
+
+
+def prepare_sampler(dataset: FloodDataset,
+                    cache_hash: str,
+                    smoothing: float = 0.8,
+                    workers: int = 1) -> WeightedRandomSampler:
+    if dataset.catalog is not None:
+        LOG.info("Computing weights for weighted random sampling from the catalog")
+        weights = smooth_weights(dataset.catalog.entropy(), smoothing=smoothing)
     else:
+        # the label scan is shared with the body ratio filtering, labels are read at most once
         LOG.info("Computing weights for weighted random sampling")
-        weights = entropy_weights(dataset.label_files, smoothing=smoothing)
-        np.save(str(target_file), weights)
+        weights = entropy_weights(dataset.label_files,
+                                  smoothing=smoothing,
+                                  workers=workers,
+                                  cache_file=label_scan_cache("train", cache_hash))
     # completely arbitrary, this is just here to maximize the amount of images we look at
     num_samples = len(dataset) * 2
     return WeightedRandomSampler(weights=weights, num_samples=num_samples, replacement=True)
@@ -1,28 +1,44 @@
 import json
 import logging
 import os
+import time
+from collections import defaultdict
+from contextlib import ExitStack, nullcontext
 from glob import glob
+from itertools import groupby
 from pathlib import Path
-from typing import Callable, Counter, Optional, Set, Tuple, Union
+from typing import Callable, Counter, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import cv2
 import numpy as np
 import rasterio
 from joblib import Parallel, delayed
 from rasterio.enums import Resampling
-from rasterio.io import MemoryFile
+from rasterio.io import DatasetReader, MemoryFile
+from rasterio.transform import Affine
 from rasterio.windows import Window
-from skimage.restoration import denoise_nl_means
 from tqdm import tqdm
 
-from floods.config.preproc import ImageType, PreparationConfig, StatsConfig
+from floods.config.preproc import (Compression, Denoiser, ImageType, OtsuLevel, PreparationConfig, PseudolabelMethod,
+                                   StatsConfig, TileFormat)
 from floods.datasets.flood import FloodDataset
 from floods.utils.common import check_or_make_dir, print_config
-from floods.utils.gis import imread, mask_raster, write_window
+from floods.utils.catalog import CATALOG_FILE, merge_records, tile_record, write_catalog
+from floods.utils.denoise import denoise
+from floods.utils.gis import array_window, decode_tile, encode_tile, imread, write_array_window
+from floods.utils.index import TileFiles, index_tiles
+from floods.utils.manifest import SceneManifest, fingerprint
 from floods.utils.ml import F16_EPS, identity
+from floods.utils.scenes import BLOCK_SIZE, SCENES_DIR, SceneRasterWriter
+from floods.utils.stacked import (STACKED_DIR, StackedSequence, StackedTileWriter, read_stacked, stacked_roles,
+                                  write_stacked)
+from floods.utils.stats import Histogram, Moments, QuantileSketch, otsu_threshold
+from floods.utils.store import PackedTileStore, PackedTileWriter, consolidate_shards
 from floods.utils.tiling import DynamicOverlapTiler, SingleImageTiler, Tiler
 
 LOG = logging.getLogger(__name__)
+# compact DEM tiles are stored as int16 multiples of this, in meters (about +-8000m)
+DEM_SCALE = 0.25
 
 
 class MorphologyTransform:
@@ -58,19 +74,6 @@ class MorphologyTransform:
         return self._process_mask(image)
 
 
-def _dims(image: np.ndarray) -> Tuple[int, int]:
-    """Returns the first two dimensions of the given array, supposed to be
-    an image in channels-last configuration (width - height).
-
-    Args:
-        image (np.ndarray): array representing an image
-
-    Returns:
-        Tuple[int, int]: height and width
-    """
-    return image.shape[:2]
-
-
 def _extract_emsr(path: Union[str, Path]) -> str:
     """Transforms string like 'EMSR345-0-0' into 'EMSR345'
 
@@ -84,14 +87,6 @@ def _extract_emsr(path: Union[str, Path]) -> str:
     return image_id.split("-")[0]
 
 
-def _delete_group(*paths: Tuple[Path, ...]) -> None:
-    """Deletes the given variable list of paths, useful to delete tuples.
-    """
-    for path in paths:
-        if os.path.exists(str(path)):
-            os.remove(path)
-
-
 def _gather_files(sar_glob: Path,
                   dem_glob: Path,
                   mask_glob: Path,
@@ -123,7 +118,7 @@ def _gather_files(sar_glob: Path,
         for paths in zip(sar_files, dem_files, msk_files):
             names = [Path(p).stem for p in paths]
             assert names.count(names[0]) == len(names), f"Name mismatch in tuple: {names}"
-    if subset:
+    if subset is not None:
         sar_files = list(filter(lambda p: _extract_emsr(p) in subset, sar_files))
         dem_files = list(filter(lambda p: _extract_emsr(p) in subset, dem_files))
         msk_files = list(filter(lambda p: _extract_emsr(p) in subset, msk_files))
@@ -160,79 +155,670 @@ def _clip_dem(data: np.ndarray):
     return data
 
 
-def _process_tiff(image_id: str,
-                  source_path: Path,
-                  dst_path: Path,
-                  image_type: ImageType,
-                  tiling_fn: Tiler,
-                  process_fn: Optional[Callable] = None,
-                  scale: float = 1.0,
+def _resize(dataset: DatasetReader,
+            height: int,
+            width: int,
+            resampling: Resampling = Resampling.bilinear) -> Tuple[np.ndarray, Affine]:
+    """Reads the whole raster at the given size (decimated read), updating the geotransform accordingly.
+
+    Args:
+        dataset (DatasetReader): open raster, usually the in-memory copy of a decoded source
+        height (int): target height
+        width (int): target width
+        resampling (Resampling, optional): resampling strategy. Defaults to Resampling.bilinear.
+
+    Returns:
+        Tuple[np.ndarray, Affine]: resized image, with format CxHxW, and its transform
+    """
+    # given the possible resize, both transform and dimensions need to be updated
+    transform = dataset.transform * Affine.scale(dataset.width / width, dataset.height / height)
+    image = dataset.read(out_shape=(dataset.count, height, width), resampling=resampling)
+    return image, transform
+
+
+def _read_pyramid(source_path: Path,
+                  scales: List[int],
                   resampling: Resampling = Resampling.bilinear,
-                  is_context: bool = False,
-                  name_suffix: str = "") -> Tuple[int, int]:
-    """Main function, processes the inputs by reading them, doing some checks and additional stuff
-    for masks, then tiles them ans stores the single chips.
+                  context_size: Optional[int] = None) -> Tuple[Dict[int, tuple], Optional[tuple], dict]:
+    """Decodes the given raster once, then derives every required scale and the optional context thumbnail
+    with decimated reads of an uncompressed in-memory copy, updating the geotransforms accordingly.
+    Results are the same of the decimated reads from the source file, without decoding it again.
+    The copy is only made when resampling is required, unit scales return the decoded image itself.
+
+    Args:
+        source_path (Path): path to the GeoTIFF image.
+        scales (List[int]): tile multipliers, a value of 2 means the image is downscaled by half.
+        resampling (Resampling, optional): resampling strategy. Defaults to Resampling.bilinear.
+        context_size (Optional[int], optional): when present, also shrinks the whole image to this size.
+
+    Returns:
+        Tuple[Dict[int, tuple], Optional[tuple], dict]: (image, transform) for every scale, same for the
+        context image (or None), the source profile
+    """
+    with rasterio.open(str(source_path), mode="r", driver="GTiff") as dataset:
+        image = dataset.read()
+        profile: dict = dataset.profile
+    _, orig_height, orig_width = image.shape
+    shapes = {scale: (int(orig_height * (1.0 / scale)), int(orig_width * (1.0 / scale))) for scale in scales}
+    # unit scales are served directly, the in-memory copy is only required when resampling
+    levels = {scale: (image, profile["transform"]) for scale, shape in shapes.items() if shape == image.shape[1:]}
+    context = None
+    if len(levels) == len(shapes) and not context_size:
+        return levels, context, profile
+    with MemoryFile() as memfile:
+        with memfile.open(driver="GTiff",
+                          height=orig_height,
+                          width=orig_width,
+                          count=image.shape[0],
+                          dtype=image.dtype,
+                          nodata=profile.get("nodata"),
+                          crs=profile.get("crs"),
+                          transform=profile["transform"]) as dst:
+            dst.write(image)
+        with memfile.open() as dataset:
+            for tile_scale, shape in shapes.items():
+                if tile_scale not in levels:
+                    levels[tile_scale] = _resize(dataset, *shape, resampling=resampling)
+            if context_size:
+                context = _resize(dataset, context_size, context_size, resampling=resampling)
+    return levels, context, profile
+
+
+def _tile_metadata(profile: dict, count: int) -> dict:
+    """Basic metadata (driver, data type, nodata and CRS) of the output rasters, taken from the source profile,
+    with the output encoding (see `_tile_encoding`) on top, if any. Compressed tiles get the predictor of their type.
+    """
+    metadata = dict(driver="GTiff", dtype=profile["dtype"], nodata=profile.get("nodata"), crs=profile.get("crs"))
+    metadata.update(profile.get("encoding", dict()), count=count)
+    if "compress" in metadata:
+        metadata.update(predictor=3 if np.issubdtype(np.dtype(metadata["dtype"]), np.floating) else 2)
+    return metadata
+
+
+def _tile_encoding(compact: bool = False, compression: Compression = Compression.none) -> Dict[ImageType, dict]:
+    """Output options of each image type, applied on top of the source profiles: with compact tiles, SAR values
+    are stored in half precision (16 bits floats, widened by GDAL on read) and DEM values as scaled int16.
+    Compressed tiles are also internally tiled.
+    """
+    encoding = {image_type: dict() for image_type in ImageType}
+    if compact:
+        encoding[ImageType.SAR].update(dtype="float32", nbits=16)
+        encoding[ImageType.DEM].update(dtype="int16", nodata=None, scale_factor=DEM_SCALE)
+    if compression != Compression.none:
+        for options in encoding.values():
+            options.update(compress=compression.value, tiled=True, blockxsize=BLOCK_SIZE, blockysize=BLOCK_SIZE)
+    return encoding
+
+
+def _invalid_pixels(sar: np.ndarray, metadata: dict) -> np.ndarray:
+    """Computes the 2D mask of invalid pixels (nan in any channel) on the SAR image, as it would be stored.
+    """
+    return np.isnan(sar.astype(metadata["dtype"], copy=False).sum(axis=0))
+
+
+def _process_tiles(image_id: str,
+                   images: Dict[ImageType, np.ndarray],
+                   transform: Affine,
+                   profiles: Dict[ImageType, dict],
+                   dst_path: Path,
+                   windows: Iterable[tuple],
+                   nan_threshold: Optional[float] = None,
+                   is_context: bool = False,
+                   name_suffix: str = "",
+                   offset: Tuple[int, int] = (0, 0),
+                   writer: Optional[Union[PackedTileWriter, StackedTileWriter]] = None,
+                   write_tiles: bool = True) -> Tuple[List[dict], int]:
+    """Main function, tiles the already processed SAR, DEM and mask images together and stores the single chips.
+    Invalid pixels are checked on the SAR tile before writing anything: mostly empty tiles are discarded,
+    while the others are stored once, with invalid pixels replaced by the ignore value of each image type.
+    The images may also be a portion (e.g. a block row) of the full scene, starting at the given offset.
+    A catalog record is computed for each stored tile, while its pixels are still in memory.
 
     Args:
         image_id (str): emsr-like code identifier of the tuple.
-        source_path (Path): path to the image.
+        images (Dict[ImageType, np.ndarray]): processed images (channels first), same size for every type.
+        transform (Affine): geotransform of the full scene, shared by the given images.
+        profiles (Dict[ImageType, dict]): profiles of the source rasters, one for each image type.
         dst_path (Path): path where to store the tiles.
-        image_type (ImageType): sar, dem or mask.
-        tiling_fn (Callable): callable for the tiling operation, yields coordinates.
-        process_fn (Optional[Callable], optional): optional callable for mask processing. Defaults to None.
-        scale (Optional[float]): optional value to up/downscale the image before tiling.
-        resampling (Optional[Resampling]): resampling strategy, defaults to bilinear.
+        windows (Iterable[tuple]): tile coordinates, as yielded by a tiler, relative to the full scene.
+        nan_threshold (Optional[float]): ratio of invalid pixels before discarding the tile, None to keep all.
         is_context (Optional[bool]): whether the current image is a context image (should be shrinked).
         name_suffix (Optional[str]): optional suffix to add at the end of the file (useful for multi-scale).
+        offset (Tuple[int, int], optional): row and column of the first pixel of the images in the full scene.
+        writer (Optional[Union[PackedTileWriter, StackedTileWriter]], optional): when given, tiles are appended
+            to the packed store of the scene, or stored as stacked rasters, instead of one GeoTIFF per modality.
+        write_tiles (bool, optional): whether to store the tiles at all, virtual tiles are only recorded
+            in the catalog, as windows of the scene rasters. Defaults to True.
 
     Returns:
-        Tuple[int, int]: number of tiles for each axis
+        Tuple[List[dict], int]: catalog records of the stored tiles (see `tile_record`) and number of discarded tiles
     """
-    group, _ = image_type.value
-    process_fn = process_fn or identity
+    sar = images[ImageType.SAR]
+    dims = {image_type.value[0]: image.shape[1:] for image_type, image in images.items()}
+    assert len(set(dims.values())) == 1, f"Shape mismatch for {image_id}: {dims}"
     # create destination subfolders paths (dem/sar/mask) and additional context folder if necessary
+    # tiles are sliced directly from the processed arrays, only the basic metadata is kept
     ctx_dir = "context" if is_context else ""
-    root_dir = Path(dst_path) / group / ctx_dir
-    check_or_make_dir(root_dir)
-    # read image using rasterio
-    # once opened, rescale according to the factor, adjusting the transform
-    with rasterio.open(str(source_path), mode="r", driver="GTiff") as dataset:
-        # read image with varying output shape to resize
-        # 1. if multiscale, resize proportionally
-        # 2. if context, shrink the whole image to the tile dimension
-        orig_height = dataset.height
-        orig_width = dataset.width
+    root_dirs, metadata = dict(), dict()
+    for image_type, image in images.items():
+        group, _ = image_type.value
+        if writer is None:
+            root_dirs[image_type] = check_or_make_dir(Path(dst_path) / group / ctx_dir)
+        metadata[image_type] = _tile_metadata(profiles[image_type], count=image.shape[0])
+    orig_height = profiles[ImageType.SAR]["height"]
+    orig_width = profiles[ImageType.SAR]["width"]
+    # windows are expressed in scene coordinates, while the images may start somewhere else
+    row_offset, col_offset = offset
+    transform = transform * Affine.translation(col_offset, row_offset)
+    valid, removed = list(), 0
+    for _, coords in windows:
+        x1, y1, x2, y2 = coords
+        window = Window.from_slices(rows=(x1 - row_offset, x2 - row_offset), cols=(y1 - col_offset, y2 - col_offset))
+        # remove mostly nan tiles, using the configured percentage, before they are ever written
+        # otherwise replace nans with the ignore values (not important for sar and dem, but 255 for losses)
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+        nan_mask = _invalid_pixels(sar[:, row_start:row_stop, col_start:col_stop], metadata[ImageType.SAR])
+        empty_pixels = np.count_nonzero(nan_mask)
+        if nan_threshold is not None and (empty_pixels / float((x2 - x1) * (y2 - y1))) >= nan_threshold:
+            removed += 1
+            continue
         if is_context:
-            out_shape = (dataset.count, tiling_fn.tile_size, tiling_fn.tile_size)
+            tile_name = f"{image_id}_{orig_height}_{orig_width}{name_suffix}.tif"
         else:
-            out_shape = (dataset.count, int(dataset.height * scale), int(dataset.width * scale))
-        image = dataset.read(out_shape=out_shape, resampling=resampling)
-        _, height, width = image.shape
-        # given the possible resize, both transform and dimensions need to be updated
-        transform = dataset.transform * dataset.transform.scale(dataset.width / width, dataset.height / height)
-        profile: dict = dataset.profile
-        # transform the image to extract the number of channels (it may vary depending on process_fn)
-        processed_img = process_fn(image)
-        channels = processed_img.shape[0]
-        profile.update(height=height, width=width, count=channels)
-        # create and open an in-memory file to store results
-        # during preprocessing
-        with MemoryFile() as memfile:
-            with memfile.open(**profile) as processed:
-                processed.write(processed_img)
-                processed.transform = transform
-                generator = tiling_fn(image)
-                # store result, using target raster (which could be either)
-                for (tile_row, tile_col), coords in generator:
-                    x1, y1, x2, y2 = coords
-                    window = Window.from_slices(rows=(x1, x2), cols=(y1, y2))
-                    if is_context:
-                        tile_path = root_dir / f"{image_id}_{orig_height}_{orig_width}{name_suffix}.tif"
+            tile_name = f"{image_id}_{x1}_{y1}{name_suffix}.tif"
+        if writer is not None and write_tiles:
+            writer.add(Path(tile_name).stem,
+                       height=nan_mask.shape[0],
+                       width=nan_mask.shape[1],
+                       transform=rasterio.windows.transform(window, transform),
+                       crs=metadata[ImageType.SAR]["crs"])
+        tiles = dict()
+        for image_type, image in images.items():
+            group, ignore_value = image_type.value
+            if writer is not None or not write_tiles:
+                tile = array_window(image, window, mask=nan_mask if empty_pixels > 0 else None, mask_value=ignore_value)
+                tile = tile.astype(metadata[image_type]["dtype"], copy=False)
+                if write_tiles:
+                    writer.write(group, tile)
+            else:
+                tile = write_array_window(image,
+                                          window,
+                                          path=root_dirs[image_type] / tile_name,
+                                          profile=metadata[image_type],
+                                          transform=transform,
+                                          mask=nan_mask if empty_pixels > 0 else None,
+                                          mask_value=ignore_value)
+                tile = decode_tile(tile, metadata[image_type].get("scale_factor"))
+            tiles[image_type] = tile
+        valid.append(
+            tile_record(tile_name,
+                        row=x1,
+                        col=y1,
+                        sar=tiles[ImageType.SAR],
+                        dem=tiles[ImageType.DEM],
+                        mask=tiles[ImageType.MASK],
+                        invalid=nan_mask))
+    return valid, removed
+
+
+def _scene_writer(dst_path: Path, image_id: str, output_format: TileFormat, is_context: bool = False):
+    """Returns the packed writer of the given scene, the stacked writer, or an empty context when tiles are stored
+    as single files for each modality.
+    """
+    if output_format == TileFormat.stacked:
+        path = Path(dst_path) / STACKED_DIR
+        return StackedTileWriter(path / "context" if is_context else path)
+    if output_format != TileFormat.packed:
+        return nullcontext()
+    return PackedTileWriter(_packed_path(dst_path, is_context=is_context), scene_id=image_id)
+
+
+def _packed_path(dst_path: Path, is_context: bool = False) -> Path:
+    path = Path(dst_path) / "packed"
+    return path / "context" if is_context else path
+
+
+def _scene_rasters(dst_path: Path,
+                   image_id: str,
+                   output_format: TileFormat,
+                   shape: Tuple[int, int],
+                   transform: Affine,
+                   name_suffix: str = ""):
+    """Returns the writer of the processed scene rasters for the virtual format, or an empty context otherwise.
+    """
+    if output_format != TileFormat.virtual:
+        return nullcontext()
+    return SceneRasterWriter(dst_path, f"{image_id}{name_suffix}.tif", *shape, transform=transform)
+
+
+def _write_scene_rows(rasters: Optional[SceneRasterWriter],
+                      images: Dict[ImageType, np.ndarray],
+                      profiles: Dict[ImageType, dict],
+                      row_offset: int = 0) -> None:
+    """Stores a block of rows of the processed scene, with invalid pixels replaced by the ignore values,
+    so that any window of the scene rasters is identical to the corresponding tile.
+    """
+    if rasters is None:
+        return
+    metadata = {t: _tile_metadata(profiles[t], count=image.shape[0]) for t, image in images.items()}
+    nan_mask = _invalid_pixels(images[ImageType.SAR], metadata[ImageType.SAR])
+    for image_type, image in images.items():
+        group, ignore_value = image_type.value
+        image = image.astype(metadata[image_type]["dtype"])
+        image[:, nan_mask] = ignore_value
+        rasters.write(group, image, profile=metadata[image_type], row_offset=row_offset)
+
+
+def _remove_scenes(dst_path: Path, image_ids: Set[str]) -> None:
+    """Removes the processed scene rasters (virtual format) of the given scenes, at every scale.
+    """
+    for group in [t.value[0] for t in ImageType]:
+        folder = Path(dst_path) / SCENES_DIR / group
+        if not image_ids or not folder.is_dir():
+            continue
+        for entry in os.scandir(folder):
+            stem = Path(entry.name).stem
+            if stem in image_ids or stem.rsplit("_x", 1)[0] in image_ids:
+                os.remove(entry.path)
+
+
+def _load_subsets(summary_file: Union[str, Path]) -> Dict[str, str]:
+    """Loads the summary file containing all the EMSR information, returning the split of each EMSR code.
+    """
+    code2subset = dict()
+    with open(summary_file, "r", encoding="utf-8") as f:
+        for k, v in json.load(f).items():
+            code2subset[k] = v["subset"]
+    return code2subset
+
+
+def processing_functions(decibel: bool = True,
+                         colorize: bool = False,
+                         clip_dem: bool = True,
+                         morphology: bool = True,
+                         morph_kernel: int = 5) -> Tuple[Optional[Callable], ...]:
+    """Returns the preprocessing functions for SAR, DEM and masks (None means no processing), with the same
+    defaults of the preprocessing configuration, so that images read elsewhere can be processed the same way.
+    """
+    sar_process = None
+    if decibel:
+        sar_process = _decibel
+    elif colorize:
+        sar_process = _rgb_ratio
+    dem_process = _clip_dem if clip_dem else None
+    morph = None if not morphology else MorphologyTransform(kernel_size=morph_kernel, channels_first=True)
+    return sar_process, dem_process, morph
+
+
+def _processing_functions(config: PreparationConfig) -> Tuple[Optional[Callable], ...]:
+    """Returns the preprocessing functions for SAR, DEM and masks, as configured (None means no processing).
+    """
+    return processing_functions(decibel=config.decibel,
+                                colorize=config.colorize,
+                                clip_dem=config.clip_dem,
+                                morphology=config.morphology,
+                                morph_kernel=config.morph_kernel)
+
+
+def _tile_coords(tile_name: str) -> Tuple[int, int, int]:
+    """Transforms tile names like 'EMSR345-0_512_0_x2.tif' into their coordinates and scale: (512, 0, 2).
+    """
+    parts = Path(tile_name).stem.split("_")
+    scale = 1
+    if parts[-1].startswith("x"):
+        scale = int(parts.pop()[1:])
+    return int(parts[-2]), int(parts[-1]), scale
+
+
+def _tile_scene(tile_name: str) -> str:
+    """Transforms tile names like 'EMSR345-0_512_0_x2.tif' or 'EMSR345-0_512_0.tif' into 'EMSR345-0'.
+    """
+    parts = Path(tile_name).stem.split("_")
+    if parts[-1].startswith("x"):
+        parts = parts[:-1]
+    return "_".join(parts[:-2])
+
+
+def _remove_tiles(dst_path: Path, image_ids: Set[str]) -> None:
+    """Removes every tile (single files, including context and weights) of the given scenes from the subset folder.
+    Packed stores are rebuilt at the end of each run and do not need this, any single file is left untouched.
+    """
+    if not image_ids:
+        return
+    for group in [t.value[0] for t in ImageType] + ["weight", STACKED_DIR]:
+        for folder in (Path(dst_path) / group, Path(dst_path) / group / "context"):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder):
+                if entry.is_file() and entry.name.endswith(".tif") and _tile_scene(entry.name) in image_ids:
+                    os.remove(entry.path)
+
+
+def _process_scene(image_id: str,
+                   sar_path: Path,
+                   dem_path: Path,
+                   msk_path: Path,
+                   dst_path: Path,
+                   tiling_fn: Tiler,
+                   scales: List[int],
+                   make_context: bool = False,
+                   nan_threshold: Optional[float] = None,
+                   sar_process: Optional[Callable] = None,
+                   dem_process: Optional[Callable] = None,
+                   msk_process: Optional[Callable] = None,
+                   output_format: TileFormat = TileFormat.tif,
+                   encoding: Optional[Dict[ImageType, dict]] = None) -> Tuple[Dict[int, Tuple[int, int]], List[dict]]:
+    """Processes a single (SAR, DEM, mask) triplet at every required scale, plus the optional context images.
+    Every scene is independent from the others, so that this can be safely executed in a separate process.
+    Each raster is decoded only once, scales and context are derived in memory.
+
+    Args:
+        image_id (str): emsr-like code identifier of the tuple.
+        sar_path (Path): path to the SAR image.
+        dem_path (Path): path to the DEM image.
+        msk_path (Path): path to the ground truth mask.
+        dst_path (Path): path where to store the tiles, subfolders are created automatically.
+        tiling_fn (Tiler): tiling operator, yields coordinates.
+        scales (List[int]): list of tile multipliers (x2 means a tile twice as large, then resized).
+        make_context (bool, optional): whether to also produce the context images. Defaults to False.
+        nan_threshold (Optional[float], optional): ratio of invalid pixels before discarding a tile, None keeps all.
+        sar_process (Optional[Callable], optional): preprocessing function for SAR images. Defaults to None.
+        dem_process (Optional[Callable], optional): preprocessing function for DEM images. Defaults to None.
+        msk_process (Optional[Callable], optional): preprocessing function for masks. Defaults to None.
+        output_format (TileFormat, optional): single GeoTIFF files or per-scene shards of a packed store.
+        encoding (Optional[Dict[ImageType, dict]], optional): output options of each image type, on top of the
+            source profiles (see `_tile_encoding`). Defaults to None.
+
+    Returns:
+        Tuple[Dict[int, Tuple[int, int]], List[dict]]: number of stored and discarded tiles for each scale,
+            catalog records of every stored tile (names of context tiles are prefixed by their folder)
+    """
+    encoding = encoding or dict()
+    context_size = tiling_fn.tile_size if make_context else None
+    pyramids, contexts, profiles, process_fns = dict(), dict(), dict(), dict()
+    for image_type, path, process_fn, resampling in ((ImageType.SAR, sar_path, sar_process, Resampling.bilinear),
+                                                     (ImageType.DEM, dem_path, dem_process, Resampling.bilinear),
+                                                     (ImageType.MASK, msk_path, msk_process, Resampling.nearest)):
+        levels, context, profile = _read_pyramid(path, scales=scales, resampling=resampling, context_size=context_size)
+        pyramids[image_type] = levels
+        contexts[image_type] = context
+        profiles[image_type] = dict(profile, encoding=encoding.get(image_type, dict()))
+        process_fns[image_type] = process_fn or identity
+    # values are reversed: a scale factor of 2 (x2) means a tile 1024x1024
+    # this is equivalent to a tile 512x512, on the image downscaled by 1/2
+    result, tiles = dict(), list()
+    with _scene_writer(dst_path, image_id, output_format) as writer:
+        for tile_scale in scales:
+            name_suffix = "" if tile_scale == 1 else f"_x{tile_scale}"
+            images = {t: process_fns[t](levels[tile_scale][0]) for t, levels in pyramids.items()}
+            transform = pyramids[ImageType.SAR][tile_scale][1]
+            shape = images[ImageType.SAR].shape[1:]
+            with _scene_rasters(dst_path, image_id, output_format, shape, transform, name_suffix) as rasters:
+                _write_scene_rows(rasters, images, profiles)
+            valid, removed = _process_tiles(image_id,
+                                            images,
+                                            transform,
+                                            profiles,
+                                            dst_path,
+                                            windows=tiling_fn(images[ImageType.SAR]),
+                                            nan_threshold=nan_threshold,
+                                            name_suffix=name_suffix,
+                                            writer=writer,
+                                            write_tiles=output_format != TileFormat.virtual)
+            result[tile_scale] = (len(valid), removed)
+            tiles.extend(valid)
+    # last generate context (global) images, only once per scene and never discarded
+    if make_context:
+        images = {t: process_fns[t](context[0]) for t, context in contexts.items()}
+        with _scene_writer(dst_path, image_id, output_format, is_context=True) as writer:
+            valid, _ = _process_tiles(image_id,
+                                      images,
+                                      contexts[ImageType.SAR][1],
+                                      profiles,
+                                      dst_path,
+                                      windows=tiling_fn(images[ImageType.SAR]),
+                                      is_context=True,
+                                      writer=writer)
+        tiles.extend(dict(record, name=f"context/{record['name']}") for record in valid)
+    return result, tiles
+
+
+def _read_rows(datasets: Dict[ImageType, DatasetReader],
+               process_fns: Dict[ImageType, Callable],
+               resamplings: Dict[ImageType, Resampling],
+               shape: Tuple[int, int],
+               rows: Tuple[int, int],
+               halo: int = 0) -> Dict[int, np.ndarray]:
+    """Reads and processes a block of rows from each dataset, using windowed (and decimated, if the given shape
+    is smaller than the source) reads. An additional halo of rows is read and discarded after processing,
+    so that neighbourhood operations (e.g. morphology) are not affected by the block boundaries.
+
+    Args:
+        datasets (Dict[ImageType, DatasetReader]): open source rasters, one for each image type.
+        process_fns (Dict[ImageType, Callable]): processing function for each image type.
+        resamplings (Dict[ImageType, Resampling]): resampling strategy for each image type.
+        shape (Tuple[int, int]): height and width of the full scene at the current scale.
+        rows (Tuple[int, int]): first and last (excluded) rows to be returned, at the current scale.
+        halo (int, optional): additional rows to read above and below the block. Defaults to 0.
+
+    Returns:
+        Dict[int, np.ndarray]: processed block for each image type, channels first.
+    """
+    height, width = shape
+    start, stop = rows
+    top, bottom = max(start - halo, 0), min(stop + halo, height)
+    images = dict()
+    for image_type, dataset in datasets.items():
+        row_ratio = dataset.height / float(height)
+        window = Window(0, top * row_ratio, dataset.width, (bottom - top) * row_ratio)
+        block = dataset.read(window=window,
+                             out_shape=(dataset.count, bottom - top, width),
+                             resampling=resamplings[image_type])
+        block = process_fns[image_type](block)
+        images[image_type] = block[:, start - top:stop - top]
+    return images
+
+
+def _stream_scene(image_id: str,
+                  sar_path: Path,
+                  dem_path: Path,
+                  msk_path: Path,
+                  dst_path: Path,
+                  tiling_fn: Tiler,
+                  scales: List[int],
+                  make_context: bool = False,
+                  nan_threshold: Optional[float] = None,
+                  sar_process: Optional[Callable] = None,
+                  dem_process: Optional[Callable] = None,
+                  msk_process: Optional[Callable] = None,
+                  output_format: TileFormat = TileFormat.tif,
+                  encoding: Optional[Dict[ImageType, dict]] = None,
+                  halo: int = 0) -> Tuple[Dict[int, Tuple[int, int]], List[dict]]:
+    """Bounded-memory version of `_process_scene`: tile windows are planned from the raster dimensions alone,
+    then pixels are read, processed and written one block row at a time, using windowed reads.
+    Peak memory depends on the tile size and the scene width, not on the scene size.
+    Whole-image tilers (test set) write their single output one block of rows at a time.
+
+    Args:
+        image_id (str): emsr-like code identifier of the tuple.
+        sar_path (Path): path to the SAR image.
+        dem_path (Path): path to the DEM image.
+        msk_path (Path): path to the ground truth mask.
+        dst_path (Path): path where to store the tiles, subfolders are created automatically.
+        tiling_fn (Tiler): tiling operator, it must be able to plan windows from dimensions.
+        scales (List[int]): list of tile multipliers (x2 means a tile twice as large, then resized).
+        make_context (bool, optional): whether to also produce the context images. Defaults to False.
+        nan_threshold (Optional[float], optional): ratio of invalid pixels before discarding a tile, None keeps all.
+        sar_process (Optional[Callable], optional): preprocessing function for SAR images. Defaults to None.
+        dem_process (Optional[Callable], optional): preprocessing function for DEM images. Defaults to None.
+        msk_process (Optional[Callable], optional): preprocessing function for masks. Defaults to None.
+        output_format (TileFormat, optional): single GeoTIFF files or per-scene shards of a packed store.
+        encoding (Optional[Dict[ImageType, dict]], optional): output options of each image type, on top of the
+            source profiles (see `_tile_encoding`). Defaults to None.
+        halo (int, optional): extra rows read around each block, for neighbourhood operations. Defaults to 0.
+
+    Returns:
+        Tuple[Dict[int, Tuple[int, int]], List[dict]]: number of stored and discarded tiles for each scale,
+            catalog records of every stored tile (names of context tiles are prefixed by their folder)
+    """
+    encoding = encoding or dict()
+    sources = ((ImageType.SAR, sar_path, sar_process, Resampling.bilinear),
+               (ImageType.DEM, dem_path, dem_process, Resampling.bilinear),
+               (ImageType.MASK, msk_path, msk_process, Resampling.nearest))
+    process_fns = {image_type: fn or identity for image_type, _, fn, _ in sources}
+    resamplings = {image_type: resampling for image_type, _, _, resampling in sources}
+    result, tiles = dict(), list()
+    with ExitStack() as stack:
+        datasets = {t: stack.enter_context(rasterio.open(str(p), mode="r", driver="GTiff")) for t, p, _, _ in sources}
+        profiles = {t: dict(dataset.profile, encoding=encoding.get(t, dict())) for t, dataset in datasets.items()}
+        dims = {image_type.value[0]: dataset.shape for image_type, dataset in datasets.items()}
+        assert len(set(dims.values())) == 1, f"Shape mismatch for {image_id}: {dims}"
+        height, width = datasets[ImageType.SAR].shape
+        source_transform = profiles[ImageType.SAR]["transform"]
+        whole_image = isinstance(tiling_fn, SingleImageTiler)
+        writer = stack.enter_context(_scene_writer(dst_path, image_id, output_format))
+        for tile_scale in scales:
+            name_suffix = "" if tile_scale == 1 else f"_x{tile_scale}"
+            shape = (int(height * (1.0 / tile_scale)), int(width * (1.0 / tile_scale)))
+            transform = source_transform * Affine.scale(width / shape[1], height / shape[0])
+            rasters = stack.enter_context(
+                _scene_rasters(dst_path, image_id, output_format, shape, transform, name_suffix))
+            if whole_image:
+                valid, removed = _stream_whole(image_id,
+                                               datasets,
+                                               process_fns,
+                                               resamplings,
+                                               shape=shape,
+                                               transform=transform,
+                                               profiles=profiles,
+                                               dst_path=dst_path,
+                                               block_size=tiling_fn.tile_size,
+                                               name_suffix=name_suffix,
+                                               halo=halo,
+                                               writer=writer,
+                                               rasters=rasters)
+                result[tile_scale] = (len(valid), removed)
+                tiles.extend(valid)
+                continue
+            # group windows by their starting row, so that each block row is read once
+            valid, removed = list(), 0
+            for row, windows in groupby(tiling_fn.windows(*shape), key=lambda w: w[1][0]):
+                windows = list(windows)
+                last_row = min(max(coords[2] for _, coords in windows), shape[0])
+                images = _read_rows(datasets, process_fns, resamplings, shape=shape, rows=(row, last_row), halo=halo)
+                # overlapping rows of consecutive blocks are simply written again, with the same values
+                _write_scene_rows(rasters, images, profiles, row_offset=row)
+                row_valid, row_removed = _process_tiles(image_id,
+                                                        images,
+                                                        transform,
+                                                        profiles,
+                                                        dst_path,
+                                                        windows=windows,
+                                                        nan_threshold=nan_threshold,
+                                                        name_suffix=name_suffix,
+                                                        offset=(row, 0),
+                                                        writer=writer,
+                                                        write_tiles=output_format != TileFormat.virtual)
+                valid += row_valid
+                removed += row_removed
+            result[tile_scale] = (len(valid), removed)
+            tiles.extend(valid)
+        # context images are tiny, the decimated read is handled block-wise by GDAL
+        if make_context:
+            size = tiling_fn.tile_size
+            images = _read_rows(datasets, process_fns, resamplings, shape=(size, size), rows=(0, size))
+            with _scene_writer(dst_path, image_id, output_format, is_context=True) as writer:
+                valid, _ = _process_tiles(image_id,
+                                          images,
+                                          source_transform * Affine.scale(width / size, height / size),
+                                          profiles,
+                                          dst_path,
+                                          windows=[((0, 0), (0, 0, size, size))],
+                                          is_context=True,
+                                          writer=writer)
+            tiles.extend(dict(record, name=f"context/{record['name']}") for record in valid)
+    return result, tiles
+
+
+def _stream_whole(image_id: str,
+                  datasets: Dict[ImageType, DatasetReader],
+                  process_fns: Dict[ImageType, Callable],
+                  resamplings: Dict[ImageType, Resampling],
+                  shape: Tuple[int, int],
+                  transform: Affine,
+                  profiles: Dict[ImageType, dict],
+                  dst_path: Path,
+                  block_size: int,
+                  name_suffix: str = "",
+                  halo: int = 0,
+                  writer: Optional[Union[PackedTileWriter, StackedTileWriter]] = None,
+                  rasters: Optional[SceneRasterWriter] = None) -> Tuple[List[dict], int]:
+    """Streams the whole scene into a single output per image type, one block of rows at a time.
+    Invalid pixels are replaced with the ignore values, nothing is discarded.
+    When a packed (or stacked) writer is given, the scene is stored as a single tile of the store,
+    while virtual tiles only require the scene rasters.
+    The catalog record is accumulated block by block.
+
+    Returns:
+        Tuple[List[dict], int]: record of the stored image and number of discarded images (always zero)
+    """
+    height, width = shape
+    tile_name = f"{image_id}_0_0{name_suffix}.tif"
+    sar_meta = _tile_metadata(profiles[ImageType.SAR], count=datasets[ImageType.SAR].count)
+    if writer is not None:
+        writer.add(Path(tile_name).stem, height=height, width=width, transform=transform, crs=sar_meta["crs"])
+    records = list()
+    with ExitStack() as stack:
+        outputs, metas = dict(), dict()
+        for start in range(0, height, block_size):
+            stop = min(start + block_size, height)
+            images = _read_rows(datasets, process_fns, resamplings, shape=shape, rows=(start, stop), halo=halo)
+            if writer is not None or rasters is not None:
+                nan_mask = _invalid_pixels(images[ImageType.SAR], sar_meta)
+                for image_type, image in images.items():
+                    group, ignore_value = image_type.value
+                    image = image.astype(profiles[image_type]["dtype"])
+                    image[:, nan_mask] = ignore_value
+                    images[image_type] = image
+                    if writer is not None:
+                        writer.write(group, image, row_offset=start)
                     else:
-                        tile_path = root_dir / f"{image_id}_{x1}_{y1}{name_suffix}.tif"
-                    write_window(window, processed, path=tile_path)
-    # return the total amount of tile rows and cols and a mask, if present
-    return tile_row + 1, tile_col + 1
+                        meta = _tile_metadata(profiles[image_type], count=image.shape[0])
+                        rasters.write(group, image, profile=meta, row_offset=start)
+                records.append(_block_record(tile_name, images, nan_mask))
+                continue
+            # output channels depend on the processing functions, open the outputs once known
+            if not outputs:
+                for image_type, image in images.items():
+                    group, _ = image_type.value
+                    path = check_or_make_dir(Path(dst_path) / group) / tile_name
+                    metas[image_type] = _tile_metadata(profiles[image_type], count=image.shape[0])
+                    meta = {k: v for k, v in metas[image_type].items() if k != "scale_factor"}
+                    outputs[image_type] = stack.enter_context(
+                        rasterio.open(str(path), "w", height=height, width=width, transform=transform, **meta))
+                    if "scale_factor" in metas[image_type]:
+                        outputs[image_type].scales = (metas[image_type]["scale_factor"], ) * image.shape[0]
+            nan_mask = _invalid_pixels(images[ImageType.SAR], outputs[ImageType.SAR].profile)
+            for image_type, image in images.items():
+                _, ignore_value = image_type.value
+                dst = outputs[image_type]
+                scale = metas[image_type].get("scale_factor")
+                image = encode_tile(image, dst.dtypes[0], nbits=metas[image_type].get("nbits"), scale=scale)
+                image[:, nan_mask] = ignore_value
+                images[image_type] = decode_tile(image, scale)
+                dst.write(image, window=Window(0, start, width, stop - start))
+            records.append(_block_record(tile_name, images, nan_mask))
+    return [merge_records(records)], 0
+
+
+def _block_record(tile_name: str, images: Dict[ImageType, np.ndarray], nan_mask: np.ndarray) -> dict:
+    return tile_record(tile_name,
+                       row=0,
+                       col=0,
+                       sar=images[ImageType.SAR],
+                       dem=images[ImageType.DEM],
+                       mask=images[ImageType.MASK],
+                       invalid=nan_mask)
 
 
 def preprocess_data(config: PreparationConfig):
@@ -242,12 +828,7 @@ def preprocess_data(config: PreparationConfig):
 
     # initial checks and common folder inits (if not exists, create)
     dst_dir = check_or_make_dir(config.data_processed)
-    code2subset = dict()
-    # load the summary file containing all the EMSR information, including splits
-    with open(config.summary_file, "r", encoding="utf-8") as f:
-        for k, v in json.load(f).items():
-            code2subset[k] = v["subset"]
-
+    code2subset = _load_subsets(config.summary_file)
     LOG.info(f"EMSR activations: {dict(Counter(code2subset.values()))}")
 
     for subset in config.subset:
@@ -274,197 +855,392 @@ def preprocess_data(config: PreparationConfig):
                 make_context = config.make_context
             else:
                 available_scales = [1]
+                make_context = False
                 tiler = SingleImageTiler(tile_size=config.tile_size, channels_first=True)
             LOG.info(f"Tiling with {type(tiler).__name__}")
+            LOG.info(f"Processing raw dataset with scales: {available_scales} ({config.workers} workers)")
             # prepare preprocessing functions
-            sar_process = None
-            if config.decibel:
-                sar_process = _decibel
-            elif config.colorize:
-                sar_process = _rgb_ratio
-            dem_process = _clip_dem if config.clip_dem else None
-            morph = None if not config.morphology else MorphologyTransform(kernel_size=config.morph_kernel,
-                                                                           channels_first=True)
-            # iterate over the different required scales
-            # values are reversed: a scale factor of 2 (x2) means a tile 1024x1024
-            # this is equivalent to a tile 512x512, on the image downscaled by 1/2
-            for tile_scale in available_scales:
-                LOG.info(f"Processing raw dataset with scale: x{tile_scale}")
-                image_scale = 1.0 / tile_scale
-                name_suffix = "" if tile_scale == 1 else f"_x{tile_scale}"
-                # tile the triplets of images into NxN chips
-                for sar_path, dem_path, msk_path in tqdm(list(zip(sar_files, dem_files, msk_files))):
-                    image_id = Path(sar_path).stem
-                    dem_tiles = _process_tiff(image_id,
-                                              dem_path,
-                                              subset_dir,
-                                              image_type=ImageType.DEM,
-                                              tiling_fn=tiler,
-                                              process_fn=dem_process,
-                                              scale=image_scale,
-                                              resampling=Resampling.bilinear,
-                                              name_suffix=name_suffix)
-                    sar_tiles = _process_tiff(image_id,
-                                              sar_path,
-                                              subset_dir,
-                                              image_type=ImageType.SAR,
-                                              tiling_fn=tiler,
-                                              process_fn=sar_process,
-                                              scale=image_scale,
-                                              resampling=Resampling.bilinear,
-                                              name_suffix=name_suffix)
-                    msk_tiles = _process_tiff(image_id,
-                                              msk_path,
-                                              subset_dir,
-                                              image_type=ImageType.MASK,
-                                              tiling_fn=tiler,
-                                              process_fn=morph,
-                                              scale=image_scale,
-                                              resampling=Resampling.nearest,
-                                              name_suffix=name_suffix)
-                    assert (sar_tiles == dem_tiles == msk_tiles), \
-                        f"Tile mismatch for {image_id}: {sar_tiles} - {dem_tiles} - {msk_tiles}"
-                    # last generate context (global) images, only when the scale is 1 to avoid repeating it
-                    if make_context and tile_scale == 1:
-                        _process_tiff(image_id,
-                                      dem_path,
-                                      subset_dir,
-                                      image_type=ImageType.DEM,
-                                      tiling_fn=tiler,
-                                      process_fn=dem_process,
-                                      scale=1,
-                                      resampling=Resampling.bilinear,
-                                      is_context=True)
-                        _process_tiff(image_id,
+            sar_process, dem_process, morph = _processing_functions(config)
+            # compact types and compression only apply to single GeoTIFF tiles
+            compact = config.compact_tiles or config.compression != Compression.none
+            assert not compact or config.output_format == TileFormat.tif, \
+                "Compact tiles and compression require the tif output format"
+            encoding = _tile_encoding(config.compact_tiles, config.compression)
+            nan_threshold = None if is_test_set else config.nan_threshold
+            scene_fn = _process_scene
+            scene_args = dict()
+            if config.streaming:
+                scene_fn = _stream_scene
+                scene_args.update(halo=config.morph_kernel if config.morphology else 0)
+            # scenes are skipped when the manifest records the same sources, processed with the same settings
+            # anything else (new, changed or interrupted scenes) is cleaned up and processed again
+            settings = dict(scales=available_scales,
+                            make_context=make_context,
+                            nan_threshold=nan_threshold,
+                            tile_size=config.tile_size,
+                            tile_max_overlap=config.tile_max_overlap,
+                            decibel=config.decibel,
+                            colorize=config.colorize,
+                            clip_dem=config.clip_dem,
+                            morphology=config.morphology,
+                            morph_kernel=config.morph_kernel,
+                            output_format=config.output_format.value,
+                            compact_tiles=config.compact_tiles,
+                            compression=config.compression.value)
+            manifest = SceneManifest(dst_dir / "manifest" / subset)
+            entries = manifest.entries()
+            scenes = list(zip(sar_files, dem_files, msk_files))
+            sources = {Path(paths[0]).stem: fingerprint(*paths) for paths in scenes}
+            stale = set(entries) - set(sources)
+            # entries from older versions, without catalog records, are processed again as well
+            pending = [
+                paths for paths in scenes if config.force
+                or not manifest.is_current(entries.get(Path(paths[0]).stem), sources[Path(paths[0]).stem], settings)
+                or "records" not in entries[Path(paths[0]).stem]
+            ]
+            LOG.info(f"Scenes to process: {len(pending)}, up to date: {len(scenes) - len(pending)}")
+            if stale:
+                LOG.info(f"Removing {len(stale)} scenes no longer in the {subset} set")
+            if config.output_format in (TileFormat.tif, TileFormat.stacked):
+                _remove_tiles(subset_dir, stale | {Path(sar_path).stem for sar_path, _, _ in pending})
+            elif config.output_format == TileFormat.virtual:
+                _remove_scenes(subset_dir, stale | {Path(sar_path).stem for sar_path, _, _ in pending})
+            for image_id in stale:
+                manifest.remove(image_id)
+            # tile the triplets of images into NxN chips, one scene per job
+            # mostly empty tiles are discarded on the fly, except for test images that are kept whole
+            # results are yielded in the same order as the inputs, regardless of the completion order
+            # in streaming mode, scenes are read one block row at a time to keep the memory bounded
+            # each scene is recorded in the manifest as soon as it is complete, so that reruns can resume
+            jobs = (delayed(scene_fn)(Path(sar_path).stem,
                                       sar_path,
-                                      subset_dir,
-                                      image_type=ImageType.SAR,
-                                      tiling_fn=tiler,
-                                      process_fn=sar_process,
-                                      scale=1,
-                                      resampling=Resampling.bilinear,
-                                      is_context=True)
-                        _process_tiff(image_id,
+                                      dem_path,
                                       msk_path,
                                       subset_dir,
-                                      image_type=ImageType.MASK,
                                       tiling_fn=tiler,
-                                      process_fn=morph,
-                                      scale=1,
-                                      resampling=Resampling.nearest,
-                                      is_context=True)
-
-        LOG.info("Tiling complete")
-        # From here, assume tiles are done and present in dst_dir
-        # continue with the preprocessing
-        tile_paths = _gather_files(sar_glob=subset_dir / "sar" / "*.tif",
-                                   dem_glob=subset_dir / "dem" / "*.tif",
-                                   mask_glob=subset_dir / "mask" / "*.tif",
-                                   check_stems=False)
-
-        valid, removed = 0, 0
-        tile_area = config.tile_size * config.tile_size
-
-        for sar_path, dem_path, msk_path in tqdm(list(zip(*tile_paths))):
-            image = imread(sar_path)
-            is_context = Path(sar_path).stem.endswith("_full")
-            # remove mostly nan images, using the configured percentage (excluding test images)
-            # tile files are directly deleted, careful about this
-            nan_mask = np.isnan(image.sum(axis=0))
-            empty_pixels = np.count_nonzero(nan_mask)
-            if not (is_test_set or is_context) and (empty_pixels / float(tile_area)) >= config.nan_threshold:
-                _delete_group(sar_path, dem_path, msk_path)
-                removed += 1
-            # otherwise update nans into an actual ignore index
-            # for sar and dem is not important, but the mask should be 255 for losses
-            else:
-                if empty_pixels > 0:
-                    mask_raster(sar_path, mask=nan_mask, mask_value=ImageType.SAR.value[-1])
-                    mask_raster(dem_path, mask=nan_mask, mask_value=ImageType.DEM.value[-1])
-                    mask_raster(msk_path, mask=nan_mask, mask_value=ImageType.MASK.value[-1])
-                valid += 1
-
-        LOG.info(f"valid tiles: {valid}, removed tiles: {removed} ({valid / float(valid + removed) * 100.0:.2f})")
+                                      scales=available_scales,
+                                      make_context=make_context,
+                                      nan_threshold=nan_threshold,
+                                      sar_process=sar_process,
+                                      dem_process=dem_process,
+                                      msk_process=morph,
+                                      output_format=config.output_format,
+                                      encoding=encoding,
+                                      **scene_args) for sar_path, dem_path, msk_path in pending)
+            results = Parallel(n_jobs=config.workers, return_as="generator")(jobs)
+            for (sar_path, _, _), (scene_result, tiles) in tqdm(zip(pending, results), total=len(pending)):
+                image_id = Path(sar_path).stem
+                for tile_scale, (scene_valid, scene_removed) in scene_result.items():
+                    LOG.debug(f"{image_id} (x{tile_scale}): {scene_valid} valid tiles, {scene_removed} removed")
+                manifest.write(image_id,
+                               sources=sources[image_id],
+                               settings=settings,
+                               counts={str(k): v for k, v in scene_result.items()},
+                               tiles=[record["name"] for record in tiles],
+                               records=[record for record in tiles if not record["name"].startswith("context/")])
+            # packed stores are assembled from the per-scene shards, in the same order as the inputs
+            # up-to-date scenes are carried over from the previous store
+            if config.output_format == TileFormat.packed:
+                image_ids = list(sources.keys())
+                packed_tiles = consolidate_shards(_packed_path(subset_dir), image_ids)
+                if make_context:
+                    consolidate_shards(_packed_path(subset_dir, is_context=True), image_ids)
+                LOG.info(f"Packed {packed_tiles} tiles into {str(_packed_path(subset_dir))}")
+            # the catalog summarizes every tile of the subset, so that datasets do not need to read them again
+            valid, removed = 0, 0
+            records, record_scenes = list(), list()
+            for image_id, entry in manifest.entries().items():
+                for scene_valid, scene_removed in entry["counts"].values():
+                    valid += scene_valid
+                    removed += scene_removed
+                records.extend(entry["records"])
+                record_scenes.extend([image_id] * len(entry["records"]))
+            catalog_tiles = write_catalog(subset_dir / CATALOG_FILE, records, scenes=record_scenes)
+            LOG.info(f"Catalog: {catalog_tiles} tiles")
+            LOG.info("Tiling complete")
+            LOG.info(f"valid tiles: {valid}, removed tiles: {removed} ({valid / max(valid + removed, 1) * 100.0:.2f})")
     LOG.info("Done!")
 
 
-def compute_statistics(config: StatsConfig):
-    # A couple prints just to be cool
-    """Computes the statistics on the current dataset.
+def _tile_statistics(tiles: List[Tuple[str, str, str]],
+                     store_path: Optional[Path] = None,
+                     relative_accuracy: float = 0.01) -> Tuple[Moments, QuantileSketch]:
+    """Accumulates the per-channel moments and quantile sketches of a batch of tiles, executed by each worker.
+    Tiles are either (sar, dem, mask) path triples, or indices of a packed store when a path is given.
+    Pixels marked as invalid in the mask are ignored.
+    """
+    store = PackedTileStore(store_path) if store_path is not None else None
+    moments, sketch = None, None
+    for tile in tiles:
+        if store is not None:
+            sar, dem, mask = store.read(tile, "sar"), store.read(tile, "dem"), store.read(tile, "mask")
+        elif len(tile) == 1:
+            stack, roles = read_stacked(tile[0])
+            sar, dem, mask = (stack[slice(*roles[role])] for role in ("sar", "dem", "mask"))
+        else:
+            sar, dem, mask = (imread(path) for path in tile)
+        assert sar.shape[1:] == dem.shape[1:] == mask.shape[1:], f"Shape mismatch for tile {tile}"
+        if moments is None:
+            moments = Moments(channels=sar.shape[0] + dem.shape[0])
+            sketch = QuantileSketch(channels=sar.shape[0] + dem.shape[0], relative_accuracy=relative_accuracy)
+        valid = mask[0] != FloodDataset.ignore_index()
+        pixels = np.concatenate((sar[:, valid], dem[:, valid]), axis=0)
+        moments.update(pixels)
+        sketch.update(pixels)
+    return moments, sketch
+
+
+def compute_statistics(config: StatsConfig) -> dict:
+    """Computes per-channel statistics (pooled mean and standard deviation, minimum and maximum, median,
+    interquartile range and clip percentiles) on the processed tiles of the given subset, in a single pass:
+    each job accumulates moments and quantile sketches of a batch of tiles, then partial results are merged.
+    Tiles are already processed, they are read as they are.
+    Results are stored in JSON format, so that they can be loaded by the datasets in place of the defaults.
+
+    Returns:
+        dict: computed statistics, with one value for each channel (SAR first, then DEM)
     """
     LOG.info(f"Computing dataset statistics on {config.subset} set...")
     print_config(LOG, config)
+    subset_path = config.data_root / config.subset
+
+    if config.packed:
+        store = PackedTileStore(subset_path / "packed")
+        tiles = list(range(len(store)))
+        store_path = store.path
+    else:
+        # stacked tiles hold every modality, otherwise matching names are checked by the index, all at once
+        stacked = index_tiles(subset_path, groups=[STACKED_DIR])[STACKED_DIR]
+        if len(stacked) > 0:
+            tiles = [(path, ) for path in TileFiles(subset_path / STACKED_DIR, stacked).paths()]
+        else:
+            names = index_tiles(subset_path, groups=["sar", "dem", "mask"])
+            tiles = list(zip(*(TileFiles(subset_path / g, names[g]).paths() for g in ("sar", "dem", "mask"))))
+        store_path = None
+    assert len(tiles) > 0, f"No tiles found in {subset_path}"
+
+    batches = [tiles[i:i + config.batch_size] for i in range(0, len(tiles), config.batch_size)]
+    jobs = (delayed(_tile_statistics)(batch, store_path=store_path, relative_accuracy=config.relative_accuracy)
+            for batch in batches)
+    LOG.info(f"Processing {len(tiles)} tiles ({config.workers} workers)")
+    moments, sketch = None, None
+    with tqdm(total=len(tiles)) as progress:
+        # results come back in order, the reduction is deterministic
+        results = Parallel(n_jobs=config.workers, return_as="generator")(jobs)
+        for batch, (batch_moments, batch_sketch) in zip(batches, results):
+            moments = batch_moments if moments is None else moments.merge(batch_moments)
+            sketch = batch_sketch if sketch is None else sketch.merge(batch_sketch)
+            progress.update(len(batch))
 
-    sar_paths = sorted(list(glob(str(config.data.path / config.subset / "sar" / "*.tif"))))
-    dem_paths = sorted(list(glob(str(config.data.path / config.subset / "dem" / "*.tif"))))
-    msk_paths = sorted(list(glob(str(config.data.path / config.subset / "mask" / "*.tif"))))
-
-    assert len(sar_paths) > 0 and len(sar_paths) == len(dem_paths) == len(msk_paths), "Length mismatch"
-
-    pixel_count = 0
-    ch_max = None
-    ch_min = None
-    ch_avg = None
-    ch_std = None
-    # iterate on the large tiles
-    LOG.info("Computing  min, max and mean...")
-    for sar_path, dem_path, mask_path in tqdm(list(zip(sar_paths, dem_paths, msk_paths))):
-        image_id = Path(sar_path).stem  # .replace("sar", "")
-        assert _extract_emsr(sar_path) == _extract_emsr(dem_path) == _extract_emsr(mask_path), "Image ID not matching"
-
-        # read images
-        sar = _decibel(imread(sar_path, channels_first=False))
-        dem = _clip_dem(imread(dem_path, channels_first=False))
-        mask = imread(mask_path, channels_first=False)
-        mask = mask.reshape(_dims(mask))
-        assert _dims(sar) == _dims(dem) == _dims(mask), f"Shape mismatch for {image_id}"
-
-        # initialize vectors if it's the first iteration
-        channel_count = sar.shape[-1] + dem.shape[-1]
-        if ch_max is None:
-            ch_max = np.ones(channel_count) * np.finfo(np.float32).min
-            ch_min = np.ones(channel_count) * np.finfo(np.float32).max
-            ch_avg = np.zeros(channel_count, dtype=np.float32)
-            ch_std = np.zeros(channel_count, dtype=np.float32)
-
-        valid_pixels = mask.flatten() != 255
-        sar = sar.reshape((-1, sar.shape[-1]))[valid_pixels]
-        dem = dem.reshape((-1, dem.shape[-1]))[valid_pixels]
-
-        pixel_count += sar.shape[0]
-        ch_max = np.maximum(ch_max, np.concatenate((sar.max(axis=0), dem.max(axis=0)), axis=-1))
-        ch_min = np.minimum(ch_min, np.concatenate((sar.min(axis=0), dem.min(axis=0)), axis=-1))
-        ch_avg += np.concatenate((sar.sum(axis=0), dem.sum(axis=0)), axis=-1)
-    ch_avg /= float(pixel_count)
-
-    # second pass to compute standard deviation (could be approximated in a single pass, but it's not accurate)
-    LOG.info("Computing standard deviation...")
-    for sar_path, dem_path in tqdm(list(zip(sar_paths, dem_paths))):
-        # read images
-        sar = _decibel(imread(sar_path, channels_first=False))
-        dem = _clip_dem(imread(dem_path, channels_first=False))
-        mask = imread(mask_path, channels_first=False)
-        mask = mask.reshape(_dims(mask))
-        assert _dims(sar) == _dims(dem) == _dims(mask), f"Shape mismatch for {image_id}"
-        # prepare arrays by flattening everything except channels
-        img_channels = sar.shape[-1]
-        dem_channels = dem.shape[-1]
-        valid_pixels = mask.flatten() != 255
-        sar = sar.reshape((-1, img_channels))[valid_pixels]
-        dem = dem.reshape((-1, dem_channels))[valid_pixels]
-        # compute variance
-        image_std = ((sar - ch_avg[:img_channels])**2).sum(axis=0) / float(sar.shape[0])
-        dem_std = ((dem - ch_avg[img_channels:])**2).sum(axis=0) / float(sar.shape[0])
-        ch_std += np.concatenate((image_std, dem_std), axis=-1)
-    # square it to compute std
-    ch_std = np.sqrt(ch_std / len(sar_paths))
-    # print stats
-    print("channel-wise max: ", ch_max)
-    print("channel-wise min: ", ch_min)
-    print("channel-wise avg: ", ch_avg)
-    print("channel-wise std: ", ch_std)
-    print("normalized avg: ", (ch_avg - ch_min) / (ch_max - ch_min))
-    print("normalized std: ", ch_std / (ch_max - ch_min))
+    low, high = config.clip_percentiles
+    quartile1, median, quartile3, clip_low, clip_high = sketch.quantile([0.25, 0.5, 0.75, low / 100, high / 100]).T
+    result = dict(subset=config.subset,
+                  tiles=len(tiles),
+                  **moments.to_dict(),
+                  median=median.tolist(),
+                  iqr=(quartile3 - quartile1).tolist(),
+                  clip_percentiles=[low, high],
+                  clip_low=clip_low.tolist(),
+                  clip_high=clip_high.tolist())
+    for key in ("mean", "std", "min", "max", "median", "iqr", "clip_low", "clip_high"):
+        LOG.info(f"channel-wise {key}: {np.array(result[key])}")
+    output_path = config.output or (config.data_root / f"stats_{config.subset}.json")
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    LOG.info(f"Statistics stored in {output_path}")
+    return result
+
+
+def _pseudolabel(image: np.ndarray,
+                 label: np.ndarray,
+                 morph_kernel: np.ndarray,
+                 vv_multiplier: float = 5.0,
+                 vh_multiplier: float = 10.0,
+                 denoiser: Denoiser = Denoiser.nlmeans,
+                 denoise_kernel: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+    """Computes the threshold-based flood map of the given SAR image and combines it with the ground truth,
+    so that background has index 0, union has index 1, intersection 2.
+
+    Args:
+        image (np.ndarray): SAR image, with format HxWxC (VV, VH first).
+        label (np.ndarray): ground truth mask, with format HxW.
+        morph_kernel (np.ndarray): kernel for the morphological opening of the flood map.
+        vv_multiplier (float, optional): fixed multiplier for the VV channel. Defaults to 5.0.
+        vh_multiplier (float, optional): fixed multiplier for the VH channel. Defaults to 10.0.
+        denoiser (Denoiser, optional): denoising method applied before thresholding. Defaults to nlmeans.
+        denoise_kernel (int, optional): window size of the filter-based denoisers. Defaults to 5.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: weight indices and flood map, both HxW
+    """
+    # multiply VV and VH for fixed constants, more practical for thresholding
+    image = image[:, :, :2].astype(np.float32)
+    image[:, :, 0] *= vv_multiplier
+    image[:, :, 1] *= vh_multiplier
+    # produce a smoother SAR image for a less noisy threshold
+    # then further clean it up using morphological opening
+    denoised = denoise(image, method=Denoiser(denoiser).value, h=0.1, kernel_size=denoise_kernel)
+    flooded = ((denoised[:, :, 0] <= 0.1) * (denoised[:, :, 1] <= 0.1)).astype(np.uint8)
+    return _weight_indices(flooded, label, morph_kernel)
+
+
+def _weight_indices(flooded: np.ndarray, label: np.ndarray, morph_kernel: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Cleans up the thresholded flood map using morphological opening, then combines it with the ground truth,
+    so that background has index 0, union has index 1, intersection 2.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: weight indices and flood map, both HxW
+    """
+    flooded = cv2.morphologyEx(flooded, cv2.MORPH_OPEN, morph_kernel)
+    return flooded + label.astype(np.uint8), flooded
+
+
+def _pseudolabel_files(batch: List[Tuple[str, str, str]], **kwargs) -> int:
+    """Pseudolabels a batch of (image, label, result) file paths, executed by each worker.
+    """
+    for image_path, label_path, result_path in batch:
+        image = imread(image_path, channels_first=False)
+        label, profile = imread(label_path, return_metadata=True)
+        result, _ = _pseudolabel(image, label.squeeze(0), **kwargs)
+        with rasterio.open(str(result_path), "w", **profile) as dst:
+            dst.write(result[np.newaxis, ...])
+    return len(batch)
+
+
+def _pseudolabel_stacked(paths: List[str], **kwargs) -> int:
+    """Pseudolabels a batch of stacked tiles, results are added in place as the weight band of each tile.
+    """
+    for path in paths:
+        with rasterio.open(path, mode="r", driver="GTiff") as src:
+            stack, roles = src.read(), stacked_roles(src.tags())
+            transform, crs = src.transform, src.crs
+        bands = {role: stack[slice(*bands)] for role, bands in roles.items()}
+        result, _ = _pseudolabel(bands["sar"].transpose(1, 2, 0), bands["mask"].squeeze(0), **kwargs)
+        bands["weight"] = result[np.newaxis, ...]
+        write_stacked(path, bands, transform=transform, crs=crs)
+    return len(paths)
+
+
+def _pseudolabel_packed(store_path: Path, indices: List[int], **kwargs) -> int:
+    """Pseudolabels a batch of tiles from a packed store, results are written in place in the weight group.
+    """
+    store = PackedTileStore(store_path)
+    for index in indices:
+        image = store.read(index, "sar").transpose(1, 2, 0)
+        label = store.read(index, "mask").squeeze(0)
+        result, _ = _pseudolabel(image, label, **kwargs)
+        store.write(index, "weight", result[np.newaxis, ...])
+    return len(indices)
+
+
+def _pseudolabel_scene(sar_path: Path,
+                       msk_path: Path,
+                       tiles: List[Tuple[str, Optional[int]]],
+                       tile_size: int,
+                       dst_path: Path,
+                       packed: bool = False,
+                       sar_process: Optional[Callable] = None,
+                       msk_process: Optional[Callable] = None,
+                       **kwargs) -> int:
+    """Scene-level pseudolabelling: the source scene is processed as in the tiling step, then denoised and
+    thresholded once for each scale, instead of once for each (overlapping) tile. Weight tiles are cut from
+    the resulting map, using the same windows of the existing SAR tiles, derived from their names.
+
+    Args:
+        sar_path (Path): path to the source SAR image.
+        msk_path (Path): path to the source ground truth mask.
+        tiles (List[Tuple[str, Optional[int]]]): tile names of the scene, with their index in the packed store.
+        tile_size (int): size of the tiles, as configured during preprocessing.
+        dst_path (Path): weight folder, or packed store path.
+        packed (bool, optional): whether the results are stored in a packed store. Defaults to False.
+        sar_process (Optional[Callable], optional): preprocessing function for SAR images. Defaults to None.
+        msk_process (Optional[Callable], optional): preprocessing function for masks. Defaults to None.
+
+    Returns:
+        int: number of weight tiles produced
+    """
+    tiles_by_scale = defaultdict(list)
+    for name, index in tiles:
+        row, col, scale = _tile_coords(name)
+        tiles_by_scale[scale].append((name, index, row, col))
+    scales = sorted(tiles_by_scale)
+    sar_levels, _, sar_profile = _read_pyramid(sar_path, scales=scales, resampling=Resampling.bilinear)
+    msk_levels, _, msk_profile = _read_pyramid(msk_path, scales=scales, resampling=Resampling.nearest)
+    metadata = _tile_metadata(msk_profile, count=1)
+    store = PackedTileStore(dst_path) if packed else None
+    for tile_scale, scale_tiles in tiles_by_scale.items():
+        sar_image, transform = sar_levels[tile_scale]
+        sar = (sar_process or identity)(sar_image).astype(sar_profile["dtype"])
+        label = (msk_process or identity)(msk_levels[tile_scale][0]).astype(msk_profile["dtype"])
+        # same treatment of invalid pixels as the stored tiles, with the ignore value of each type
+        nan_mask = np.isnan(sar.sum(axis=0))
+        sar[:, nan_mask] = ImageType.SAR.value[1]
+        label[:, nan_mask] = ImageType.MASK.value[1]
+        result, _ = _pseudolabel(sar.transpose(1, 2, 0), label.squeeze(0), **kwargs)
+        result = result[np.newaxis, ...]
+        for name, index, row, col in scale_tiles:
+            window = Window.from_slices(rows=(row, row + tile_size), cols=(col, col + tile_size))
+            if packed:
+                store.write(index, "weight", array_window(result, window))
+            else:
+                write_array_window(result, window, path=Path(dst_path) / name, profile=metadata, transform=transform)
+    return len(tiles)
+
+
+def _otsu_group(tiles: list,
+                morph_kernel: np.ndarray,
+                bins: int = 256,
+                value_range: Tuple[float, float] = (0.0, 1.0),
+                store_path: Optional[Path] = None) -> Tuple[List[float], int]:
+    """Otsu pseudolabelling of a group of tiles (a scene, or an EMSR activation): a first pass builds the VV and VH
+    histograms of the group on valid pixels, a second pass thresholds every tile with the resulting values.
+    Tiles are either (image, label, result) file paths, or indices in the given packed store.
+
+    Returns:
+        Tuple[List[float], int]: VV and VH thresholds, number of tiles processed
+    """
+    store = PackedTileStore(store_path) if store_path is not None else None
+
+    def read(tile) -> Tuple[np.ndarray, np.ndarray, Optional[dict]]:
+        if store is not None:
+            return store.read(tile, "sar"), store.read(tile, "mask"), None
+        label, profile = imread(tile[1], return_metadata=True)
+        return imread(tile[0]), label, profile
+
+    histogram = Histogram(channels=2, bins=bins, value_range=value_range)
+    for tile in tiles:
+        sar, label, _ = read(tile)
+        histogram.update(sar[:2, label[0] != ImageType.MASK.value[1]])
+    thresholds = np.array([otsu_threshold(counts, histogram.centers) for counts in histogram.counts])
+    for tile in tiles:
+        sar, label, profile = read(tile)
+        flooded = np.all(sar[:2] < thresholds[:, np.newaxis, np.newaxis], axis=0).astype(np.uint8)
+        result, _ = _weight_indices(flooded, label[0], morph_kernel)
+        if store is not None:
+            store.write(tile, "weight", result[np.newaxis, ...])
+            continue
+        with rasterio.open(str(tile[2]), "w", **profile) as dst:
+            dst.write(result[np.newaxis, ...])
+    return thresholds.tolist(), len(tiles)
+
+
+def _benchmark_denoisers(tiles: List[Tuple[np.ndarray, np.ndarray]], **kwargs) -> Dict[str, dict]:
+    """Measures the throughput of every denoising method on the given tiles, together with the agreement of
+    the resulting flood maps with respect to the reference one (NL means).
+    """
+    flood_maps, report = dict(), dict()
+    for denoiser in Denoiser:
+        start = time.perf_counter()
+        flood_maps[denoiser] = [_pseudolabel(image, label, denoiser=denoiser, **kwargs)[1] for image, label in tiles]
+        elapsed = time.perf_counter() - start
+        report[denoiser.value] = dict(tiles_per_sec=len(tiles) / elapsed, sec_per_tile=elapsed / len(tiles))
+    reference = np.stack(flood_maps[Denoiser.nlmeans]).astype(bool)
+    for denoiser, maps in flood_maps.items():
+        maps = np.stack(maps).astype(bool)
+        union = np.count_nonzero(maps | reference)
+        report[denoiser.value].update(agreement=float((maps == reference).mean()),
+                                      iou=float(np.count_nonzero(maps & reference) / union) if union else 1.0)
+    return report
 
 
 def generate_pseudolabels(config: PreparationConfig):
@@ -473,41 +1249,128 @@ def generate_pseudolabels(config: PreparationConfig):
     assert data_path.exists() and data_path.is_dir(), "The given path is not a valid directory"
 
     # this is just needed for the training set
+    packed = config.output_format == TileFormat.packed
     dataset = FloodDataset(path=data_path,
                            subset="train",
                            include_dem=False,
-                           transform_base=None)
-    # prepare directory to store resulting images
-    result_path = data_path / "train" / "weight"
-    check_or_make_dir(result_path)
+                           transform_base=None,
+                           packed=packed)
+    # stacked tiles are picked up by the dataset automatically, weights are added to them as an extra band
+    stacked = isinstance(dataset.image_files, StackedSequence)
     morph_kernel = MorphologyTransform().create_round_kernel(kernel_size=config.morph_kernel)
+    params = dict(morph_kernel=morph_kernel,
+                  vv_multiplier=config.vv_multiplier,
+                  vh_multiplier=config.vh_multiplier,
+                  denoise_kernel=config.denoise_kernel)
+    # benchmark mode: time every method on a sample of tiles, without storing anything
+    if config.benchmark > 0:
+        indices = np.linspace(0, len(dataset) - 1, num=min(config.benchmark, len(dataset))).astype(int)
+        if packed or stacked:
+            tiles = [(dataset.image_files[i].transpose(1, 2, 0), dataset.label_files[i].squeeze(0)) for i in indices]
+        else:
+            tiles = [(imread(dataset.image_files[i], channels_first=False), imread(dataset.label_files[i]).squeeze(0))
+                     for i in indices]
+        LOG.info(f"Benchmarking denoisers on {len(tiles)} tiles...")
+        report = _benchmark_denoisers(tiles, **params)
+        for name, stats in report.items():
+            LOG.info(f"{name:<8s}: {stats['tiles_per_sec']:8.2f} tiles/s - {stats['sec_per_tile']:.4f} s/tile - "
+                     f"agreement: {stats['agreement']:.4f} - IoU: {stats['iou']:.4f}")
+        with open(data_path / "pseudolabel_benchmark.json", "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        return report
 
-    # we could iterate the dataset normally, but we also need the filename to store results
-    # if we iterate in series, it takes forever to process with NL means and morphology
-    def process_image(index: int):
-        image = imread(dataset.image_files[index], channels_first=False)
-        label, profile = imread(dataset.label_files[index], return_metadata=True)
-        label = label.squeeze(0).astype(np.uint8)
-        # multiply VV and VH for fixed constants, more practical for thresholding
-        image[:, :, 0] *= config.vv_multiplier
-        image[:, :, 1] *= config.vh_multiplier
-        # produce a smoother SAR image for a less noisy threshold
-        # then further clean it up using morphological opening
-        denoised = denoise_nl_means(image, h=0.1, multichannel=True)
-        flooded = ((denoised[:, :, 0] <= 0.1) * (denoised[:, :, 1] <= 0.1)).astype(np.uint8)
-        flooded = cv2.morphologyEx(flooded, cv2.MORPH_OPEN, morph_kernel)
-        # combine them so that background has index 0, union has index 1, intersection 2
-        result = flooded + label
-        # store results to file
-        image_name = Path(dataset.image_files[index]).name
-        with rasterio.open(str(result_path / image_name), "w", **profile) as dst:
-            dst.write(result[np.newaxis, ...])
-
-    # Run a bunch of parallel jobs, using the same function
-    Parallel(n_jobs=12)(delayed(process_image)(i) for i in tqdm(range(len(dataset))))
+    # prepare directory to store resulting images, or the new group in the packed store
+    # jobs only receive paths (or indices) in batches, every worker reads its own tiles
+    params.update(denoiser=config.denoiser)
+    result_path = data_path / "train" / "weight"
+    assert not stacked or (config.method == PseudolabelMethod.fixed and not config.scene_pseudolabels), \
+        "Stacked tiles only support tile-level pseudolabels with fixed thresholds"
+    if config.method == PseudolabelMethod.otsu:
+        # one job per group (scene or EMSR activation), thresholds are computed from the group histograms
+        if packed:
+            dataset.store.add_group("weight", dtype=np.uint8, count=1)
+            tiles = list(zip(dataset.image_files.names(), dataset.image_files.indices.tolist()))
+        else:
+            check_or_make_dir(result_path)
+            tiles = [(Path(image_path).name, (image_path, label_path, str(result_path / Path(image_path).name)))
+                     for image_path, label_path in zip(dataset.image_files, dataset.label_files)]
+        groups = defaultdict(list)
+        for name, tile in tiles:
+            scene = _tile_scene(name)
+            groups[_extract_emsr(scene) if config.otsu_level == OtsuLevel.emsr else scene].append(tile)
+        jobs = (delayed(_otsu_group)(group,
+                                     morph_kernel=morph_kernel,
+                                     bins=config.hist_bins,
+                                     value_range=(config.hist_min, config.hist_max),
+                                     store_path=dataset.store.path if packed else None)
+                for group in groups.values())
+        LOG.info(f"Otsu thresholds on {len(groups)} groups ({config.otsu_level.value}, {config.workers} workers)")
+        thresholds = dict()
+        with tqdm(total=len(dataset)) as progress:
+            results = Parallel(n_jobs=config.workers, return_as="generator")(jobs)
+            for group_id, (group_thresholds, processed) in zip(groups.keys(), results):
+                LOG.debug(f"{group_id}: VV < {group_thresholds[0]:.4f}, VH < {group_thresholds[1]:.4f}")
+                thresholds[group_id] = group_thresholds
+                progress.update(processed)
+        with open(data_path / "train" / "otsu_thresholds.json", "w", encoding="utf-8") as f:
+            json.dump(thresholds, f, indent=2)
+        LOG.info("Done!")
+        return thresholds
+    if config.scene_pseudolabels:
+        # one job per source scene, each one processing every tile (and scale) of the scene at once
+        # the scenes are processed again from the source, with the same options used for the tiling
+        if packed:
+            dataset.store.add_group("weight", dtype=np.uint8, count=1)
+            tiles = list(zip(dataset.image_files.names(), dataset.image_files.indices.tolist()))
+            dst_path = dataset.store.path
+        else:
+            tiles = [(Path(image_path).name, None) for image_path in dataset.image_files]
+            dst_path = check_or_make_dir(result_path)
+        scene_tiles = defaultdict(list)
+        for name, index in tiles:
+            scene_tiles[_tile_scene(name)].append((name, index))
+        emsr_codes = {k for k, v in _load_subsets(config.summary_file).items() if v == "train"}
+        sar_files, _, msk_files = _gather_files(sar_glob=config.data_source / "*" / "s1_raw" / "*.tif",
+                                                dem_glob=config.data_source / "*" / "DEM" / "*.tif",
+                                                mask_glob=config.data_source / "*" / "mask" / "*.tif",
+                                                subset=emsr_codes)
+        sources = {Path(sar_path).stem: (sar_path, msk_path) for sar_path, msk_path in zip(sar_files, msk_files)}
+        missing = set(scene_tiles) - set(sources)
+        assert not missing, f"Source scenes not found for: {sorted(missing)}"
+        sar_process, _, morph = _processing_functions(config)
+        jobs = (delayed(_pseudolabel_scene)(*sources[image_id],
+                                            tiles=scene,
+                                            tile_size=config.tile_size,
+                                            dst_path=dst_path,
+                                            packed=packed,
+                                            sar_process=sar_process,
+                                            msk_process=morph,
+                                            **params) for image_id, scene in scene_tiles.items())
+    elif stacked:
+        paths = dataset.image_files.paths()
+        batches = [paths[i:i + config.batch_size] for i in range(0, len(paths), config.batch_size)]
+        jobs = (delayed(_pseudolabel_stacked)(batch, **params) for batch in batches)
+    elif packed:
+        dataset.store.add_group("weight", dtype=np.uint8, count=1)
+        indices = dataset.image_files.indices.tolist()
+        batches = [indices[i:i + config.batch_size] for i in range(0, len(indices), config.batch_size)]
+        jobs = (delayed(_pseudolabel_packed)(dataset.store.path, batch, **params) for batch in batches)
+    else:
+        check_or_make_dir(result_path)
+        items = [(image_path, label_path, str(result_path / Path(image_path).name))
+                 for image_path, label_path in zip(dataset.image_files, dataset.label_files)]
+        batches = [items[i:i + config.batch_size] for i in range(0, len(items), config.batch_size)]
+        jobs = (delayed(_pseudolabel_files)(batch, **params) for batch in batches)
+    LOG.info(f"Processing {len(dataset)} tiles with {config.denoiser.value} ({config.workers} workers)")
+    if config.scene_pseudolabels:
+        LOG.info(f"Scene-level mode: {len(scene_tiles)} source scenes")
+    with tqdm(total=len(dataset)) as progress:
+        for processed in Parallel(n_jobs=config.workers, return_as="generator")(jobs):
+            progress.update(processed)
     # just some final checks, just in case
     LOG.info("Validating results...")
-    result_images = glob(str(result_path / "*.tif"))
-    assert len(result_images) == len(dataset), \
-        f"Length mismatch between dataset ({len(dataset)}) and result ({len(result_images)})"
+    if not packed and not stacked:
+        result_images = glob(str(result_path / "*.tif"))
+        assert len(result_images) == len(dataset), \
+            f"Length mismatch between dataset ({len(dataset)}) and result ({len(result_images)})"
     LOG.info("Done!")
@@ -45,18 +45,22 @@ def test(test_config: TestConfig):
     # RGB is needed with either 4 - 1, or 3 - 0
     use_rgb = (config.data.in_channels - int(config.data.include_dem)) == 3
     dataset_cls = RGBFloodDataset if use_rgb else FloodDataset
-    mean = dataset_cls.mean()[:config.data.in_channels]
-    std = dataset_cls.std()[:config.data.in_channels]
+    full_mean, full_std = dataset_cls.statistics(config.data.stats_file, robust=config.data.robust_stats)
+    clip_min, clip_max = dataset_cls.clip_limits(config.data.stats_file, robust=config.data.robust_stats)
+    mean, std = full_mean[:config.data.in_channels], full_std[:config.data.in_channels]
     test_transform = eval_transforms(mean=mean,
                                      std=std,
-                                     clip_max=30,
-                                     clip_min=-30)
+                                     clip_max=clip_max[:config.data.in_channels],
+                                     clip_min=clip_min[:config.data.in_channels])
 
     LOG.debug("Eval. transforms: %s", str(test_transform))
     # create the test dataset
     test_dataset = dataset_cls(path=Path(config.data.path),
                                subset="test",
                                include_dem=config.data.include_dem,
+                               packed=config.data.packed,
+                               catalog=config.data.catalog,
+                               virtual=config.data.virtual,
                                normalization=test_transform)
     test_loader = DataLoader(dataset=test_dataset,
                              batch_size=1,  # fixed at 1 because in test we have full-size images
@@ -108,7 +112,7 @@ def test(test_config: TestConfig):
                            debug=test_config.debug)
     image_trf = as_image if use_rgb else rgb_ratio
     slice_at = config.data.in_channels - int(config.data.include_dem)
-    trainer.add_callback(DisplaySamples(inverse_transform=inverse_transform(test_dataset.mean(), test_dataset.std()),
+    trainer.add_callback(DisplaySamples(inverse_transform=inverse_transform(full_mean, full_std),
                                         mask_palette=test_dataset.palette(),
                                         image_transform=image_trf,
                                         slice_at=slice_at,
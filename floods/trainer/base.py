@@ -4,7 +4,7 @@ import time
 from collections import defaultdict
 from enum import Enum
 from posix import listdir
-from typing import TYPE_CHECKING, Any, Dict, Iterable
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable
 
 import numpy as np
 import torch
@@ -44,7 +44,9 @@ class Trainer:
                  logger: BaseLogger = None,
                  sample_batches: int = None,
                  stage: str = "train",
-                 debug: bool = False) -> None:
+                 debug: bool = False,
+                 input_transform: Callable = None,
+                 batch_transform: Callable = None) -> None:
         self.accelerator = accelerator
         self.stage = stage
         self.debug = debug
@@ -55,6 +57,10 @@ class Trainer:
         self.optimizer = optimizer
         self.scheduler = scheduler
         self.logger = logger or EmptyLogger()
+        # optional first stage on the inputs of every batch, on device (e.g. normalization)
+        # training batches can be augmented as a whole before that, together with their targets
+        self.input_transform = input_transform
+        self.batch_transform = batch_transform
         # setup metrics, if any
         self.metrics = dict()
 
@@ -88,6 +94,19 @@ class Trainer:
                 self.sample_batches = np.array([])
         return train_dataloader, val_dataloader
 
+    def _prepare_batch(self, batch: Any, augment: bool = False) -> Any:
+        # inputs come first, targets and any other item are only transformed by the augmentations
+        batch_transform = self.batch_transform if augment else None
+        if self.input_transform is None and batch_transform is None:
+            return batch
+        batch = tuple(item.to(self.accelerator.device, non_blocking=True) for item in batch)
+        with torch.no_grad():
+            if batch_transform is not None:
+                batch = batch_transform(*batch)
+            if self.input_transform is not None:
+                batch = (self.input_transform(batch[0]), *batch[1:])
+        return batch
+
     def _update_metrics(self,
                         y_true: torch.Tensor,
                         y_pred: torch.Tensor,
@@ -180,7 +199,7 @@ class Trainer:
         for batch in train_tqdm:
             start = time.time()
             self.optimizer.zero_grad()
-            loss, data = self.train_batch(batch=batch)
+            loss, data = self.train_batch(batch=self._prepare_batch(batch, augment=True))
             # backward pass
             self.accelerator.backward(loss)
             self.optimizer.step()
@@ -225,7 +244,7 @@ class Trainer:
             self.model.eval()
             for i, batch in enumerate(val_tqdm):
                 start = time.time()
-                loss, data = self.validation_batch(batch=batch, batch_index=i)
+                loss, data = self.validation_batch(batch=self._prepare_batch(batch), batch_index=i)
                 elapsed = (time.time() - start)
                 # gather info
                 loss_val = loss.mean().item()
@@ -314,7 +333,7 @@ class Trainer:
             self.model.eval()
             for i, batch in enumerate(test_tqdm):
                 start = time.time()
-                loss, data = self.test_batch(batch=batch, batch_index=i, **kwargs)
+                loss, data = self.test_batch(batch=self._prepare_batch(batch), batch_index=i, **kwargs)
                 elapsed = (time.time() - start)
                 loss_value = loss.item()
                 test_tqdm.set_postfix({"loss": f"{loss_value:.4f}"})
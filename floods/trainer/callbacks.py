@@ -10,6 +10,7 @@ from floods.utils.common import get_logger, prepare_folder
 
 if TYPE_CHECKING:
     from floods.trainer.base import Trainer
+    from floods.utils.cache import SharedTileCache
 
 LOG = get_logger(__name__)
 
@@ -193,3 +194,18 @@ class DisplaySamples(BaseCallback):
 
     def dispose(self, trainer: "Trainer"):
         trainer.sample_content.clear()
+
+
+class CacheStatistics(BaseCallback):
+    def __init__(self, caches: Dict[str, "SharedTileCache"], call_every: int = 1) -> None:
+        super().__init__(call_every=call_every)
+        self.caches = caches
+
+    def call(self, trainer: "Trainer", *args: Any, **kwargs: Any) -> Any:
+        # counters are shared by every worker, hit rates are cumulative since the start of the training
+        for stage, cache in self.caches.items():
+            stats = cache.stats()
+            LOG.info("[Epoch %2d] Tile cache (%s): hit rate %.2f (%d hits, %d misses), %d entries, %.1f MB",
+                     trainer.current_epoch, stage, stats["hit_rate"], stats["hits"], stats["misses"],
+                     stats["entries"], stats["bytes"] / 1024**2)
+            trainer.logger.log_scalar(f"cache/{stage}_hit_rate", stats["hit_rate"], step=trainer.current_epoch)
@@ -25,7 +25,9 @@ class FloodTrainer(Trainer):
                  logger: BaseLogger = None,
                  sample_batches: int = None,
                  stage: str = "train",
-                 debug: bool = False) -> None:
+                 debug: bool = False,
+                 input_transform: Callable = None,
+                 batch_transform: Callable = None) -> None:
         super().__init__(accelerator,
                          model,
                          optimizer,
@@ -37,7 +39,9 @@ class FloodTrainer(Trainer):
                          logger=logger,
                          sample_batches=sample_batches,
                          stage=stage,
-                         debug=debug)
+                         debug=debug,
+                         input_transform=input_transform,
+                         batch_transform=batch_transform)
         self.tiler = tiler
 
     def train_batch(self, batch: Any) -> torch.Tensor:
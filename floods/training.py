@@ -7,8 +7,9 @@ from accelerate import Accelerator
 from floods.config import TrainConfig
 from floods.logging.tensorboard import TensorBoardLogger
 from floods.models.base import Segmenter
-from floods.prepare import inverse_transform, prepare_datasets, prepare_metrics, prepare_model, prepare_sampler
-from floods.trainer.callbacks import Checkpoint, DisplaySamples, EarlyStopping, EarlyStoppingCriterion
+from floods.prepare import (inverse_transform, prepare_batch_augmentation, prepare_datasets,
+                            prepare_device_normalization, prepare_metrics, prepare_model, prepare_sampler)
+from floods.trainer.callbacks import CacheStatistics, Checkpoint, DisplaySamples, EarlyStopping, EarlyStoppingCriterion
 from floods.trainer.flood import FloodTrainer, MultiBranchTrainer
 from floods.utils.common import flatten_config, get_logger, git_revision_hash, init_experiment, store_config
 from floods.utils.gis import as_image, rgb_ratio
@@ -56,23 +57,32 @@ def train(config: TrainConfig):
     training_shuffle = True
     training_sampler = None
     
+    # scene crops are already drawn at random, by each worker
+    if config.data.scene_crops:
+        assert not config.data.weighted_sampling, "Weighted sampling is not available with scene crops"
+        training_shuffle = False
     if config.data.weighted_sampling:
         training_shuffle = False
         training_sampler = prepare_sampler(dataset=train_set,
                                            smoothing=config.data.sample_smoothing,
-                                           cache_hash=config.data.cache_hash)
+                                           cache_hash=config.data.cache_hash,
+                                           workers=config.trainer.num_workers)
+    # with normalization on device, batches of raw half precision images are collated in pinned memory
+    pin_memory = config.data.device_normalize and not config.trainer.cpu
     train_loader = DataLoader(dataset=train_set,
                               sampler=training_sampler,
                               batch_size=config.trainer.batch_size,
                               shuffle=training_shuffle,
                               num_workers=config.trainer.num_workers,
                               worker_init_fn=seed_worker,
+                              pin_memory=pin_memory,
                               drop_last=True)
     valid_loader = DataLoader(dataset=valid_set,
                               batch_size=config.trainer.batch_size,
                               shuffle=False,
                               num_workers=config.trainer.num_workers,
-                              worker_init_fn=seed_worker)
+                              worker_init_fn=seed_worker,
+                              pin_memory=pin_memory)
     # prepare models
     LOG.info("Preparing model...")
     model: Segmenter = prepare_model(config=config, num_classes=num_classes).to(accelerator.device)
@@ -101,6 +111,16 @@ def train(config: TrainConfig):
     LOG.info("Visualize: %s, num. batches for visualization: %s", str(config.visualize), str(config.num_samples))
     num_samples = int(config.visualize) * config.num_samples
 
+    # normalization and clipping of whole batches, as first stage on the device
+    input_transform = prepare_device_normalization(config, use_rgb=use_rgb)
+    if input_transform is not None:
+        input_transform = input_transform.to(accelerator.device)
+        LOG.info("Normalizing batches on device")
+    # augmentations of whole training batches, before the normalization
+    batch_transform = prepare_batch_augmentation(config)
+    if batch_transform is not None:
+        LOG.info("Batch augmentation: %s", str(batch_transform))
+
     # choose the trainer class depending on model and training strategy
     trainer_cls = MultiBranchTrainer if config.model.multibranch else FloodTrainer
     trainer = trainer_cls(accelerator=accelerator,
@@ -113,7 +133,9 @@ def train(config: TrainConfig):
                           val_metrics=valid_metrics,
                           logger=logger,
                           sample_batches=num_samples,
-                          debug=config.debug)
+                          debug=config.debug,
+                          input_transform=input_transform,
+                          batch_transform=batch_transform)
 
     image_trf = as_image if use_rgb else rgb_ratio
     trainer.add_callback(EarlyStopping(call_every=1,
@@ -129,6 +151,10 @@ def train(config: TrainConfig):
                                         slice_at=config.data.in_channels - int(config.data.include_dem),
                                         mask_palette=train_set.palette()))
 
+    caches = {dataset.stage(): dataset.cache for dataset in (train_set, valid_set) if getattr(dataset, "cache", None)}
+    if caches:
+        trainer.add_callback(CacheStatistics(caches=caches))
+
     # storing config and starting training
     config.version = git_revision_hash()
     store_config(config, path=config_path)
@@ -1,9 +1,15 @@
-from typing import Sequence, Union
+import random
+from typing import Optional, Sequence, Tuple, Union
 
+import cv2
 import numpy as np
 import torch
-from albumentations import Normalize
-from torch import Tensor
+from albumentations import DualTransform, ImageOnlyTransform, Normalize, Resize
+from rasterio.windows import Window
+from torch import Tensor, nn
+from torch.nn import functional as F
+
+from floods.utils.fields import DisplacementBank
 
 
 class Denormalize:
@@ -53,3 +59,337 @@ class ClipNormalize(Normalize):
     def get_transform_init_args_names(self):
         parent = list(super().get_transform_init_args_names())
         return tuple(parent + ["clip_min", "clip_max"])
+
+
+class ToHalf(ImageOnlyTransform):
+    """Casts the image to half precision, without normalizing it: paired with `DeviceNormalize`, workers only
+    transfer raw float16 images, normalization happens on the device, in a single pass over the batch.
+    """
+    def __init__(self, always_apply: bool = True, p: float = 1.0):
+        super().__init__(always_apply=always_apply, p=p)
+
+    def apply(self, image: np.ndarray, **params) -> np.ndarray:
+        return image.astype(np.float16)
+
+    def get_transform_init_args_names(self):
+        return ()
+
+
+class BankElasticTransform(DualTransform):
+    """Same as `ElasticTransform` (random affine plus smooth displacements), but the displacements are drawn from
+    a bank of precomputed fields (randomly flipped, rolled and scaled), instead of smoothing a new random field
+    for every sample. The affine is folded in the same coordinate map, so that each target needs a single remap.
+    """
+    def __init__(self,
+                 bank: DisplacementBank,
+                 alpha: float = 1,
+                 alpha_affine: float = 50,
+                 scale_limit: float = 0.25,
+                 interpolation: int = cv2.INTER_LINEAR,
+                 border_mode: int = cv2.BORDER_REFLECT_101,
+                 always_apply: bool = False,
+                 p: float = 0.5):
+        super().__init__(always_apply=always_apply, p=p)
+        self.bank = bank
+        self.alpha = alpha
+        self.alpha_affine = alpha_affine
+        self.scale_limit = scale_limit
+        self.interpolation = interpolation
+        self.border_mode = border_mode
+
+    @property
+    def targets_as_params(self):
+        return ["image"]
+
+    def get_params_dependent_on_targets(self, params: dict) -> dict:
+        height, width = params["image"].shape[:2]
+        rng = np.random.default_rng(random.getrandbits(32))
+        # same random affine of the elastic transform, as inverse mapping from output to input coordinates
+        center = np.array((height, width), dtype=np.float32) // 2
+        side = min(height, width) // 3
+        source = np.array([center + side, [center[0] + side, center[1] - side], center - side], dtype=np.float32)
+        target = source + rng.uniform(-self.alpha_affine, self.alpha_affine, size=source.shape).astype(np.float32)
+        inverse = cv2.invertAffineTransform(cv2.getAffineTransform(source, target))
+        # displacements from the bank, with a random amplitude around alpha
+        dx, dy = self.bank.sample(height, width, rng=rng)
+        alpha = self.alpha * rng.uniform(1 - self.scale_limit, 1 + self.scale_limit)
+        x, y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+        x, y = x + dx * alpha, y + dy * alpha
+        map_x = inverse[0, 0] * x + inverse[0, 1] * y + inverse[0, 2]
+        map_y = inverse[1, 0] * x + inverse[1, 1] * y + inverse[1, 2]
+        return dict(map_x=map_x.astype(np.float32), map_y=map_y.astype(np.float32))
+
+    def _remap(self, image: np.ndarray, map_x: np.ndarray, map_y: np.ndarray, interpolation: int) -> np.ndarray:
+        # OpenCV handles at most 4 channels at once
+        if image.ndim == 3 and image.shape[2] > 4:
+            chunks = [self._remap(image[..., i:i + 4], map_x, map_y, interpolation) for i in range(0, image.shape[2], 4)]
+            return np.dstack(chunks)
+        result = cv2.remap(image, map_x, map_y, interpolation=interpolation, borderMode=self.border_mode)
+        return result.reshape(result.shape[:2] + image.shape[2:])
+
+    def apply(self, image: np.ndarray, map_x: np.ndarray = None, map_y: np.ndarray = None, **params) -> np.ndarray:
+        return self._remap(image, map_x, map_y, self.interpolation)
+
+    def apply_to_mask(self, mask: np.ndarray, map_x: np.ndarray = None, map_y: np.ndarray = None,
+                      **params) -> np.ndarray:
+        return self._remap(mask, map_x, map_y, cv2.INTER_NEAREST)
+
+    def get_transform_init_args_names(self):
+        return ("alpha", "alpha_affine", "scale_limit", "interpolation", "border_mode")
+
+
+class DeviceNormalize(nn.Module):
+    """Same normalization and clipping of `ClipNormalize`, applied to whole batches (B, C, H, W) of raw images
+    on their device, widened to float32 on the way. Statistics are stored as buffers, moved with the module.
+    """
+    def __init__(self,
+                 mean: Sequence[float],
+                 std: Sequence[float],
+                 clip_min: Union[float, Sequence[float]],
+                 clip_max: Union[float, Sequence[float]]) -> None:
+        super().__init__()
+        channels = len(mean)
+
+        def as_buffer(values: Union[float, Sequence[float]]) -> Tensor:
+            values = torch.tensor(values, dtype=torch.float32).expand(channels)
+            return values.reshape(1, channels, 1, 1).clone()
+
+        self.register_buffer("mean", as_buffer(mean))
+        self.register_buffer("scale", 1.0 / as_buffer(std))
+        self.register_buffer("clip_min", as_buffer(clip_min))
+        self.register_buffer("clip_max", as_buffer(clip_max))
+
+    def forward(self, batch: Tensor) -> Tensor:
+        return torch.clamp((batch.float() - self.mean) * self.scale, min=self.clip_min, max=self.clip_max)
+
+
+def _gaussian_kernels(sigma: Tensor, radius: int) -> Tensor:
+    # one normalized 1D gaussian kernel per row, of length 2 * radius + 1
+    offsets = torch.arange(-radius, radius + 1, device=sigma.device, dtype=torch.float32)
+    kernels = torch.exp(-offsets.view(1, -1)**2 / (2 * sigma.view(-1, 1)**2))
+    return kernels / kernels.sum(dim=1, keepdim=True)
+
+
+def _separable_blur(images: Tensor, kernels: Tensor) -> Tensor:
+    # blurs each image (B, C, H, W) with its own kernel (B, K), along both axes, with reflected borders
+    batch, channels, height, width = images.shape
+    radius = kernels.size(1) // 2
+    weight = kernels.repeat_interleave(channels, dim=0).unsqueeze(1)
+    result = images.reshape(1, batch * channels, height, width)
+    result = F.conv2d(F.pad(result, (radius, radius, 0, 0), mode="reflect"),
+                      weight.unsqueeze(2),
+                      groups=batch * channels)
+    result = F.conv2d(F.pad(result, (0, 0, radius, radius), mode="reflect"),
+                      weight.unsqueeze(3),
+                      groups=batch * channels)
+    return result.reshape(batch, channels, height, width)
+
+
+class BatchAugmentation(nn.Module):
+    """Vectorized counterpart of the per-sample training transforms (see `prepare.train_transforms_base` and
+    `prepare.train_transforms_sar`), applied to whole collated batches on their device, before normalization.
+    Blur or multiplicative noise is applied to the SAR channels, then random sized crops, flips, rotations by 90
+    degrees, elastic (random affine plus smooth displacements) and grid distortions are combined in a single
+    sampling grid: images are resampled bilinearly, masks and any other target (e.g. weights) with nearest
+    neighbours, so that they stay aligned. Every transform is drawn independently for each sample, with the same
+    probabilities of the per-sample version. Images are expected to be square, as the training tiles.
+    """
+    def __init__(self,
+                 sar_channels: int = 2,
+                 crop_scale: Tuple[float, float] = (0.5, 1.0),
+                 crop_p: float = 0.8,
+                 flip_p: float = 0.5,
+                 rotate_p: float = 0.5,
+                 sar_p: float = 0.6,
+                 blur_limit: Tuple[int, int] = (3, 13),
+                 multiplier: Tuple[float, float] = (0.7, 1.3),
+                 elastic_p: float = 0.5,
+                 elastic_alpha: float = 1.0,
+                 elastic_sigma: float = 50.0,
+                 elastic_alpha_affine: float = 50.0,
+                 grid_p: float = 0.5,
+                 grid_steps: int = 5,
+                 grid_limit: float = 0.3) -> None:
+        """Stores the parameters of each transform, crops are disabled with crop_p = 0 (e.g. when already
+        sampled by the dataset). Blur and noise are mutually exclusive, each one drawn with half of sar_p.
+        """
+        super().__init__()
+        self.sar_channels = sar_channels
+        self.crop_scale = crop_scale
+        self.crop_p = crop_p
+        self.flip_p = flip_p
+        self.rotate_p = rotate_p
+        self.sar_p = sar_p
+        self.blur_limit = blur_limit
+        self.multiplier = multiplier
+        self.elastic_p = elastic_p
+        self.elastic_alpha = elastic_alpha
+        self.elastic_sigma = elastic_sigma
+        self.elastic_alpha_affine = elastic_alpha_affine
+        self.grid_p = grid_p
+        self.grid_steps = grid_steps
+        self.grid_limit = grid_limit
+
+    def extra_repr(self) -> str:
+        names = ("sar_channels", "crop_scale", "crop_p", "flip_p", "rotate_p", "sar_p", "blur_limit", "multiplier",
+                 "elastic_p", "elastic_alpha", "elastic_sigma", "elastic_alpha_affine", "grid_p", "grid_steps",
+                 "grid_limit")
+        return ", ".join(f"{name}={getattr(self, name)}" for name in names)
+
+    def _draw(self, batch: int, p: float, device: torch.device) -> Tensor:
+        return torch.rand(batch, device=device) < p
+
+    def _sar_noise(self, images: Tensor) -> Tensor:
+        # one of blur or multiplicative noise (per pixel and channel), on the SAR channels only
+        batch, device = images.size(0), images.device
+        choice = torch.rand(batch, device=device)
+        blur = choice < self.sar_p / 2
+        noise = (choice >= self.sar_p / 2) & (choice < self.sar_p)
+        sar = images[:, :self.sar_channels]
+        if blur.any():
+            # same kernel sizes of the per-sample blur, sigma derived from the size as in OpenCV
+            low, high = self.blur_limit
+            sizes = torch.randint(low // 2, high // 2 + 1, (batch, ), device=device) * 2 + 1
+            sigma = 0.3 * ((sizes.float() - 1) * 0.5 - 1) + 0.8
+            kernels = _gaussian_kernels(sigma, radius=high // 2)
+            offsets = torch.arange(-(high // 2), high // 2 + 1, device=device).view(1, -1)
+            kernels = kernels * (offsets.abs() <= sizes.view(-1, 1) // 2)
+            kernels = kernels / kernels.sum(dim=1, keepdim=True)
+            sar = torch.where(blur.view(-1, 1, 1, 1), _separable_blur(sar, kernels), sar)
+        if noise.any():
+            low, high = self.multiplier
+            factors = torch.empty_like(sar).uniform_(low, high)
+            sar = torch.where(noise.view(-1, 1, 1, 1), sar * factors, sar)
+        return torch.cat((sar, images[:, self.sar_channels:]), dim=1)
+
+    def _grid_distortion(self, batch: int, size: int, device: torch.device) -> Tensor:
+        # piecewise linear stretch of rows and columns (same as `GridDistortion`), in pixels, for each axis
+        step = size // self.grid_steps
+        stretch = 1 + torch.empty(batch, 2, self.grid_steps + 1, device=device).uniform_(-self.grid_limit,
+                                                                                         self.grid_limit)
+        starts = torch.cumsum(F.pad(stretch[..., :-1] * step, (1, 0)), dim=-1)
+        positions = torch.arange(size, device=device, dtype=torch.float32)
+        cells = torch.clamp(positions // step, max=self.grid_steps).long().expand(batch, 2, size)
+        return starts.gather(-1, cells) + (positions - cells * step) * stretch.gather(-1, cells)
+
+    def _elastic_field(self, batch: int, size: int, device: torch.device) -> Tensor:
+        # smooth random displacements, in pixels: the noise is smoothed on a coarser grid, then upsampled,
+        # rescaled so that the amplitude matches the smoothing at full resolution
+        factor = max(1, int(self.elastic_sigma // 4))
+        coarse = max(2, size // factor)
+        noise = torch.rand(batch, 2, coarse, coarse, device=device) * 2 - 1
+        radius = int(min(4 * self.elastic_sigma / factor, coarse - 1))
+        sigma = torch.full((batch, ), self.elastic_sigma / factor, device=device)
+        field = _separable_blur(noise, _gaussian_kernels(sigma, radius=radius)) / factor
+        field = F.interpolate(field, size=(size, size), mode="bilinear", align_corners=False)
+        return field * self.elastic_alpha
+
+    def _sampling_grid(self, batch: int, size: int, device: torch.device) -> Tensor:
+        # output coordinates are mapped back to the input, one transform at a time, in reverse order
+        identity = (torch.arange(size, device=device, dtype=torch.float32) + 0.5) / size * 2 - 1
+        rows, cols = torch.meshgrid(identity, identity, indexing="ij")
+        coords = torch.stack((cols, rows), dim=-1).expand(batch, size, size, 2).clone()
+        if self.grid_p > 0:
+            apply = self._draw(batch, self.grid_p, device).view(-1, 1, 1)
+            stretch = (self._grid_distortion(batch, size, device) + 0.5) / size * 2 - 1
+            coords[..., 0] = torch.where(apply, stretch[:, 0].unsqueeze(1).expand(-1, size, -1), coords[..., 0])
+            coords[..., 1] = torch.where(apply, stretch[:, 1].unsqueeze(2).expand(-1, -1, size), coords[..., 1])
+        if self.elastic_p > 0:
+            # random affine from three perturbed points (inverse mapping), then the smooth displacements
+            apply = self._draw(batch, self.elastic_p, device)
+            side = 2.0 / 3.0
+            source = torch.tensor([[side, side], [side, -side], [-side, -side]], device=device).expand(batch, 3, 2)
+            shift = torch.empty(batch, 3, 2, device=device).uniform_(-1, 1) * self.elastic_alpha_affine * 2 / size
+            target = source + shift * apply.view(-1, 1, 1)
+            ones = torch.ones(batch, 3, 1, device=device)
+            affine = torch.linalg.solve(torch.cat((target, ones), dim=2), source)
+            coords = torch.cat((coords, torch.ones_like(coords[..., :1])), dim=-1) @ affine.unsqueeze(1)
+            field = self._elastic_field(batch, size, device).permute(0, 2, 3, 1) * 2 / size
+            coords = coords + field * apply.view(-1, 1, 1, 1)
+        # rotations by 90 degrees and flips (horizontal, vertical or both) are axis swaps and sign changes
+        rotations = torch.randint(0, 4, (batch, ), device=device) * self._draw(batch, self.rotate_p, device)
+        for k in range(1, 4):
+            selected = rotations == k
+            coords[selected] = self._rotate(coords[selected], k)
+        flips = torch.randint(0, 3, (batch, ), device=device)
+        flip = self._draw(batch, self.flip_p, device)
+        flip_x = flip & (flips != 0)
+        flip_y = flip & (flips != 1)
+        coords[..., 0] = torch.where(flip_x.view(-1, 1, 1), -coords[..., 0], coords[..., 0])
+        coords[..., 1] = torch.where(flip_y.view(-1, 1, 1), -coords[..., 1], coords[..., 1])
+        # random sized crops are a scale and a translation of the coordinates
+        if self.crop_p > 0:
+            low, high = self.crop_scale
+            scale = torch.empty(batch, device=device).uniform_(low, high)
+            scale = torch.where(self._draw(batch, self.crop_p, device), scale, torch.ones_like(scale))
+            offset = (torch.rand(batch, 2, device=device) * 2 - 1) * (1 - scale.view(-1, 1))
+            coords = coords * scale.view(-1, 1, 1, 1) + offset.view(-1, 1, 1, 2)
+        return coords
+
+    @staticmethod
+    def _rotate(coords: Tensor, k: int) -> Tensor:
+        # sampling coordinates of an image rotated k times by 90 degrees, counter-clockwise
+        x, y = coords[..., 0], coords[..., 1]
+        for _ in range(k):
+            x, y = -y, x
+        return torch.stack((x, y), dim=-1)
+
+    def forward(self, images: Tensor, *targets: Tensor) -> Tuple[Tensor, ...]:
+        """Augments a batch of raw images (B, C, H, W), along with its targets (B, H, W), e.g. masks and weights.
+
+        Returns:
+            Tuple[Tensor, ...]: augmented images (float32) and targets (same type as the inputs)
+        """
+        batch, _, height, width = images.shape
+        assert height == width, f"Square images required, got {height}x{width}"
+        images = self._sar_noise(images.float())
+        grid = self._sampling_grid(batch, height, images.device)
+        images = F.grid_sample(images, grid, mode="bilinear", padding_mode="reflection", align_corners=False)
+        results = list()
+        for target in targets:
+            sampled = F.grid_sample(target.unsqueeze(1).float(),
+                                    grid,
+                                    mode="nearest",
+                                    padding_mode="reflection",
+                                    align_corners=False)
+            results.append(sampled.squeeze(1).to(target.dtype))
+        return (images, *results)
+
+
+class RandomCropWindow:
+    """Random sized crop (same as `RandomSizedCrop`), split in two steps: the crop window is sampled first,
+    from the tile dimensions alone, so that only its pixels need to be read, then the crop is resized
+    to the output size, as part of the usual augmentation pipeline.
+    """
+    def __init__(self,
+                 min_max_height: Tuple[int, int],
+                 height: int,
+                 width: int,
+                 w2h_ratio: float = 1.0,
+                 p: float = 1.0) -> None:
+        self.min_max_height = min_max_height
+        self.w2h_ratio = w2h_ratio
+        self.p = p
+        self.resize = Resize(height=height, width=width, always_apply=True)
+
+    def __call__(self, height: int, width: int) -> Optional[Window]:
+        """Samples a crop window for a tile with the given dimensions.
+
+        Args:
+            height (int): tile height.
+            width (int): tile width.
+
+        Returns:
+            Optional[Window]: crop window, None when the whole tile is required
+        """
+        if random.random() >= self.p:
+            return None
+        crop_height = min(random.randint(*self.min_max_height), height)
+        crop_width = min(int(crop_height * self.w2h_ratio), width)
+        row = random.randint(0, height - crop_height)
+        col = random.randint(0, width - crop_width)
+        return Window(col_off=col, row_off=row, width=crop_width, height=crop_height)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(min_max_height={self.min_max_height}, w2h_ratio={self.w2h_ratio}, " \
+            f"p={self.p}, resize={self.resize})"
@@ -0,0 +1,164 @@
+import hashlib
+import logging
+import multiprocessing as mp
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+SHM_DIR = "/dev/shm"
+# packed masks start with their shape (channels, height, width)
+MASK_HEADER = np.dtype("<u4")
+
+
+def default_cache_dir() -> Path:
+    """Shared memory (tmpfs) when available, the temporary folder otherwise.
+    """
+    root = SHM_DIR if os.path.isdir(SHM_DIR) else tempfile.gettempdir()
+    return Path(root) / "floods-cache"
+
+
+def pack_mask(mask: np.ndarray, ignore_index: int = 255) -> Optional[np.ndarray]:
+    """Packs a mask (channels first) into a flat array of bits: flooded pixels and ignored pixels are kept as two
+    separate bit planes, after a small header with the shape. Only masks with background, flood and ignored
+    pixels can be packed, None is returned otherwise.
+    """
+    assert mask.ndim == 3, f"Expected a mask with format CxHxW, got {mask.shape}"
+    flood, ignored = mask == 1, mask == ignore_index
+    if np.count_nonzero(flood) + np.count_nonzero(ignored) + np.count_nonzero(mask == 0) != mask.size:
+        return None
+    header = np.array(mask.shape, dtype=MASK_HEADER).view(np.uint8)
+    return np.concatenate((header, np.packbits(np.stack((flood, ignored)))))
+
+
+def unpack_mask(packed: np.ndarray, ignore_index: int = 255) -> np.ndarray:
+    """Restores a mask packed by `pack_mask`, as uint8.
+    """
+    header = 3 * MASK_HEADER.itemsize
+    shape = tuple(int(size) for size in packed[:header].view(MASK_HEADER))
+    flood, ignored = np.unpackbits(packed[header:], count=2 * int(np.prod(shape))).reshape((2, ) + shape)
+    flood[ignored.astype(bool)] = ignore_index
+    return flood
+
+
+class SharedTileCache:
+    """Cache of decoded arrays, stored as raw .npy files in shared memory (a tmpfs folder such as /dev/shm),
+    so that entries written by any dataloader worker, or by any other run on the same host, are visible to all.
+    Files are written atomically, hits refresh their modification time, which drives the LRU eviction:
+    whenever a process has written a fraction of the budget, the oldest entries are removed until the folder
+    is back below the budget. The budget is therefore approximate, it can be exceeded by a few entries per process.
+    Hits and misses are counted in shared memory, across the workers forked (or spawned) from the same dataset.
+    """
+    def __init__(self,
+                 path: Optional[Union[str, Path]] = None,
+                 max_bytes: int = 4 * 1024**3,
+                 check_every: float = 0.05,
+                 low_watermark: float = 0.9) -> None:
+        """Creates the cache folder, if required.
+
+        Args:
+            path (Optional[Union[str, Path]], optional): cache folder. Defaults to /dev/shm/floods-cache.
+            max_bytes (int, optional): byte budget of the whole folder. Defaults to 4GB.
+            check_every (float, optional): fraction of the budget written before checking it. Defaults to 0.05.
+            low_watermark (float, optional): fraction of the budget left after an eviction. Defaults to 0.9.
+        """
+        assert max_bytes > 0, f"Invalid cache budget: {max_bytes}"
+        self.path = Path(path or default_cache_dir())
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.check_bytes = int(max_bytes * check_every)
+        self.low_watermark = low_watermark
+        # hits and misses
+        self._counters = mp.Array("q", 2)
+        self._written = 0
+
+    def _file(self, key: str) -> Path:
+        return self.path / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.npy"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Returns the cached array for the given key, None when missing.
+        """
+        path = self._file(key)
+        try:
+            array = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, EOFError):
+            # missing, or evicted meanwhile
+            self._count(1)
+            return None
+        self._count(0)
+        return array
+
+    def put(self, key: str, array: np.ndarray) -> None:
+        """Stores the given array, arrays larger than the whole budget are ignored.
+        """
+        if array.nbytes > self.max_bytes:
+            return
+        path = self._file(key)
+        tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+        self._written += array.nbytes
+        if self._written >= self.check_bytes:
+            self._written = 0
+            self.evict()
+
+    def _count(self, index: int) -> None:
+        with self._counters.get_lock():
+            self._counters[index] += 1
+
+    def _entries(self) -> list:
+        entries = list()
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.name.endswith(".npy"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def evict(self) -> int:
+        """Removes the least recently used entries, when the folder exceeds the budget.
+
+        Returns:
+            int: number of removed entries
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return 0
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * self.low_watermark:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        LOG.debug("Cache eviction: %d entries removed, %d bytes left", removed, total)
+        return removed
+
+    def stats(self) -> dict:
+        """Hits, misses and hit rate counted so far, with the current size of the cache.
+        """
+        hits, misses = self._counters[:]
+        entries = self._entries()
+        return dict(hits=hits,
+                    misses=misses,
+                    hit_rate=hits / max(hits + misses, 1),
+                    entries=len(entries),
+                    bytes=sum(size for _, size, _ in entries))
+
+    def reset_stats(self) -> None:
+        with self._counters.get_lock():
+            self._counters[:] = [0, 0]
@@ -0,0 +1,162 @@
+import os
+from pathlib import Path
+from typing import Dict, List, Sequence, Union
+
+import numpy as np
+
+CATALOG_FILE = "catalog.npz"
+
+
+def tile_record(name: str,
+                row: int,
+                col: int,
+                sar: np.ndarray,
+                dem: np.ndarray,
+                mask: np.ndarray,
+                invalid: np.ndarray,
+                ignore_index: int = 255) -> dict:
+    """Summary of a single tile (or of a block of rows of a tile), computed from the arrays being written.
+    Counts and sums of different blocks of the same tile can be added together, see `merge_records`.
+
+    Args:
+        name (str): tile name, as stored on disk.
+        row (int): first row of the tile in the scene.
+        col (int): first column of the tile in the scene.
+        sar (np.ndarray): SAR tile, channels first.
+        dem (np.ndarray): DEM tile, channels first.
+        mask (np.ndarray): ground truth tile, single channel, with invalid pixels already set to the ignore index.
+        invalid (np.ndarray): boolean mask of invalid pixels, height x width.
+        ignore_index (int, optional): value of ignored pixels in the mask. Defaults to 255.
+
+    Returns:
+        dict: record with counts of invalid pixels and mask values, per-channel sums of valid pixels
+    """
+    valid = ~invalid
+    classes = np.bincount(mask.ravel().astype(np.int64), minlength=ignore_index + 1)
+    return dict(name=name,
+                row=int(row),
+                col=int(col),
+                height=int(mask.shape[-2]),
+                width=int(mask.shape[-1]),
+                invalid=int(np.count_nonzero(invalid)),
+                background=int(classes[0]),
+                flood=int(classes[1]),
+                ignored=int(classes[ignore_index]),
+                sar_sum=sar[:, valid].sum(axis=1, dtype=np.float64).tolist(),
+                dem_sum=dem[:, valid].sum(axis=1, dtype=np.float64).tolist())
+
+
+def merge_records(records: Sequence[dict]) -> dict:
+    """Combines the records of consecutive blocks of rows of the same tile.
+    """
+    result = dict(records[0])
+    for record in records[1:]:
+        result["height"] += record["height"]
+        for key in ("invalid", "background", "flood", "ignored"):
+            result[key] += record[key]
+        for key in ("sar_sum", "dem_sum"):
+            result[key] = [a + b for a, b in zip(result[key], record[key])]
+    return result
+
+
+def binary_entropy(probabilities: np.ndarray) -> np.ndarray:
+    """Entropy (in bits) of a binary variable with the given probabilities of the positive class.
+    """
+    p = np.clip(np.asarray(probabilities, dtype=np.float64), 0, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = -(p * np.log2(p) + (1 - p) * np.log2(1 - p))
+    return np.nan_to_num(result, nan=0.0)
+
+
+def write_catalog(path: Path, records: List[dict], scenes: List[str]) -> int:
+    """Stores the given tile records as a columnar catalog (one array for each column), sorted by tile name
+    (without extension), which is the same order of the single files. The file is replaced atomically.
+    Relative paths of the single files are always listed, tiles of packed stores are looked up by name.
+
+    Args:
+        path (Path): destination file.
+        records (List[dict]): tile records, as produced by `tile_record`.
+        scenes (List[str]): scene identifier of each record.
+
+    Returns:
+        int: number of tiles in the catalog
+    """
+    order = sorted(range(len(records)), key=lambda i: records[i]["name"])
+    records = [records[i] for i in order]
+    scenes = [scenes[i] for i in order]
+    names = np.array([Path(r["name"]).stem for r in records], dtype=str)
+    columns = dict(name=names,
+                   scene=np.array(scenes, dtype=str),
+                   emsr=np.array([scene.split("-")[0] for scene in scenes], dtype=str))
+    for key in ("row", "col", "height", "width", "invalid", "background", "flood", "ignored"):
+        columns[key] = np.array([r[key] for r in records], dtype=np.int64)
+    columns["scale"] = np.array([_tile_scale(name) for name in names], dtype=np.int64)
+    for key in ("sar_sum", "dem_sum"):
+        channels = len(records[0][key]) if records else 0
+        columns[key] = np.array([r[key] for r in records], dtype=np.float64).reshape(len(records), channels)
+    for group in ("sar", "dem", "mask"):
+        columns[f"{group}_path"] = np.array([f"{group}/{name}.tif" for name in names], dtype=str)
+    tmp_path = Path(f"{path}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **columns)
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+def _tile_scale(tile_name: str) -> int:
+    suffix = Path(tile_name).stem.split("_")[-1]
+    return int(suffix[1:]) if suffix.startswith("x") else 1
+
+
+class TileCatalog:
+    """Columnar, read-only view on the tile catalog produced by the preprocessing, holding for each tile
+    its name, scene and EMSR code, window offsets, scale, pixel counts and per-channel sums.
+    Derived quantities (invalid ratio, flood ratio, entropy) are computed on the fly, for every tile at once.
+    """
+    def __init__(self, columns: Union[Path, str, Dict[str, np.ndarray]]) -> None:
+        if not isinstance(columns, dict):
+            with np.load(str(columns), allow_pickle=False) as data:
+                columns = {key: data[key] for key in data.files}
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.columns["name"])
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column]
+
+    def __contains__(self, column: str) -> bool:
+        return column in self.columns
+
+    def take(self, indices: Union[Sequence[int], np.ndarray]) -> "TileCatalog":
+        """Returns a new catalog with the given rows (indices or boolean mask), in the given order.
+        """
+        indices = np.asarray(indices)
+        return TileCatalog({key: values[indices] for key, values in self.columns.items()})
+
+    def lookup(self, names: Sequence[str]) -> np.ndarray:
+        """Indices of the given tile names, which must be present in the catalog.
+        """
+        index = {name: i for i, name in enumerate(self.columns["name"])}
+        missing = [name for name in names if name not in index]
+        assert not missing, f"{len(missing)} tiles missing from the catalog (e.g. {missing[0]})"
+        return np.array([index[name] for name in names], dtype=np.int64)
+
+    @property
+    def pixels(self) -> np.ndarray:
+        return self.columns["height"] * self.columns["width"]
+
+    @property
+    def nan_ratio(self) -> np.ndarray:
+        return self.columns["invalid"] / self.pixels
+
+    def flood_ratio(self, smoothing: float = 0.0) -> np.ndarray:
+        """Ratio of flooded pixels over the tile, with optional smoothing (same as `tile_body_water_ratio`).
+        """
+        factor = smoothing * self.pixels
+        return (self.columns["flood"] + factor) / (self.pixels + factor)
+
+    def entropy(self) -> np.ndarray:
+        """Entropy of each binary label, ignored pixels count as background (same as `utils.ml.entropy`).
+        """
+        return binary_entropy(self.columns["flood"] / self.pixels)
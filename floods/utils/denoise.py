@@ -0,0 +1,89 @@
+import cv2
+import numpy as np
+from skimage.restoration import denoise_nl_means
+
+
+def nl_means(image: np.ndarray, h: float = 0.1, **kwargs) -> np.ndarray:
+    """Non-local means from scikit-image, the slowest and most accurate option.
+
+    Args:
+        image (np.ndarray): float image with format HxWxC.
+        h (float, optional): cut-off distance, in gray levels. Defaults to 0.1.
+
+    Returns:
+        np.ndarray: denoised image, same shape as the input
+    """
+    return denoise_nl_means(image, h=h, channel_axis=-1)
+
+
+def fast_nl_means(image: np.ndarray, h: float = 0.1, value_range: tuple = (0.0, 1.0), **kwargs) -> np.ndarray:
+    """Non-local means from OpenCV: several times faster, but it only works on 8-bit data, therefore each
+    channel is clipped and quantized in the given range first, then restored to the same range.
+
+    Args:
+        image (np.ndarray): float image with format HxWxC.
+        h (float, optional): filter strength, in the same scale of the image. Defaults to 0.1.
+        value_range (tuple, optional): range of values mapped to 8 bits. Defaults to (0.0, 1.0).
+
+    Returns:
+        np.ndarray: denoised image, same shape as the input
+    """
+    low, high = value_range
+    scale = 255.0 / (high - low)
+    result = np.empty(image.shape, dtype=np.float32)
+    for channel in range(image.shape[-1]):
+        quantized = np.clip((image[..., channel] - low) * scale, 0, 255).astype(np.uint8)
+        denoised = cv2.fastNlMeansDenoising(quantized, None, h=h * scale, templateWindowSize=7, searchWindowSize=21)
+        result[..., channel] = denoised / scale + low
+    return result
+
+
+def box_filter(image: np.ndarray, kernel_size: int = 5, **kwargs) -> np.ndarray:
+    """Plain moving average over a square window, the fastest and coarsest option.
+
+    Args:
+        image (np.ndarray): float image with format HxWxC.
+        kernel_size (int, optional): side of the averaging window. Defaults to 5.
+
+    Returns:
+        np.ndarray: denoised image, same shape as the input
+    """
+    image = image.astype(np.float32, copy=False)
+    return cv2.blur(image, (kernel_size, kernel_size)).reshape(image.shape)
+
+
+def lee_filter(image: np.ndarray, kernel_size: int = 5, **kwargs) -> np.ndarray:
+    """Vectorised Lee filter for speckle noise: each pixel is pulled towards the local mean, more strongly
+    where the local variance is low compared to the noise variance (estimated as the average local variance).
+
+    Args:
+        image (np.ndarray): float image with format HxWxC.
+        kernel_size (int, optional): side of the window used for local statistics. Defaults to 5.
+
+    Returns:
+        np.ndarray: denoised image, same shape as the input
+    """
+    image = image.astype(np.float32, copy=False)
+    mean = box_filter(image, kernel_size=kernel_size)
+    sq_mean = box_filter(image**2, kernel_size=kernel_size)
+    variance = np.maximum(sq_mean - mean**2, 0)
+    noise = variance.mean(axis=(0, 1), keepdims=True)
+    weights = variance / (variance + noise + np.finfo(np.float32).eps)
+    return mean + weights * (image - mean)
+
+
+DENOISERS = dict(nlmeans=nl_means, opencv=fast_nl_means, lee=lee_filter, box=box_filter)
+
+
+def denoise(image: np.ndarray, method: str = "nlmeans", **kwargs) -> np.ndarray:
+    """Applies the given denoising method, extra arguments are forwarded when relevant.
+
+    Args:
+        image (np.ndarray): float image with format HxWxC.
+        method (str, optional): one of nlmeans, opencv, lee, box. Defaults to "nlmeans".
+
+    Returns:
+        np.ndarray: denoised image, same shape as the input
+    """
+    assert method in DENOISERS, f"Unknown denoising method: {method}, available: {list(DENOISERS)}"
+    return DENOISERS[method](image, **kwargs)
@@ -0,0 +1,98 @@
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy.ndimage import gaussian_filter
+
+from floods.utils.cache import default_cache_dir
+
+LOG = logging.getLogger(__name__)
+
+FIELDS_DIR = "fields"
+
+
+class DisplacementBank:
+    """Bank of smooth random displacement fields (dx, dy), the same of the elastic transform (uniform noise in
+    [-1, 1], smoothed with a gaussian filter), generated once and stored as a single .npy file in shared memory.
+    Fields are smoothed with periodic borders, so that they can be rolled (and cropped) without seams.
+    Every process maps the file read-only on first access, the pages are shared by all workers (and by later runs
+    with the same parameters), memory maps are never pickled.
+    """
+    def __init__(self,
+                 size: int,
+                 count: int = 32,
+                 sigma: float = 50.0,
+                 seed: int = 0,
+                 path: Optional[Union[str, Path]] = None) -> None:
+        """Generates the fields, unless the file already exists.
+
+        Args:
+            size (int): height and width of the (square) fields.
+            count (int, optional): number of fields in the bank. Defaults to 32.
+            sigma (float, optional): standard deviation of the gaussian smoothing, in pixels. Defaults to 50.
+            seed (int, optional): seed of the random noise. Defaults to 0.
+            path (Optional[Union[str, Path]], optional): folder of the bank. Defaults to /dev/shm/floods-cache/fields.
+        """
+        assert size > 0 and count > 0, f"Invalid bank size: {count} fields of {size}x{size}"
+        self.size = size
+        self.count = count
+        self.sigma = sigma
+        self.seed = seed
+        folder = Path(path) if path else default_cache_dir() / FIELDS_DIR
+        self.path = folder / f"elastic_{size}_{count}_{sigma:g}_{seed}.npy"
+        self._fields = None
+        self._pid = None
+        if not self.path.is_file():
+            folder.mkdir(parents=True, exist_ok=True)
+            self._generate()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_fields"] = None
+        return state
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _generate(self) -> None:
+        LOG.info("Generating %d displacement fields (%dx%d, sigma: %g)", self.count, self.size, self.size, self.sigma)
+        rng = np.random.default_rng(self.seed)
+        tmp_path = f"{self.path}.tmp{os.getpid()}"
+        fields = open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(self.count, 2, self.size, self.size))
+        for index in range(self.count):
+            noise = rng.uniform(-1, 1, size=(2, self.size, self.size))
+            fields[index] = gaussian_filter(noise, sigma=(0, self.sigma, self.sigma), mode="wrap")
+        fields.flush()
+        del fields
+        os.replace(tmp_path, self.path)
+
+    @property
+    def fields(self) -> np.ndarray:
+        """Read-only map of the whole bank, with format NxCxHxW (C = dx, dy).
+        """
+        if self._pid != os.getpid():
+            self._fields, self._pid = np.load(self.path, mmap_mode="r"), os.getpid()
+        return self._fields
+
+    def sample(self, height: int, width: int, rng: Optional[np.random.Generator] = None) -> Tuple[np.ndarray, ...]:
+        """Draws a field of the given size: a random field of the bank, randomly transposed, flipped and rolled
+        (wrapping around its borders), with the signs of the displacements following the flips.
+
+        Returns:
+            Tuple[np.ndarray, ...]: displacements along x and y, with format HxW
+        """
+        rng = rng or np.random.default_rng()
+        field = self.fields[rng.integers(self.count)]
+        if rng.random() < 0.5:
+            # swap the axes, along with the displacements
+            field = field[::-1].transpose(0, 2, 1)
+        rows = (np.arange(height) + rng.integers(self.size)) % self.size
+        cols = (np.arange(width) + rng.integers(self.size)) % self.size
+        flip_x, flip_y = rng.random(2) < 0.5
+        rows = rows[::-1] if flip_y else rows
+        cols = cols[::-1] if flip_x else cols
+        dx, dy = field[:, rows[:, None], cols[None, :]]
+        return (-dx if flip_x else dx), (-dy if flip_y else dy)
@@ -1,66 +1,145 @@
 from pathlib import Path
+from typing import Optional
 
 import numpy as np
 import rasterio
-from rasterio.io import DatasetReader
 from rasterio.transform import Affine
 from rasterio.windows import Window
 
 
-def imread(path: Path, channels_first: bool = True, return_metadata: bool = False) -> np.ndarray:
+def imread(path: Path,
+           channels_first: bool = True,
+           return_metadata: bool = False,
+           window: Window = None,
+           decode: bool = True) -> np.ndarray:
     """Wraps rasterio open functionality to read the numpy array and exit the context.
 
     Args:
         path (Path): path to the geoTIFF image
         channels_first (bool, optional): whether to return it channels first or not. Defaults to True.
+        return_metadata (bool, optional): whether to also return the raster profile. Defaults to False.
+        window (Window, optional): when provided, only the given window is read from disk. Defaults to None.
+        decode (bool, optional): whether to apply the scale and offset of the bands, if any, returning
+            float32 values. When False, the stored values are returned (e.g. scaled integers). Defaults to True.
 
     Returns:
         np.ndarray: image array
     """
     with rasterio.open(str(path), mode="r", driver="GTiff") as src:
-        image = src.read()
+        image = src.read(window=window)
         metadata = src.profile.copy()
+        if window is not None:
+            metadata.update(height=image.shape[1], width=image.shape[2], transform=src.window_transform(window))
+        if decode and (any(s != 1.0 for s in src.scales) or any(o != 0.0 for o in src.offsets)):
+            scales = np.array(src.scales, dtype=np.float32)[:, np.newaxis, np.newaxis]
+            offsets = np.array(src.offsets, dtype=np.float32)[:, np.newaxis, np.newaxis]
+            image = image.astype(np.float32) * scales + offsets
     image = image if channels_first else image.transpose(1, 2, 0)
     if return_metadata:
         return image, metadata
     return image
 
 
-def mask_raster(path: Path, mask: np.ndarray, mask_value: int = 0) -> None:
-    """Masks the given raster (a 3D image with channels first) with the given mask (2D).
+def array_window(image: np.ndarray, window: Window, mask: np.ndarray = None, mask_value: int = 0) -> np.ndarray:
+    """Slices the given window from an in-memory image (channels first). The result is a view on the source,
+    unless a mask is provided: in that case the masked pixels are set to the given value on a copy.
 
     Args:
-        path (Path): path to the image to be masked
-        mask (np.ndarray): mask containing the pixels to be set to the given value
-        mask_value (int, optional): Value for the invalid pixels. Defaults to 0.
+        image (np.ndarray): source image with format CxHxW
+        window (Window): rasterio Window to delimit the target image
+        mask (np.ndarray, optional): 2D mask, with the same size of the window, of pixels to be replaced
+        mask_value (int, optional): Value for the masked pixels. Defaults to 0.
+
+    Returns:
+        np.ndarray: image tile, CxHxW
+    """
+    (row_start, row_stop), (col_start, col_stop) = window.toranges()
+    tile = image[:, row_start:row_stop, col_start:col_stop]
+    if mask is not None:
+        assert tile.shape[1:] == mask.shape, f"Mask shape ({mask.shape}) doesn't match tile shape ({tile.shape})"
+        tile = tile.copy()
+        tile[:, mask] = mask_value
+    return tile
+
+
+def tile_encoding(path: Path) -> dict:
+    """Storage details of a raster, from its header: whether bands are stored in half precision (floats with 16 bits)
+    and the scale factor of bands stored as scaled integers (None when values are stored as they are).
     """
     with rasterio.open(str(path), mode="r", driver="GTiff") as src:
-        current = src.read()
-        profile = src.profile
-    with rasterio.open(str(path), mode="w", **profile) as dst:
-        assert current.shape[1:] == mask.shape, \
-            f"Mask shape ({mask.shape}) doesn't match target shape ({current.shape})"
-        current[:, mask] = mask_value
-        dst.write(current)
+        half = src.tags(1, ns="IMAGE_STRUCTURE").get("NBITS") == "16" and src.dtypes[0] == "float32"
+        scale = src.scales[0] if src.scales[0] != 1.0 else None
+    return dict(half=half, scale=scale)
 
 
-def write_window(window: Window, source: DatasetReader, path: Path, transform: Affine = None) -> None:
-    """Stores the data inside the given window, cutting it from the source dataset.
-    The image is stored in the given path. When the transform is None, the source transform is used instead.
+def encode_tile(tile: np.ndarray, dtype: str, nbits: Optional[int] = None, scale: Optional[float] = None) -> np.ndarray:
+    """Converts a tile into the values actually stored with the given data type: floats stored with 16 bits are
+    rounded to half precision, integers with a scale factor store the rounded values divided by the scale
+    (invalid values become zero, the rest is clipped to the integer range).
 
     Args:
+        tile (np.ndarray): tile with physical values, any shape.
+        dtype (str): data type of the output raster.
+        nbits (Optional[int], optional): bits per value in the output raster, if reduced. Defaults to None.
+        scale (Optional[float], optional): scale factor of the integer values. Defaults to None.
+
+    Returns:
+        np.ndarray: tile with the given data type
+    """
+    if scale is not None:
+        info = np.iinfo(dtype)
+        return np.clip(np.rint(np.nan_to_num(tile / scale)), info.min, info.max).astype(dtype)
+    if nbits == 16 and np.issubdtype(np.dtype(dtype), np.floating):
+        return tile.astype(np.float16).astype(dtype)
+    return tile.astype(dtype, copy=False)
+
+
+def decode_tile(tile: np.ndarray, scale: Optional[float] = None) -> np.ndarray:
+    """Physical values of a tile stored as scaled integers, as float32. Tiles without scale are returned as they are.
+    """
+    if scale is None:
+        return tile
+    return tile.astype(np.float32) * np.float32(scale)
+
+
+def write_array_window(image: np.ndarray,
+                       window: Window,
+                       path: Path,
+                       profile: dict,
+                       transform: Affine,
+                       mask: np.ndarray = None,
+                       mask_value: int = 0) -> np.ndarray:
+    """Stores the data inside the given window, slicing it directly from an in-memory image (channels first).
+    The slice is a view on the source array, no intermediate dataset or copy is required, while the tile
+    transform is derived from the given source transform. When a mask is provided, the masked pixels are set
+    to the given value on a copy of the tile, leaving the source untouched.
+
+    Args:
+        image (np.ndarray): source image with format CxHxW
         window (Window): rasterio Window to delimit the target image
-        source (DatasetReader): source TIFF to be cut
         path (Path): path to the target file to be created
-        transform (Affine, optional): Optional alternative transform. Defaults to None.
-    """
-    kwargs = source.meta.copy()
-    transform = transform or source.transform
-    transform = rasterio.windows.transform(window, transform)
-    kwargs.update(dict(height=window.height, width=window.width, transform=transform))
+        profile (dict): base profile for the output (driver, dtype, crs, ...), dimensions are updated here.
+            An optional `scale_factor` stores the values as scaled integers (see `encode_tile`).
+        transform (Affine): geotransform of the full source image
+        mask (np.ndarray, optional): 2D mask, with the same size of the window, of pixels to be replaced
+        mask_value (int, optional): Value for the masked pixels. Defaults to 0.
 
+    Returns:
+        np.ndarray: the stored tile, with the output data type
+    """
+    tile = array_window(image, window, mask=mask, mask_value=mask_value)
+    kwargs = dict(profile,
+                  height=tile.shape[1],
+                  width=tile.shape[2],
+                  count=tile.shape[0],
+                  transform=rasterio.windows.transform(window, transform))
+    scale = kwargs.pop("scale_factor", None)
+    tile = encode_tile(tile, kwargs["dtype"], nbits=kwargs.get("nbits"), scale=scale)
     with rasterio.open(str(path), "w", **kwargs) as dst:
-        dst.write(source.read(window=window))
+        dst.write(tile)
+        if scale is not None:
+            dst.scales = (scale, ) * tile.shape[0]
+    return tile
 
 
 def rgb_ratio(sar_image: np.ndarray,
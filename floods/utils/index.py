@@ -0,0 +1,97 @@
+import logging
+import os
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Dict, List, Union
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+FILES_INDEX = "files.npz"
+
+
+class TileFiles(Sequence):
+    """Array-backed list of the tile files of a single folder: only the names are stored, in a numpy array,
+    full paths are built when accessed. It can stand in for a (sorted) list of tile paths.
+    """
+    def __init__(self, folder: Path, names: np.ndarray, extension: str = ".tif") -> None:
+        self.folder = Path(folder)
+        self.tiles = np.asarray(names, dtype=str)
+        self.extension = extension
+
+    def __len__(self) -> int:
+        return len(self.tiles)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, "TileFiles"]:
+        if isinstance(index, slice):
+            return TileFiles(self.folder, self.tiles[index], extension=self.extension)
+        return os.path.join(self.folder, self.tiles[index] + self.extension)
+
+    def names(self) -> List[str]:
+        return self.tiles.tolist()
+
+    def paths(self) -> List[str]:
+        folder = str(self.folder)
+        return [os.path.join(folder, name + self.extension) for name in self.tiles.tolist()]
+
+    def select(self, mask: Union[List[bool], np.ndarray]) -> "TileFiles":
+        return TileFiles(self.folder, self.tiles[np.asarray(mask, dtype=bool)], extension=self.extension)
+
+
+def _scan_folder(folder: Path, extension: str = ".tif") -> np.ndarray:
+    # a single scan of the folder, sorted by file name (same order of glob + sorted), then stripped
+    if not folder.is_dir():
+        return np.array([], dtype=str)
+    with os.scandir(folder) as it:
+        names = sorted(entry.name for entry in it if entry.name.endswith(extension) and not entry.name.startswith("."))
+    return np.array([name[:-len(extension)] for name in names], dtype=str)
+
+
+def _folder_mtime(folder: Path) -> int:
+    # adding, removing or replacing a file updates the modification time of its folder
+    return os.stat(folder).st_mtime_ns if folder.is_dir() else -1
+
+
+def index_tiles(path: Path, groups: Sequence[str], reuse: bool = True) -> Dict[str, np.ndarray]:
+    """Lists the tile names in each group folder (e.g. sar, mask) and checks that they match, as arrays.
+    Names are stored in an index file next to the folders, reused as long as the folders are unchanged,
+    so that later runs (or other processes of the same run) do not need to scan them again.
+
+    Args:
+        path (Path): subset folder, containing one folder for each group.
+        groups (Sequence[str]): group folders to be listed, the first one is the reference.
+        reuse (bool, optional): whether to reuse the index file, when up to date. Defaults to True.
+
+    Returns:
+        Dict[str, np.ndarray]: sorted tile names (without extension) for each group
+    """
+    path = Path(path)
+    index_path = path / FILES_INDEX
+    mtimes = {group: _folder_mtime(path / group) for group in groups}
+    stored = dict()
+    if index_path.is_file():
+        with np.load(index_path, allow_pickle=False) as index:
+            stored = {key: index[key] for key in index.files}
+    if reuse and all(group in stored and int(stored[f"{group}_mtime"]) == mtimes[group] for group in groups):
+        return {group: stored[group] for group in groups}
+    result = {group: _scan_folder(path / group) for group in groups}
+    reference = groups[0]
+    for group in groups[1:]:
+        assert len(result[group]) == len(result[reference]), \
+            f"Length mismatch between {reference} and {group}: {len(result[reference])} != {len(result[group])}"
+        mismatch = np.flatnonzero(result[group] != result[reference])
+        assert mismatch.size == 0, \
+            f"{reference}: {result[reference][mismatch[0]]} != {group}: {result[group][mismatch[0]]}"
+    # other groups already in the index are kept, the file is replaced atomically
+    for group in groups:
+        stored[group] = result[group]
+        stored[f"{group}_mtime"] = np.int64(mtimes[group])
+    try:
+        tmp_path = Path(f"{index_path}.tmp{os.getpid()}")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **stored)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        LOG.warning("Could not store the tile index in %s: %s", str(path), str(e))
+    return result
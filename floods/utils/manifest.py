@@ -0,0 +1,55 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Union
+
+from floods.utils.common import check_or_make_dir
+
+
+def fingerprint(*paths: Union[str, Path]) -> List[dict]:
+    """Cheap content fingerprint of the given files, based on path, size and modification time.
+
+    Returns:
+        List[dict]: one record for each file, in the same order
+    """
+    records = list()
+    for path in paths:
+        stat = os.stat(path)
+        records.append(dict(path=str(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns))
+    return records
+
+
+class SceneManifest:
+    """Records what has been produced for each source scene, one JSON entry per scene, so that interrupted
+    or repeated runs only need to process new or changed scenes. Entries are written atomically once
+    a scene is complete: a scene without an entry is considered missing, whatever is on disk.
+    """
+    def __init__(self, path: Path) -> None:
+        self.path = check_or_make_dir(path)
+
+    def _entry_path(self, scene_id: str) -> Path:
+        return self.path / f"{scene_id}.json"
+
+    def entries(self) -> Dict[str, dict]:
+        result = dict()
+        for entry_path in sorted(self.path.glob("*.json")):
+            with open(entry_path, "r", encoding="utf-8") as f:
+                result[entry_path.stem] = json.load(f)
+        return result
+
+    def is_current(self, entry: dict, sources: List[dict], settings: Dict[str, Any]) -> bool:
+        """Whether the given entry has been produced from the same sources, with the same settings.
+        """
+        if entry is None:
+            return False
+        return entry["sources"] == sources and entry["settings"] == json.loads(json.dumps(settings))
+
+    def write(self, scene_id: str, sources: List[dict], settings: Dict[str, Any], **info: Any) -> None:
+        entry = dict(scene=scene_id, sources=sources, settings=settings, **info)
+        tmp_path = self.path / f"{scene_id}.json.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, indent=2)
+        os.replace(tmp_path, self._entry_path(scene_id))
+
+    def remove(self, scene_id: str) -> None:
+        self._entry_path(scene_id).unlink(missing_ok=True)
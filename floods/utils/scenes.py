@@ -0,0 +1,131 @@
+import os
+from collections.abc import Sequence
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import rasterio
+from rasterio.io import DatasetReader
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from floods.utils.catalog import TileCatalog
+from floods.utils.common import check_or_make_dir
+
+SCENES_DIR = "scenes"
+BLOCK_SIZE = 256
+
+
+def scene_raster_name(scene_id: str, scale: int = 1) -> str:
+    """Name of the processed raster of the given scene, at the given scale (same suffix of the tiles).
+    """
+    return f"{scene_id}.tif" if scale == 1 else f"{scene_id}_x{scale}.tif"
+
+
+class SceneRasterWriter:
+    """Writes the processed rasters of a single scene at a given scale, one for each group (sar, dem, mask),
+    a block of rows at a time. Rasters are internally tiled, so that any window can be read efficiently.
+    """
+    def __init__(self, path: Path, scene_name: str, height: int, width: int, transform: Affine) -> None:
+        self.path = Path(path) / SCENES_DIR
+        self.scene_name = scene_name
+        self.height = height
+        self.width = width
+        self.transform = transform
+        self.outputs = dict()
+
+    def __enter__(self) -> "SceneRasterWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, group: str, data: np.ndarray, profile: dict, row_offset: int = 0) -> None:
+        """Writes the given rows (channels first) in the raster of the given group, created on first use.
+
+        Args:
+            group (str): image group, e.g. sar.
+            data (np.ndarray): block of rows, with format CxHxW, with the same width of the scene.
+            profile (dict): base profile of the output (driver, dtype, nodata, crs).
+            row_offset (int, optional): first row of the block in the scene. Defaults to 0.
+        """
+        if group not in self.outputs:
+            path = check_or_make_dir(self.path / group) / self.scene_name
+            kwargs = dict(profile,
+                          count=data.shape[0],
+                          height=self.height,
+                          width=self.width,
+                          transform=self.transform,
+                          tiled=True,
+                          blockxsize=BLOCK_SIZE,
+                          blockysize=BLOCK_SIZE)
+            self.outputs[group] = rasterio.open(str(path), "w", **kwargs)
+        dst = self.outputs[group]
+        dst.write(data.astype(dst.dtypes[0], copy=False), window=Window(0, row_offset, self.width, data.shape[1]))
+
+    def close(self) -> None:
+        for dst in self.outputs.values():
+            dst.close()
+        self.outputs = dict()
+
+
+class WindowSequence(Sequence):
+    """Lazy list-like view of the tiles of a group, each item is read as a window of the processed scene raster,
+    according to the catalog (scene, scale and window of each tile). It can stand in for a list of tile files.
+    Open rasters are kept for the lifetime of the process, and never shared with forked workers.
+    """
+    def __init__(self, path: Path, group: str, catalog: TileCatalog) -> None:
+        self.path = Path(path)
+        self.group = group
+        self.catalog = catalog
+        self._datasets = dict()
+        self._pid = None
+
+    def __len__(self) -> int:
+        return len(self.catalog)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_datasets"] = dict()
+        return state
+
+    def _dataset(self, name: str) -> DatasetReader:
+        if self._pid != os.getpid():
+            self._datasets, self._pid = dict(), os.getpid()
+        if name not in self._datasets:
+            self._datasets[name] = rasterio.open(str(self.path / SCENES_DIR / self.group / name))
+        return self._datasets[name]
+
+    def raster(self, index: int) -> str:
+        return scene_raster_name(str(self.catalog["scene"][index]), int(self.catalog["scale"][index]))
+
+    def window(self, index: int) -> Window:
+        return Window(col_off=int(self.catalog["col"][index]),
+                      row_off=int(self.catalog["row"][index]),
+                      width=int(self.catalog["width"][index]),
+                      height=int(self.catalog["height"][index]))
+
+    def shape(self, index: int) -> Tuple[int, int]:
+        return int(self.catalog["height"][index]), int(self.catalog["width"][index])
+
+    def read(self, index: int, window: Optional[Window] = None) -> np.ndarray:
+        """Reads the given tile, or only the given window of it (relative to the tile).
+        """
+        tile_window = self.window(index)
+        if window is not None:
+            tile_window = Window(col_off=tile_window.col_off + window.col_off,
+                                 row_off=tile_window.row_off + window.row_off,
+                                 width=window.width,
+                                 height=window.height)
+        return self._dataset(self.raster(index)).read(window=tile_window)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[np.ndarray, "WindowSequence"]:
+        if isinstance(index, slice):
+            return WindowSequence(self.path, self.group, self.catalog.take(np.arange(len(self))[index]))
+        return self.read(index)
+
+    def names(self) -> List[str]:
+        return [str(name) for name in self.catalog["name"]]
+
+    def select(self, mask: Union[List[bool], np.ndarray]) -> "WindowSequence":
+        return WindowSequence(self.path, self.group, self.catalog.take(np.asarray(mask, dtype=bool)))
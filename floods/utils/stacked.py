@@ -0,0 +1,152 @@
+import json
+import os
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from floods.utils.common import check_or_make_dir
+from floods.utils.index import TileFiles
+
+STACKED_DIR = "stacked"
+ROLES_TAG = "BAND_ROLES"
+# bands of the different modalities are always stored in this order, when present
+ROLE_ORDER = ("sar", "dem", "mask", "weight")
+
+
+def write_stacked(path: Path, bands: Dict[str, np.ndarray], transform: Affine, crs: Optional[CRS] = None) -> None:
+    """Stores the given modalities of a tile as a single float32 raster (pixel interleaved, so that every band
+    of a pixel is contiguous), with a tag describing the first and last band of each role.
+
+    Args:
+        path (Path): destination file, replaced atomically.
+        bands (Dict[str, np.ndarray]): arrays for each role (e.g. sar, dem, mask), channels first, same size.
+        transform (Affine): geotransform of the tile.
+        crs (Optional[CRS], optional): coordinate reference system. Defaults to None.
+    """
+    roles, start = dict(), 0
+    for role in ROLE_ORDER:
+        if role in bands:
+            roles[role] = (start, start + bands[role].shape[0])
+            start += bands[role].shape[0]
+    assert len(roles) == len(bands), f"Unknown band roles: {set(bands) - set(roles)}"
+    data = np.concatenate([bands[role].astype(np.float32, copy=False) for role in roles])
+    profile = dict(driver="GTiff",
+                   dtype="float32",
+                   count=data.shape[0],
+                   height=data.shape[1],
+                   width=data.shape[2],
+                   transform=transform,
+                   crs=crs,
+                   interleave="pixel")
+    tmp_path = Path(path).with_suffix(f".tmp{os.getpid()}")
+    with rasterio.open(str(tmp_path), "w", **profile) as dst:
+        dst.write(data)
+        dst.update_tags(**{ROLES_TAG: json.dumps(roles)})
+        dst.descriptions = tuple(f"{role}_{i}" for role, (first, last) in roles.items() for i in range(last - first))
+    os.replace(tmp_path, path)
+
+
+def read_stacked(path: Union[str, Path], window: Optional[Window] = None) -> Tuple[np.ndarray, Dict[str, tuple]]:
+    """Reads every band of a stacked tile (or the given window) with a single read, along with the band roles.
+    """
+    with rasterio.open(str(path), mode="r", driver="GTiff") as src:
+        return src.read(window=window), stacked_roles(src.tags())
+
+
+def stacked_roles(tags: Union[str, Path, dict]) -> Dict[str, tuple]:
+    """First and last (excluded) band of each role, from the tags of a stacked raster, or from its path.
+    """
+    if not isinstance(tags, dict):
+        with rasterio.open(str(tags), mode="r", driver="GTiff") as src:
+            tags = src.tags()
+    return {role: tuple(bands) for role, bands in json.loads(tags[ROLES_TAG]).items()}
+
+
+class StackedTileWriter:
+    """Stores each tile as a single stacked raster, with the same interface of the packed writer: tiles are
+    started with `add`, then every modality is written, possibly a block of rows at a time. Each tile
+    is kept in memory until the next one is started (or the writer is closed), then written at once.
+    """
+    def __init__(self, path: Path) -> None:
+        self.path = check_or_make_dir(path)
+        self.current = None
+        self.bands = dict()
+
+    def __enter__(self) -> "StackedTileWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def add(self, tile_id: str, height: int, width: int, transform: Affine, crs: Optional[CRS] = None) -> None:
+        self.flush()
+        self.current = dict(tile_id=tile_id, height=height, width=width, transform=transform, crs=crs)
+
+    def write(self, group: str, data: np.ndarray, row_offset: int = 0) -> None:
+        assert self.current is not None, "No tile started, call add first"
+        if group not in self.bands:
+            self.bands[group] = np.zeros((data.shape[0], self.current["height"], self.current["width"]),
+                                         dtype=np.float32)
+        self.bands[group][:, row_offset:row_offset + data.shape[1]] = data
+
+    def flush(self) -> None:
+        if self.current is not None and self.bands:
+            write_stacked(self.path / f"{self.current['tile_id']}.tif",
+                          self.bands,
+                          transform=self.current["transform"],
+                          crs=self.current["crs"])
+        self.current = None
+        self.bands = dict()
+
+    def close(self) -> None:
+        self.flush()
+
+
+class StackedSequence(Sequence):
+    """Lazy list-like view of a single role (e.g. sar) of stacked tiles, each item is read with the bands
+    of that role only. It can stand in for a list of tile files, while `files` lists the stacked rasters,
+    so that every role of a tile can be read at once and split with `take`.
+    """
+    def __init__(self, files: TileFiles, role: str, roles: Dict[str, tuple]) -> None:
+        assert role in roles, f"Band role '{role}' not found in the stacked tiles: {list(roles)}"
+        self.files = files
+        self.role = role
+        self.roles = roles
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[np.ndarray, "StackedSequence"]:
+        if isinstance(index, slice):
+            return StackedSequence(self.files[index], self.role, self.roles)
+        return self.read(index)
+
+    def take(self, stack: np.ndarray) -> np.ndarray:
+        """Bands of this role, from the whole stack of a tile.
+        """
+        first, last = self.roles[self.role]
+        return stack[first:last]
+
+    def read(self, index: int, window: Optional[Window] = None) -> np.ndarray:
+        first, last = self.roles[self.role]
+        with rasterio.open(self.files[index], mode="r", driver="GTiff") as src:
+            return src.read(indexes=list(range(first + 1, last + 1)), window=window)
+
+    def shape(self, index: int) -> Tuple[int, int]:
+        with rasterio.open(self.files[index], mode="r", driver="GTiff") as src:
+            return src.height, src.width
+
+    def names(self) -> List[str]:
+        return self.files.names()
+
+    def paths(self) -> List[str]:
+        return self.files.paths()
+
+    def select(self, mask: Union[List[bool], np.ndarray]) -> "StackedSequence":
+        return StackedSequence(self.files.select(mask), self.role, self.roles)
@@ -0,0 +1,221 @@
+from collections import Counter
+from typing import Sequence, Tuple
+
+import numpy as np
+
+
+class Histogram:
+    """Per-channel histogram with fixed bins, built incrementally in bounded memory.
+    Values outside the range are accumulated in the first and last bins, non-finite values are ignored.
+    Histograms with the same bins can be merged, e.g. when computed by different workers.
+    """
+    def __init__(self, channels: int, bins: int = 256, value_range: Tuple[float, float] = (0.0, 1.0)) -> None:
+        low, high = value_range
+        assert high > low, f"Invalid histogram range: {value_range}"
+        self.bins = bins
+        self.value_range = (float(low), float(high))
+        self.edges = np.linspace(low, high, num=bins + 1)
+        self.counts = np.zeros((channels, bins), dtype=np.int64)
+
+    @property
+    def centers(self) -> np.ndarray:
+        return (self.edges[:-1] + self.edges[1:]) / 2.0
+
+    def update(self, values: np.ndarray) -> "Histogram":
+        """Adds the given values to the histogram.
+
+        Args:
+            values (np.ndarray): array with format C x N (or C x anything), one row for each channel.
+
+        Returns:
+            Histogram: the same instance, updated
+        """
+        values = values.reshape(self.counts.shape[0], -1)
+        low, high = self.value_range
+        for channel, channel_values in enumerate(values):
+            channel_values = channel_values[np.isfinite(channel_values)]
+            indices = ((channel_values - low) * (self.bins / (high - low))).astype(np.int64)
+            self.counts[channel] += np.bincount(np.clip(indices, 0, self.bins - 1), minlength=self.bins)
+        return self
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        assert self.counts.shape == other.counts.shape and self.value_range == other.value_range, \
+            "Cannot merge histograms with different bins"
+        self.counts += other.counts
+        return self
+
+
+def otsu_threshold(counts: np.ndarray, centers: np.ndarray) -> float:
+    """Computes the Otsu threshold from a histogram, maximizing the inter-class variance,
+    in a vectorised way (equivalent to `skimage.filters.threshold_otsu` with the same histogram).
+
+    Args:
+        counts (np.ndarray): histogram counts, one for each bin.
+        centers (np.ndarray): bin centers.
+
+    Returns:
+        float: threshold, values below it belong to the first class
+    """
+    counts = counts.astype(np.float64)
+    if np.count_nonzero(counts) < 2:
+        return float(centers[np.argmax(counts)])
+    # probabilities and means of the two classes, for every possible split
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean1 = np.cumsum(counts * centers) / weight1
+        mean2 = (np.cumsum((counts * centers)[::-1]) / weight2[::-1])[::-1]
+    variance = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:])**2
+    return float(centers[np.nanargmax(variance)])
+
+
+class Moments:
+    """Per-channel count, mean, variance, minimum and maximum, computed in a single pass.
+    Each update computes the statistics of the new batch and combines them with the current ones, as in
+    Chan et al. parallel variant of Welford's algorithm: accumulators from different workers can be merged
+    exactly, without keeping any pixel in memory. Non-finite values are ignored.
+    """
+    def __init__(self, channels: int) -> None:
+        self.count = np.zeros(channels, dtype=np.int64)
+        self.mean = np.zeros(channels, dtype=np.float64)
+        self.m2 = np.zeros(channels, dtype=np.float64)
+        self.min = np.full(channels, np.inf, dtype=np.float64)
+        self.max = np.full(channels, -np.inf, dtype=np.float64)
+
+    @property
+    def variance(self) -> np.ndarray:
+        return self.m2 / np.maximum(self.count, 1)
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.variance)
+
+    def _combine(self, channel: int, count: int, mean: float, m2: float) -> None:
+        if count == 0:
+            return
+        total = self.count[channel] + count
+        delta = mean - self.mean[channel]
+        self.mean[channel] += delta * count / total
+        self.m2[channel] += m2 + delta**2 * self.count[channel] * count / total
+        self.count[channel] = total
+
+    def update(self, values: np.ndarray) -> "Moments":
+        """Adds the given values to the statistics.
+
+        Args:
+            values (np.ndarray): array with format C x N (or C x anything), one row for each channel.
+
+        Returns:
+            Moments: the same instance, updated
+        """
+        values = values.reshape(self.count.shape[0], -1)
+        for channel, channel_values in enumerate(values):
+            channel_values = channel_values[np.isfinite(channel_values)].astype(np.float64)
+            if channel_values.size == 0:
+                continue
+            mean = channel_values.mean()
+            self._combine(channel, channel_values.size, mean, ((channel_values - mean)**2).sum())
+            self.min[channel] = min(self.min[channel], channel_values.min())
+            self.max[channel] = max(self.max[channel], channel_values.max())
+        return self
+
+    def merge(self, other: "Moments") -> "Moments":
+        assert self.count.shape == other.count.shape, "Cannot merge statistics with a different number of channels"
+        for channel in range(self.count.shape[0]):
+            self._combine(channel, other.count[channel], other.mean[channel], other.m2[channel])
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        return self
+
+    def to_dict(self) -> dict:
+        return dict(count=self.count.tolist(),
+                    mean=self.mean.tolist(),
+                    std=self.std.tolist(),
+                    min=self.min.tolist(),
+                    max=self.max.tolist())
+
+
+class QuantileSketch:
+    """Per-channel streaming quantiles, with fixed logarithmic bins: every value is counted in the bin
+    [gamma^(i-1), gamma^i) of its magnitude, so that estimates have a bounded relative error, whatever the range
+    of the channel (e.g. decibels and DEM alike). Memory only grows with the logarithm of the range,
+    sketches with the same accuracy can be merged. Values closer to zero than `min_value` count as zero,
+    non-finite values are ignored.
+    """
+    def __init__(self, channels: int, relative_accuracy: float = 0.01, min_value: float = 1e-9) -> None:
+        assert 0 < relative_accuracy < 1, f"Invalid relative accuracy: {relative_accuracy}"
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.min_value = min_value
+        self.positive = [Counter() for _ in range(channels)]
+        self.negative = [Counter() for _ in range(channels)]
+        self.zeros = np.zeros(channels, dtype=np.int64)
+
+    @property
+    def count(self) -> np.ndarray:
+        return np.array([
+            sum(pos.values()) + sum(neg.values()) + zeros
+            for pos, neg, zeros in zip(self.positive, self.negative, self.zeros)
+        ], dtype=np.int64)
+
+    def _add(self, counter: Counter, magnitudes: np.ndarray) -> None:
+        indices = np.ceil(np.log(magnitudes) / np.log(self.gamma)).astype(np.int64)
+        keys, counts = np.unique(indices, return_counts=True)
+        counter.update(dict(zip(keys.tolist(), counts.tolist())))
+
+    def update(self, values: np.ndarray) -> "QuantileSketch":
+        """Adds the given values to the sketch.
+
+        Args:
+            values (np.ndarray): array with format C x N (or C x anything), one row for each channel.
+
+        Returns:
+            QuantileSketch: the same instance, updated
+        """
+        values = values.reshape(self.zeros.shape[0], -1)
+        for channel, channel_values in enumerate(values):
+            channel_values = channel_values[np.isfinite(channel_values)].astype(np.float64)
+            positive = channel_values >= self.min_value
+            negative = channel_values <= -self.min_value
+            self._add(self.positive[channel], channel_values[positive])
+            self._add(self.negative[channel], -channel_values[negative])
+            self.zeros[channel] += channel_values.size - positive.sum() - negative.sum()
+        return self
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        assert self.zeros.shape == other.zeros.shape and self.gamma == other.gamma, \
+            "Cannot merge sketches with different channels or accuracy"
+        for channel in range(self.zeros.shape[0]):
+            self.positive[channel].update(other.positive[channel])
+            self.negative[channel].update(other.negative[channel])
+        self.zeros += other.zeros
+        return self
+
+    def quantile(self, q: Sequence[float]) -> np.ndarray:
+        """Estimates the given quantiles for each channel.
+
+        Args:
+            q (Sequence[float]): quantiles, between 0 and 1.
+
+        Returns:
+            np.ndarray: array with format C x len(q), NaN for empty channels
+        """
+        q = np.asarray(q, dtype=np.float64)
+        result = np.full((self.zeros.shape[0], q.size), np.nan)
+        for channel in range(self.zeros.shape[0]):
+            neg_keys = sorted(self.negative[channel], reverse=True)
+            pos_keys = sorted(self.positive[channel])
+            # bins in ascending order of value, each one represented by its (relative) midpoint
+            values = np.concatenate((-self._midpoints(neg_keys), [0.0], self._midpoints(pos_keys)))
+            counts = [self.negative[channel][k] for k in neg_keys]
+            counts += [self.zeros[channel]] + [self.positive[channel][k] for k in pos_keys]
+            counts = np.array(counts, dtype=np.int64)
+            total = counts.sum()
+            if total == 0:
+                continue
+            ranks = q * (total - 1)
+            result[channel] = values[np.searchsorted(np.cumsum(counts), ranks, side="right")]
+        return result
+
+    def _midpoints(self, keys: Sequence[int]) -> np.ndarray:
+        return 2 * self.gamma**np.asarray(keys, dtype=np.float64) / (self.gamma + 1)
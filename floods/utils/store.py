@@ -0,0 +1,296 @@
+import json
+import os
+import shutil
+from collections.abc import Sequence
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from floods.utils.common import check_or_make_dir
+
+INDEX_FILE = "index.npz"
+SHARDS_DIR = "shards"
+
+
+class PackedTileWriter:
+    """Appends the tiles of a single scene to raw, per-group shard files (one for SAR, DEM, mask...),
+    keeping a small list of records (tile id, size and geotransform) on the side.
+    Shards are independent, so that each scene can be written by a different process, then
+    `consolidate_shards` concatenates them into the final store.
+    Tiles are stored channels first and contiguously, a tile can also be written a block of rows at a time.
+    """
+    def __init__(self, path: Path, scene_id: str) -> None:
+        self.path = check_or_make_dir(Path(path) / SHARDS_DIR)
+        self.scene_id = scene_id
+        self.crs = None
+        self.records = list()
+        self.groups = dict()
+        self.files = dict()
+        self.pixels = 0
+
+    def __enter__(self) -> "PackedTileWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def add(self, tile_id: str, height: int, width: int, transform: Affine, crs: Optional[CRS] = None) -> None:
+        """Starts a new tile, that becomes the target of the next `write` calls.
+
+        Args:
+            tile_id (str): unique identifier of the tile, e.g. the name it would have as single file.
+            height (int): tile height in pixels.
+            width (int): tile width in pixels.
+            transform (Affine): geotransform of the tile.
+            crs (Optional[CRS], optional): coordinate reference system, the same for the whole scene.
+        """
+        crs = crs.to_string() if crs else None
+        assert self.crs is None or self.crs == crs, f"CRS mismatch in {self.scene_id}: {self.crs} != {crs}"
+        self.crs = crs
+        if self.records:
+            self.pixels += self.records[-1]["height"] * self.records[-1]["width"]
+        self.records.append(dict(tile=tile_id, height=height, width=width, transform=tuple(transform)[:6]))
+
+    def write(self, group: str, data: np.ndarray, row_offset: int = 0) -> None:
+        """Writes the given rows (channels first) of the current tile into the shard of the given group.
+
+        Args:
+            group (str): name of the data group (e.g. sar, dem, mask).
+            data (np.ndarray): array with format CxHxW, H can be smaller than the tile height.
+            row_offset (int, optional): index of the first given row inside the tile. Defaults to 0.
+        """
+        assert self.records, "Call 'add' before writing any tile"
+        assert data.ndim == 3, f"Expected a channels-first image, got shape: {data.shape}"
+        record = self.records[-1]
+        channels, rows, width = data.shape
+        assert width == record["width"] and row_offset + rows <= record["height"], \
+            f"Data with shape {data.shape} does not fit tile {record['tile']} at row {row_offset}"
+        if group not in self.files:
+            self.files[group] = open(self.path / f"{self.scene_id}.{group}.bin", "w+b")
+            self.groups[group] = dict(dtype=data.dtype.str, count=channels)
+        spec = self.groups[group]
+        assert spec["dtype"] == data.dtype.str and spec["count"] == channels, \
+            f"Group '{group}' expects {spec}, got {data.dtype.str} x {channels}"
+        # each channel of the tile is contiguous, seek to the given rows of every plane
+        plane = record["height"] * width
+        start = self.pixels * channels + row_offset * width
+        file = self.files[group]
+        for channel in range(channels):
+            file.seek((start + channel * plane) * data.dtype.itemsize)
+            file.write(np.ascontiguousarray(data[channel]).tobytes())
+
+    def close(self) -> None:
+        """Closes the shard files and stores the scene records, the shard is complete only after this call.
+        """
+        for file in self.files.values():
+            file.close()
+        self.files = dict()
+        target = self.path / f"{self.scene_id}.json"
+        with open(self.path / f"{self.scene_id}.json.tmp", "w", encoding="utf-8") as f:
+            json.dump(dict(scene=self.scene_id, crs=self.crs, groups=self.groups, tiles=self.records), f)
+        os.replace(self.path / f"{self.scene_id}.json.tmp", target)
+
+
+def _copy_range(src, dst, start: int, length: int, chunk_size: int = 1 << 24) -> None:
+    src.seek(start)
+    while length > 0:
+        chunk = src.read(min(chunk_size, length))
+        assert chunk, "Unexpected end of file while copying tiles"
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def consolidate_shards(path: Path, scene_ids: List[str]) -> int:
+    """Concatenates the shards of the given scenes, in order, into one raw file per group,
+    then stores the index and removes the shards. Scenes without a shard are copied from the
+    previous store in the same path, if any, so that only new or changed scenes need to be sharded.
+    Groups not available for every scene (e.g. weights computed on the previous tiles) are dropped.
+    The previous store is replaced only once the new one is complete.
+
+    Args:
+        path (Path): root of the packed store, containing the shards folder.
+        scene_ids (List[str]): scenes to be included, in the desired order.
+
+    Returns:
+        int: total number of tiles in the store
+    """
+    path = check_or_make_dir(path)
+    shards_path = path / SHARDS_DIR
+    previous = PackedTileStore(path) if (path / INDEX_FILE).exists() else None
+    scenes = list()
+    for scene_id in scene_ids:
+        shard_file = shards_path / f"{scene_id}.json"
+        if shard_file.exists():
+            with open(shard_file, "r", encoding="utf-8") as f:
+                scenes.append(json.load(f))
+        else:
+            assert previous is not None and scene_id in previous.scenes, f"Missing tiles for scene: {scene_id}"
+            scenes.append(previous.scene_record(scene_id))
+    groups = None
+    for scene in filter(lambda scene: scene["tiles"], scenes):
+        groups = {g: spec for g, spec in scene["groups"].items() if groups is None or g in groups}
+    groups = groups or dict()
+    for scene in filter(lambda scene: scene["tiles"], scenes):
+        for group, spec in groups.items():
+            assert scene["groups"][group] == spec, f"Group '{group}' mismatch: {scene['groups'][group]} != {spec}"
+    for group, spec in groups.items():
+        pixel_size = np.dtype(spec["dtype"]).itemsize * spec["count"]
+        with open(path / f"{group}.bin.tmp", "wb") as dst:
+            for scene in filter(lambda scene: scene["tiles"], scenes):
+                if "pixels" not in scene:
+                    with open(shards_path / f"{scene['scene']}.{group}.bin", "rb") as src:
+                        shutil.copyfileobj(src, dst)
+                    continue
+                with open(path / f"{group}.bin", "rb") as src:
+                    first, last = scene["pixels"]
+                    _copy_range(src, dst, start=first * pixel_size, length=(last - first) * pixel_size)
+    tiles = [(i, tile) for i, scene in enumerate(scenes) for tile in scene["tiles"]]
+    with open(path / f"{INDEX_FILE}.tmp", "wb") as f:
+        np.savez(f,
+                 tiles=np.array([tile["tile"] for _, tile in tiles], dtype=str),
+                 scene_index=np.array([i for i, _ in tiles], dtype=np.int64).reshape(-1),
+                 shapes=np.array([(tile["height"], tile["width"]) for _, tile in tiles], dtype=np.int64).reshape(-1, 2),
+                 transforms=np.array([tile["transform"] for _, tile in tiles], dtype=np.float64).reshape(-1, 6),
+                 scenes=np.array([scene["scene"] for scene in scenes], dtype=str),
+                 crs=np.array([scene["crs"] or "" for scene in scenes], dtype=str),
+                 groups=json.dumps(groups))
+    for group in groups:
+        os.replace(path / f"{group}.bin.tmp", path / f"{group}.bin")
+    os.replace(path / f"{INDEX_FILE}.tmp", path / INDEX_FILE)
+    for group in set(previous.groups if previous else []) - set(groups):
+        os.remove(path / f"{group}.bin")
+    if shards_path.exists():
+        shutil.rmtree(shards_path)
+    return len(tiles)
+
+
+class PackedTileStore:
+    """Read access to a consolidated store: every group is a single raw file, memory-mapped on first access
+    and sliced by offset, without opening any file per sample. Memory maps are not pickled, each process
+    (e.g. dataloader workers) opens its own on first access.
+    """
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        index_path = self.path / INDEX_FILE
+        assert index_path.exists(), f"Packed store index not found: {str(index_path)}"
+        with np.load(index_path) as index:
+            self.tiles = index["tiles"]
+            self.scene_index = index["scene_index"]
+            self.shapes = index["shapes"]
+            self.transforms = index["transforms"]
+            self.scenes = index["scenes"]
+            self.crs = index["crs"]
+            self.groups = json.loads(str(index["groups"]))
+        self.offsets = np.concatenate(([0], np.cumsum(self.shapes.prod(axis=1)))).astype(np.int64)
+        self._arrays = dict()
+
+    def __len__(self) -> int:
+        return len(self.tiles)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_arrays"] = dict()
+        return state
+
+    def has_group(self, group: str) -> bool:
+        return group in self.groups
+
+    def scene_record(self, scene_id: str) -> dict:
+        """Describes the tiles of the given scene, in the same format of the shard records,
+        plus the range of pixels they occupy in the store (tiles of a scene are contiguous).
+        """
+        scene_index = int(np.flatnonzero(self.scenes == scene_id)[0])
+        indices = np.flatnonzero(self.scene_index == scene_index)
+        tiles = [
+            dict(tile=str(self.tiles[i]), height=int(h), width=int(w), transform=tuple(self.transforms[i]))
+            for i, (h, w) in zip(indices, self.shapes[indices])
+        ]
+        pixels = (int(self.offsets[indices[0]]), int(self.offsets[indices[-1] + 1])) if len(indices) else (0, 0)
+        return dict(scene=scene_id, crs=str(self.crs[scene_index]) or None, groups=self.groups, tiles=tiles, pixels=pixels)
+
+    def _array(self, group: str) -> np.memmap:
+        if group not in self._arrays:
+            assert self.has_group(group), f"Group '{group}' not available in {str(self.path)}"
+            self._arrays[group] = np.memmap(self.path / f"{group}.bin", dtype=self.groups[group]["dtype"], mode="r")
+        return self._arrays[group]
+
+    def _range(self, index: int, group: str) -> tuple:
+        count = self.groups[group]["count"]
+        return self.offsets[index] * count, self.offsets[index + 1] * count
+
+    def read(self, index: int, group: str) -> np.ndarray:
+        """Returns the tile at the given index (channels first), as a read-only view on the memory map.
+        """
+        start, stop = self._range(index, group)
+        height, width = self.shapes[index]
+        return self._array(group)[start:stop].reshape(-1, height, width)
+
+    def transform(self, index: int) -> Affine:
+        return Affine(*self.transforms[index])
+
+    def add_group(self, group: str, dtype: Union[str, np.dtype], count: int = 1) -> None:
+        """Adds a new empty group to the store (e.g. weights computed after tiling), aligned with the existing
+        tiles and filled with zeros. Tiles can then be written in place using `write`.
+        """
+        dtype = np.dtype(dtype)
+        with open(self.path / f"{group}.bin", "wb") as f:
+            f.truncate(int(self.offsets[-1]) * count * dtype.itemsize)
+        self.groups[group] = dict(dtype=dtype.str, count=count)
+        self._arrays.pop(group, None)
+        with np.load(self.path / INDEX_FILE) as index:
+            arrays = dict(index)
+        arrays.update(groups=json.dumps(self.groups))
+        np.savez(self.path / INDEX_FILE, **arrays)
+
+    def write(self, index: int, group: str, data: np.ndarray) -> None:
+        """Overwrites the tile at the given index, data must match the group type and the tile shape.
+        """
+        spec = self.groups[group]
+        data = np.ascontiguousarray(data, dtype=spec["dtype"])
+        start, stop = self._range(index, group)
+        assert data.size == stop - start, f"Data size {data.size} does not match tile size {stop - start}"
+        with open(self.path / f"{group}.bin", "r+b") as f:
+            f.seek(start * data.dtype.itemsize)
+            f.write(data.tobytes())
+
+    def sequence(self, group: str, indices: np.ndarray = None) -> "TileSequence":
+        indices = np.arange(len(self)) if indices is None else indices
+        return TileSequence(self, group, indices)
+
+
+class TileSequence(Sequence):
+    """Lazy list-like view of a group in a packed store, each item is a tile array.
+    It can stand in for a list of tile files, items are read only when accessed.
+    """
+    def __init__(self, store: PackedTileStore, group: str, indices: np.ndarray) -> None:
+        self.store = store
+        self.group = group
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[np.ndarray, "TileSequence"]:
+        if isinstance(index, slice):
+            return TileSequence(self.store, self.group, self.indices[index])
+        return self.store.read(self.indices[index], self.group)
+
+    def shape(self, index: int) -> Tuple[int, int]:
+        height, width = self.store.shapes[self.indices[index]]
+        return int(height), int(width)
+
+    def read(self, index: int, window: Optional[Window] = None) -> np.ndarray:
+        """Reads the given tile, or only the given window of it (slicing the memory map touches only its rows).
+        """
+        tile = self[index]
+        return tile if window is None else tile[(slice(None), ) + window.toslices()]
+
+    def names(self) -> List[str]:
+        return [str(name) for name in self.store.tiles[self.indices]]
+
+    def select(self, mask: Union[List[bool], np.ndarray]) -> "TileSequence":
+        return TileSequence(self.store, self.group, self.indices[np.asarray(mask, dtype=bool)])
@@ -5,7 +5,7 @@ from typing import Callable, Generator, Iterable, Union
 import numpy as np
 import torch
 
-from floods.utils.tiling.functional import tile_fixed_overlap, tile_overlapped
+from floods.utils.tiling.functional import tile_fixed_overlap, tile_overlapped, tile_windows
 from floods.utils.tiling.smooth import predict_smooth_windowing
 
 
@@ -21,6 +21,11 @@ class Tiler(ABC):
     def __call__(self, image: np.ndarray) -> Generator[tuple, None, None]:
         return NotImplementedError("Implement in subclass")
 
+    def windows(self, height: int, width: int) -> Generator[tuple, None, None]:
+        """Plans the tile coordinates from the raster dimensions alone, without any pixel array.
+        """
+        raise NotImplementedError(f"{type(self).__name__} requires the full image")
+
 
 class SingleImageTiler(Tiler):
     """'Fake' tiling operator that returns the coordinates for the full image.
@@ -33,6 +38,9 @@ class SingleImageTiler(Tiler):
         if self.channels_first:
             image = np.moveaxis(image, 0, -1)
         height, width, _ = image.shape
+        return self.windows(height, width)
+
+    def windows(self, height: int, width: int) -> Generator[tuple, None, None]:
         yield (0, 0), (0, 0, height, width)
 
 
@@ -49,6 +57,9 @@ class DynamicOverlapTiler(Tiler):
                                overlap_threshold=self.overlap_threshold,
                                channels_first=self.channels_first)
 
+    def windows(self, height: int, width: int) -> Generator[tuple, None, None]:
+        return tile_windows(height, width, tile_size=self.tile_size, overlap_threshold=self.overlap_threshold)
+
 
 class MultiScaleTiler(DynamicOverlapTiler):
     def __init__(self, tile_size: Iterable[int], overlap_threshold: int, channels_first: bool = False) -> None:
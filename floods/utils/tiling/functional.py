@@ -1,39 +1,34 @@
 from pathlib import Path
-from typing import Generator, List, Optional, Union
+from typing import Generator, List, Optional, Sequence, Union
 
 import numpy as np
+from joblib import Parallel, delayed
 from tqdm import tqdm
 
+from floods.utils.catalog import binary_entropy
+from floods.utils.common import check_or_make_dir
 from floods.utils.gis import imread
-from floods.utils.ml import entropy
+from floods.utils.index import TileFiles
+from floods.utils.stacked import StackedSequence
+from floods.utils.store import TileSequence
 
 
-def tile_overlapped(image: np.ndarray,
-                    tile_size: Union[tuple, int],
-                    overlap_threshold: int,
-                    channels_first: bool = False) -> Generator[tuple, None, None]:
+def tile_windows(height: int,
+                 width: int,
+                 tile_size: Union[tuple, int],
+                 overlap_threshold: int) -> Generator[tuple, None, None]:
     """Generates a set of tiles with dynamically computed overlap, so that every tile is contained inside the image
-    bounds.
+    bounds. Only the raster dimensions are required, so that windows can be planned before reading any pixel.
 
     Args:
-        image (np.ndarray): input image to be tiled.
-        tile_size (Union[tuple, int], optional): size of the tile in pixels, assuming a square tile. Defaults to 256.
+        height (int): height of the image to be tiled.
+        width (int): width of the image to be tiled.
+        tile_size (Union[tuple, int], optional): size of the tile in pixels, assuming a square tile.
         overlap_threshold (int): if it overlaps for more tha X pixels, discard the second one
-        channels_first (bool, optional): whether the image has CxHxW format or HxWxC. Defaults to False.
-
-    Raises:
-        ValueError: when the image is smaller than a single tile
 
     Returns:
         Generator[int, int, int, int]: x, y coordinates with x and y offsets to crop windows
     """
-    if len(image.shape) == 2:
-        axis = 0 if channels_first else -1
-        image = np.expand_dims(image, axis=axis)
-    if channels_first:
-        image = np.moveaxis(image, 0, -1)
-    # assume height, width, channels from now on
-    height, width, channels = image.shape
     tile_h, tile_w = tile_size if isinstance(tile_size, tuple) else (tile_size, tile_size)
     # if the image is too short, pad with ignored
     if height <= tile_h or width <= tile_w:
@@ -76,6 +71,35 @@ def tile_overlapped(image: np.ndarray,
             yield (row, col), (x, y, x + tile_h, y + tile_h)
 
 
+def tile_overlapped(image: np.ndarray,
+                    tile_size: Union[tuple, int],
+                    overlap_threshold: int,
+                    channels_first: bool = False) -> Generator[tuple, None, None]:
+    """Generates a set of tiles with dynamically computed overlap, so that every tile is contained inside the image
+    bounds.
+
+    Args:
+        image (np.ndarray): input image to be tiled.
+        tile_size (Union[tuple, int], optional): size of the tile in pixels, assuming a square tile. Defaults to 256.
+        overlap_threshold (int): if it overlaps for more tha X pixels, discard the second one
+        channels_first (bool, optional): whether the image has CxHxW format or HxWxC. Defaults to False.
+
+    Raises:
+        ValueError: when the image is smaller than a single tile
+
+    Returns:
+        Generator[int, int, int, int]: x, y coordinates with x and y offsets to crop windows
+    """
+    if len(image.shape) == 2:
+        axis = 0 if channels_first else -1
+        image = np.expand_dims(image, axis=axis)
+    if channels_first:
+        image = np.moveaxis(image, 0, -1)
+    # assume height, width, channels from now on
+    height, width, _ = image.shape
+    return tile_windows(height, width, tile_size=tile_size, overlap_threshold=overlap_threshold)
+
+
 def tile_fixed_overlap(image: np.ndarray,
                        tile_size: Union[tuple, int],
                        overlap: int,
@@ -112,83 +136,173 @@ def tile_body_water_ratio(image: np.ndarray, label_index: int = 1, smoothing: Op
     nan_filtered = image.flat
     nan_filtered = nan_filtered[~np.isnan(nan_filtered)]
     # get the total amount of flooded pixels and divide by the total valid amount of pixels
-    _, unique_counts = np.unique(nan_filtered, return_counts=True)
-    if len(unique_counts) < 2:
-        unique_counts = (0, 0)
-    flood_pixels = unique_counts[label_index]
+    flood_pixels = np.count_nonzero(nan_filtered == label_index)
     factor = smoothing * len(nan_filtered)
     return (flood_pixels + factor) / (len(nan_filtered) + factor)
 
 
-def mask_body_ratio_from_threshold(labels: List[Path], ratio_threshold: float, label: str,
-                                   cache_hash: str) -> np.ndarray:
+def _read_label(label: Union[str, Path, np.ndarray]) -> np.ndarray:
+    # labels may be stored as single files, or provided as arrays (e.g. from a packed store)
+    return label if isinstance(label, np.ndarray) else imread(label)
+
+
+LABEL_SCAN_DTYPE = np.dtype([("pixels", np.int64), ("background", np.int64), ("flood", np.int64),
+                             ("ignored", np.int64), ("ratio", np.float64), ("entropy", np.float64)])
+
+
+def _scan_batch(labels: Sequence[Union[Path, np.ndarray]], label_index: int = 1, ignore_index: int = 255) -> np.ndarray:
+    """Reads each label once and counts its classes with a single bincount, executed by each worker.
     """
-    Returns a binary mask with the images having a body water ratio above the threshold.
+    result = np.zeros(len(labels), dtype=LABEL_SCAN_DTYPE)
+    for i, label in enumerate(labels):
+        values = _read_label(label).ravel()
+        if np.issubdtype(values.dtype, np.floating):
+            values = values[~np.isnan(values)]
+        counts = np.bincount(values.astype(np.int64), minlength=max(label_index, ignore_index) + 1)
+        result[i]["pixels"] = values.size
+        result[i]["background"] = counts[0]
+        result[i]["flood"] = counts[label_index]
+        result[i]["ignored"] = counts[ignore_index]
+    # same definitions of `tile_body_water_ratio` and `utils.ml.entropy` (ignored pixels count as background)
+    ratio = result["flood"] / np.maximum(result["pixels"], 1)
+    result["ratio"] = ratio
+    result["entropy"] = binary_entropy(ratio)
+    return result
+
+
+def _label_keys(labels: Sequence[Union[Path, np.ndarray]]) -> Optional[List[str]]:
+    # tiles of packed stores are identified by name, files by path, plain arrays cannot be cached
+    if isinstance(labels, TileSequence):
+        return labels.names()
+    if isinstance(labels, (TileFiles, StackedSequence)):
+        return labels.paths()
+    if any(isinstance(label, np.ndarray) for label in labels):
+        return None
+    return [str(label) for label in labels]
+
+
+def scan_labels(labels: Sequence[Union[Path, np.ndarray]],
+                workers: int = 1,
+                batch_size: int = 256,
+                cache_file: Optional[Path] = None) -> np.ndarray:
+    """Reads every label once, in parallel, and computes pixel counts, flooded ratio and entropy together.
+    Results are cached when a file is given: later scans of the same labels, or of a subset of them
+    (e.g. after filtering the dataset), are served from the cache without reading anything.
+
+    Args:
+        labels (Sequence[Union[Path, np.ndarray]]): list of files containing the masks, or the masks themselves
+        workers (int, optional): number of parallel processes. Defaults to 1.
+        batch_size (int, optional): number of labels read by each job. Defaults to 256.
+        cache_file (Optional[Path], optional): npz file where results are stored. Defaults to None.
+
+    Returns:
+        np.ndarray: structured array (see `LABEL_SCAN_DTYPE`), one record for each label, in the same order
     """
-    # for each mask in the path read the image array and get the tile body water ratio
     assert len(labels) > 0, "No masks found in the path"
-    target_file = Path("data/cache") / f"mask_{label}_{cache_hash}.npy"
-
-    # early out if the mask array has been cached already
-    if target_file.exists() and target_file.is_file():
-        mask = np.load(str(target_file))
-        _, counts = np.unique(mask, return_counts=True)
-        return mask, counts
-
-    # create the list for filtering the elements, set to zero by default
-    mask = np.zeros(len(labels), dtype=bool)
-    for i, label_path in enumerate(tqdm(labels)):
-        # 1. read the image
-        # 2. get the body water ratio
-        # 3. if the ratio is above the threshold, set the mask to 1, meaning use the image
-        image = imread(label_path)
-        ratio = tile_body_water_ratio(image)
-        mask[i] = ratio >= ratio_threshold
+    keys = _label_keys(labels)
+    if cache_file is not None and keys is not None and Path(cache_file).is_file():
+        with np.load(str(cache_file), allow_pickle=False) as cache:
+            index = {key: i for i, key in enumerate(cache["keys"])}
+            if all(key in index for key in keys):
+                return cache["scan"][[index[key] for key in keys]]
+
+    batches = [labels[i:i + batch_size] for i in range(0, len(labels), batch_size)]
+    results = list()
+    with tqdm(total=len(labels)) as progress:
+        for result in Parallel(n_jobs=workers, return_as="generator")(delayed(_scan_batch)(b) for b in batches):
+            results.append(result)
+            progress.update(len(result))
+    scan = np.concatenate(results)
+
+    if cache_file is not None and keys is not None:
+        check_or_make_dir(Path(cache_file).parent)
+        with open(cache_file, "wb") as f:
+            np.savez(f, keys=np.array(keys, dtype=str), scan=scan)
+    return scan
 
+
+def body_ratio(scan: np.ndarray, smoothing: Optional[float] = 0.0) -> np.ndarray:
+    """Flooded ratio of each scanned label, with a smoothing factor (same as `tile_body_water_ratio`).
+    """
+    assert smoothing >= 0 and smoothing <= 1, "Smoothing factor out of range"
+    factor = smoothing * scan["pixels"]
+    return (scan["flood"] + factor) / np.maximum(scan["pixels"] + factor, 1)
+
+
+def label_scan_cache(label: str, cache_hash: str) -> Path:
+    return Path("data/cache") / f"labels_{label}_{cache_hash}.npz"
+
+
+def mask_body_ratio_from_threshold(labels: Sequence[Union[Path, np.ndarray]],
+                                   ratio_threshold: float,
+                                   label: str,
+                                   cache_hash: str,
+                                   workers: int = 1) -> np.ndarray:
+    """
+    Returns a binary mask with the images having a body water ratio above the threshold.
+    """
+    # the scan of the labels is cached, and shared with the sampling weights
+    scan = scan_labels(labels, workers=workers, cache_file=label_scan_cache(label, cache_hash))
+    mask = scan["ratio"] >= ratio_threshold
     _, counts = np.unique(mask, return_counts=True)
-    # save a cache file of the mask for future usage
-    np.save(str(target_file), mask)
     return mask, counts
 
 
-def weights_from_body_ratio(labels: List[Path], normalize: bool = True, smoothing: Optional[float] = 1.0) -> np.ndarray:
+def weights_from_body_ratio(labels: Sequence[Union[Path, np.ndarray]],
+                            normalize: bool = True,
+                            smoothing: Optional[float] = 1.0,
+                            workers: int = 1,
+                            cache_file: Optional[Path] = None) -> np.ndarray:
     """Computes sample weights from the body/water ratio (direct proportionality).
 
     Args:
-        labels (List[Path]): list of files containing the masks
+        labels (Sequence[Union[Path, np.ndarray]]): list of files containing the masks, or the masks themselves
         normalize (bool, optional): whether to normalize outputs or not. Defaults to True.
         smoothing (Optional[float], optional): A factor to smooth out probabilities. Defaults to 1.0.
+        workers (int, optional): number of parallel processes reading the labels. Defaults to 1.
+        cache_file (Optional[Path], optional): optional cache of the label scan. Defaults to None.
 
     Returns:
         np.ndarray: array containing floats, one for each sample, to be used in importance sampling
     """
     # first compute raw flooded coverage in terms of pixels for each tile
     # then normalize them if required
-    weights = np.zeros(len(labels), dtype=np.float32)
-    for i, label_path in enumerate(tqdm(labels)):
-        image = imread(label_path)
-        weights[i] = tile_body_water_ratio(image, smoothing=smoothing)
+    scan = scan_labels(labels, workers=workers, cache_file=cache_file)
+    weights = body_ratio(scan, smoothing=smoothing).astype(np.float32)
     if normalize:
         weights /= weights.max()
     return weights
 
 
-def entropy_weights(labels: List[Path], smoothing: float = 0.8) -> np.ndarray:
+def entropy_weights(labels: Sequence[Union[Path, np.ndarray]],
+                    smoothing: float = 0.8,
+                    workers: int = 1,
+                    cache_file: Optional[Path] = None) -> np.ndarray:
     """Computes the entropy from the given list of labels (binary labels).
 
     Args:
-        labels (List[Path]): list of filenames to be read
+        labels (Sequence[Union[Path, np.ndarray]]): list of filenames to be read, or the masks themselves
         smoothing (float, optional): Value to smooth out the final array. Defaults to 0.8.
+        workers (int, optional): number of parallel processes reading the labels. Defaults to 1.
+        cache_file (Optional[Path], optional): optional cache of the label scan. Defaults to None.
 
     Returns:
         np.ndarray: array of smoothed entropy values (max = 1.0, min = 0.0)
     """
+    scan = scan_labels(labels, workers=workers, cache_file=cache_file)
+    return smooth_weights(scan["entropy"], smoothing=smoothing)
+
+
+def smooth_weights(values: np.ndarray, smoothing: float = 0.8) -> np.ndarray:
+    """Smooths out sampling weights between 0 and 1, so that every sample keeps a minimum probability.
+
+    Args:
+        values (np.ndarray): raw weights, e.g. label entropies.
+        smoothing (float, optional): Value to smooth out the final array. Defaults to 0.8.
+
+    Returns:
+        np.ndarray: array of smoothed values (max = 1.0, min = 0.0)
+    """
     assert smoothing <= 1, "Smooth factor must be between 0 and 1"
     minval = 1.0 - smoothing
-    entropies = list()
-    for label_path in tqdm(labels):
-        label = imread(label_path)
-        entropies.append(entropy(label))
-
-    entropies = np.array(entropies)
-    return np.clip(entropies * smoothing + minval, 0, 1)
+    return np.clip(values * smoothing + minval, 0, 1)
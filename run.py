@@ -16,7 +16,6 @@ def preprocess(config: PreparationConfig):
 
 @cli.command()
 def stats(config: StatsConfig):
-    # TODO: fix compute
     return preproc.compute_statistics(config=config)
 
 
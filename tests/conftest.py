@@ -1,8 +1,15 @@
+import json
 import os
 from pathlib import Path
 
+import numpy as np
 import pytest
+import rasterio
 from dotenv import load_dotenv
+from rasterio.transform import from_origin
+
+from floods.config.preproc import PreparationConfig
+from floods.preproc import preprocess_data
 
 load_dotenv()
 
@@ -16,3 +23,58 @@ def get_env(name: str) -> str:
 @pytest.fixture(scope="session")
 def dataset_path():
     return Path(get_env("DATA_PROCESSED"))
+
+
+def write_raster(path: Path, data: np.ndarray) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    profile = dict(driver="GTiff",
+                   height=data.shape[1],
+                   width=data.shape[2],
+                   count=data.shape[0],
+                   dtype=data.dtype,
+                   crs="EPSG:4326",
+                   transform=from_origin(10.0, 45.0, 1e-4, 1e-4))
+    with rasterio.open(str(path), "w", **profile) as dst:
+        dst.write(data)
+
+
+def make_config(root: Path, **kwargs) -> PreparationConfig:
+    return PreparationConfig(data_source=root / "source",
+                             data_processed=root / "processed",
+                             summary_file=str(root / "summary.json"),
+                             tile_size=256,
+                             tile_max_overlap=200,
+                             **kwargs)
+
+
+@pytest.fixture
+def source_path(tmp_path: Path):
+    """Generates a tiny fake EMSR archive, with one scene per subset and some missing data.
+    """
+    rng = np.random.default_rng(42)
+    summary = dict()
+    for code, subset, (height, width) in [("EMSR001", "train", (700, 900)), ("EMSR002", "val", (600, 640)),
+                                          ("EMSR003", "test", (300, 400))]:
+        image_id = f"{code}-0"
+        sar = rng.random((2, height, width), dtype=np.float32)
+        sar[:, :, :300] = np.nan
+        dem = rng.random((1, height, width), dtype=np.float32) * 1000
+        mask = (rng.random((1, height, width)) > 0.7).astype(np.uint8)
+        write_raster(tmp_path / "source" / code / "s1_raw" / f"{image_id}.tif", sar)
+        write_raster(tmp_path / "source" / code / "DEM" / f"{image_id}.tif", dem)
+        write_raster(tmp_path / "source" / code / "mask" / f"{image_id}.tif", mask)
+        summary[code] = dict(subset=subset)
+    with open(tmp_path / "summary.json", "w") as f:
+        json.dump(summary, f)
+    return tmp_path
+
+
+@pytest.fixture
+def preprocessed(source_path: Path):
+    """Preprocesses the fake archive with the given options (e.g. output format), returns the processed folder.
+    """
+    def preprocess(**kwargs) -> Path:
+        preprocess_data(make_config(source_path, **kwargs))
+        return source_path / "processed"
+
+    return preprocess
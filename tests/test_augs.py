@@ -1,3 +1,75 @@
+import pickle
+from pathlib import Path
+
+import albumentations as alb
+import numpy as np
+import torch
+from albumentations.pytorch import ToTensorV2
+
+from floods.transforms import BankElasticTransform, BatchAugmentation, ClipNormalize, DeviceNormalize, ToHalf
+from floods.utils.fields import DisplacementBank
+
+
+def test_device_normalize():
+    rng = np.random.default_rng(42)
+    stats = dict(mean=(0.5, 0.5, 500), std=(0.3, 0.3, 300), clip_min=(-3, -3, -1), clip_max=3)
+    images = [np.dstack((rng.random((64, 64, 2)), rng.random((64, 64, 1)) * 1000)).astype(np.float32) for _ in range(4)]
+    normalize = alb.Compose([ClipNormalize(**stats), ToTensorV2()])
+    raw = alb.Compose([ToHalf(), ToTensorV2()])
+    # workers emit half precision images, half the bytes of float32 images
+    batch = torch.stack([raw(image=image)["image"] for image in images])
+    assert batch.dtype == torch.float16
+    expected = torch.stack([normalize(image=image)["image"] for image in images]).float()
+    normalized = DeviceNormalize(**stats)(batch)
+    assert normalized.dtype == torch.float32 and normalized.shape == expected.shape
+    # same values, up to the half precision rounding of the raw images
+    torch.testing.assert_close(normalized, expected, atol=0.02, rtol=0.01)
+    assert normalized[:, 2].min() >= -1
+
+
+def test_batch_augmentation():
+    torch.manual_seed(42)
+    labels = (torch.rand(8, 32, 32) > 0.5).to(torch.uint8)
+    labels[:, :4] = 255
+    images = torch.stack((labels.float(), torch.rand(8, 32, 32), torch.rand(8, 32, 32)), dim=1).half()
+    # without augmentations, batches are left untouched
+    identity = BatchAugmentation(crop_p=0, flip_p=0, rotate_p=0, sar_p=0, elastic_p=0, grid_p=0)
+    result, result_labels = identity(images, labels)
+    torch.testing.assert_close(result, images.float())
+    assert torch.equal(result_labels, labels)
+    # flips and rotations move images and labels together, without interpolation
+    geometric = BatchAugmentation(crop_p=0, flip_p=0.5, rotate_p=0.5, sar_p=0, elastic_p=0, grid_p=0)
+    result, result_labels = geometric(images, labels)
+    assert result_labels.dtype == torch.uint8
+    assert torch.equal(result[:, 0], result_labels.float())
+    # the whole pipeline keeps the label values (nearest sampling)
+    augmented, augmented_labels = BatchAugmentation(sar_channels=2)(images, labels)
+    assert augmented.shape == images.shape and augmented.dtype == torch.float32
+    assert set(augmented_labels.unique().tolist()) <= {0, 1, 255}
+
+
+def test_elastic_bank(tmp_path: Path):
+    bank = DisplacementBank(64, count=4, sigma=8, path=tmp_path)
+    fields = np.array(bank.fields)
+    assert fields.shape == (4, 2, 64, 64) and not bank.fields.flags.writeable
+    # generated once, then mapped by any other process (maps are not pickled)
+    restored = pickle.loads(pickle.dumps(DisplacementBank(64, count=4, sigma=8, path=tmp_path)))
+    assert restored._fields is None
+    np.testing.assert_array_equal(restored.fields, fields)
+    # rolled and flipped fields, of any size, keep the amplitude of the bank
+    dx, dy = bank.sample(48, 80)
+    assert dx.shape == dy.shape == (48, 80) and np.abs(dx).max() <= np.abs(fields).max()
+    image = np.random.rand(64, 64, 3).astype(np.float32)
+    mask = (np.random.rand(64, 64) > 0.5).astype(np.uint8)
+    # without affine and displacements, the single remap is the identity
+    identity = BankElasticTransform(bank, alpha=0, alpha_affine=0, always_apply=True)(image=image, mask=mask)
+    np.testing.assert_allclose(identity["image"], image, atol=1e-6)
+    np.testing.assert_array_equal(identity["mask"], mask)
+    result = BankElasticTransform(bank, alpha=50, always_apply=True)(image=image, mask=mask)
+    assert result["image"].shape == image.shape and result["mask"].dtype == np.uint8
+    assert set(np.unique(result["mask"])) <= {0, 1}
+
+
 # def test_modality_dropout(potsdam_path: Path):
 #     # instantiate transforms for training
 #     seed_everything(1337)
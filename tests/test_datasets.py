@@ -1,15 +1,33 @@
 import logging
+import random
+from glob import glob
 from pathlib import Path
+from typing import Callable
 
+import albumentations as alb
 import numpy as np
+import pytest
+import rasterio
 import seaborn as sns
 import torch
+from albumentations.pytorch import ToTensorV2
 from matplotlib import pyplot as plt
 from plotille import histogram
+from torch.utils.data import DataLoader
 from tqdm.contrib.logging import logging_redirect_tqdm
 
-from floods.datasets.flood import FloodDataset
-from floods.utils.tiling.functional import weights_from_body_ratio
+from floods.config.preproc import Compression, TileFormat
+from floods.datasets.flood import FloodDataset, SceneCropDataset, TensorCacheDataset, WeightedFloodDataset
+from floods.preproc import DEM_SCALE, generate_pseudolabels, processing_functions
+from floods.transforms import ClipNormalize, RandomCropWindow
+from floods.utils.cache import SharedTileCache, pack_mask, unpack_mask
+from floods.utils.gis import imread
+from floods.utils.index import FILES_INDEX, index_tiles
+from floods.utils.ml import entropy
+from floods.utils.stacked import StackedSequence
+from floods.utils.tiling.functional import (entropy_weights, scan_labels, tile_body_water_ratio,
+                                            weights_from_body_ratio)
+from tests.conftest import make_config
 
 LOG = logging.getLogger(__name__)
 
@@ -47,3 +65,241 @@ def test_weighted_sampler(dataset_path: Path):
         sns.histplot(weights1, bins=100, color="g")
         sns.histplot(weights2, bins=100, color="b")
         plt.savefig("result.png")
+
+
+def test_scan_labels(source_path: Path, preprocessed: Callable):
+    preprocessed(scale=[1, 2])
+    processed = preprocessed(scale=[1, 2], output_format=TileFormat.packed)
+    files = FloodDataset(processed, subset="train")
+    cache_file = source_path / "cache" / "labels.npz"
+    scan = scan_labels(files.label_files, workers=2, batch_size=4, cache_file=cache_file)
+    labels = [imread(path) for path in files.label_files]
+    np.testing.assert_allclose(scan["ratio"], [tile_body_water_ratio(label) for label in labels])
+    np.testing.assert_allclose(scan["entropy"], [entropy(label) for label in labels], atol=1e-12)
+    np.testing.assert_allclose(weights_from_body_ratio(labels, normalize=False, smoothing=0.3),
+                               [tile_body_water_ratio(label, smoothing=0.3) for label in labels],
+                               rtol=1e-6)
+    # same results from the packed store, in its own order
+    packed = FloodDataset(processed, subset="train", packed=True)
+    order = [files.label_files.index(str(processed / "train" / "mask" / f"{name}.tif"))
+             for name in packed.label_files.names()]
+    np.testing.assert_array_equal(scan_labels(packed.label_files, batch_size=4), scan[order])
+    # subsets of the cached labels are served from the cache, without reading them again
+    subset = files.label_files[::2]
+    for path in files.label_files:
+        Path(path).unlink()
+    np.testing.assert_array_equal(entropy_weights(subset, smoothing=1.0, cache_file=cache_file), scan["entropy"][::2])
+
+
+def test_crop_window(preprocessed: Callable):
+    preprocessed()
+    preprocessed(output_format=TileFormat.packed)
+    processed = preprocessed(output_format=TileFormat.virtual)
+    crop = RandomCropWindow(min_max_height=(64, 128), height=128, width=128)
+    files = FloodDataset(processed, subset="train", include_dem=True)
+    datasets = [
+        FloodDataset(processed, subset="train", include_dem=True, transform_crop=crop, **kwargs)
+        for kwargs in (dict(), dict(packed=True), dict(virtual=True))
+    ]
+    for index in range(len(files)):
+        random.seed(index)
+        window = crop(256, 256)
+        rows, cols = window.toslices()
+        # only the window is read, with the same pixels of the full tile
+        image, label = files[index]
+        reference = crop.resize(image=image[rows, cols], mask=label[rows, cols])
+        for dataset in datasets:
+            random.seed(index)
+            crop_image, crop_label = dataset[index]
+            assert crop_image.shape == (128, 128, 3) and crop_label.shape == (128, 128)
+            np.testing.assert_array_equal(crop_image, reference["image"])
+            np.testing.assert_array_equal(crop_label, reference["mask"])
+
+
+def test_scene_crops(source_path: Path, preprocessed: Callable):
+    preprocessed(subset=["train"], output_format=TileFormat.virtual)
+    sar_process, dem_process, morph = processing_functions()
+    kwargs = dict(summary_file=source_path / "summary.json",
+                  include_dem=True,
+                  crop_size=128,
+                  scales=[1, 2],
+                  crops_per_epoch=12,
+                  nan_threshold=0.5,
+                  halo=5,
+                  sar_process=sar_process,
+                  dem_process=dem_process,
+                  msk_process=morph,
+                  seed=42)
+    dataset = SceneCropDataset(source_path / "source", **kwargs)
+    samples = list(dataset)
+    assert len(samples) == 12
+    for image, label in samples:
+        assert image.shape == (128, 128, 3) and label.shape == (128, 128)
+        assert not np.isnan(image).any()
+        assert np.count_nonzero(label == 255) / label.size < 0.5
+    # a new epoch draws different crops, the same seed draws the same sequence
+    assert any((a[0] != b[0]).any() for a, b in zip(samples, dataset))
+    np.testing.assert_array_equal(samples[0][0], next(iter(SceneCropDataset(source_path / "source", **kwargs)))[0])
+    # crops at full scale match the processed scene
+    scenes = source_path / "processed" / "train" / "scenes"
+    datasets = {group: rasterio.open(str(dataset.scenes[0][group])) for group in ("sar", "dem", "mask")}
+    crops, invalid = dataset.read_crop(datasets, scale=1, row=300, col=500)
+    window = rasterio.windows.Window(500, 300, 128, 128)
+    np.testing.assert_allclose(np.where(invalid, 0, crops["sar"]), imread(scenes / "sar" / "EMSR001-0.tif", window=window))
+    np.testing.assert_array_equal(np.where(invalid, 255, crops["mask"]),
+                                  imread(scenes / "mask" / "EMSR001-0.tif", window=window))
+    for src in datasets.values():
+        src.close()
+    # each worker draws its own share of crops
+    loader = DataLoader(dataset, batch_size=None, num_workers=2)
+    assert len(list(loader)) == 12
+
+
+def test_tile_cache(source_path: Path, preprocessed: Callable):
+    preprocessed(subset=["train"])
+    processed = preprocessed(subset=["train"], output_format=TileFormat.virtual)
+    files = FloodDataset(processed, subset="train", include_dem=True)
+    for virtual in (False, True):
+        cache = SharedTileCache(source_path / f"cache_{virtual}", max_bytes=2**30)
+        cached = FloodDataset(processed, subset="train", include_dem=True, virtual=virtual, cache=cache)
+        # decoded once, then served from the cache, with the same values
+        for _ in range(2):
+            for index in range(len(files)):
+                for expected, actual in zip(files[index], cached[index]):
+                    np.testing.assert_array_equal(expected, actual)
+        stats = cache.stats()
+        assert stats["misses"] == stats["entries"] == len(files) * 3
+        assert stats["hits"] == len(files) * 3
+    # the least recently used entries are evicted when the budget is exceeded
+    tile_bytes = 256 * 256 * 4
+    cache = SharedTileCache(source_path / "cache_small", max_bytes=tile_bytes * 4, check_every=0.01)
+    for i in range(8):
+        cache.put(str(i), np.full((1, 256, 256), i, dtype=np.float32))
+    assert cache.get("7") is not None and cache.get("0") is None
+    assert cache.stats()["bytes"] <= tile_bytes * 4
+
+
+def test_eval_tensor_cache(source_path: Path, preprocessed: Callable):
+    processed = preprocessed(subset=["val"], output_format=TileFormat.packed)
+    normalize = alb.Compose([ClipNormalize(mean=(0.5, 0.5, 500), std=(0.3, 0.3, 300), clip_min=-3, clip_max=3),
+                             ToTensorV2()])
+    dataset = FloodDataset(processed, subset="val", include_dem=True, packed=True, normalization=normalize)
+    cached = TensorCacheDataset(dataset, path=source_path / "cache", workers=2)
+    assert len(cached) == len(dataset)
+    for index in range(len(dataset)):
+        for expected, actual in zip(dataset[index], cached[index]):
+            assert expected.dtype == actual.dtype
+            torch.testing.assert_close(expected, actual)
+    # reused as long as tiles and transforms are the same
+    mtime = cached.image_path.stat().st_mtime_ns
+    assert TensorCacheDataset(dataset, path=source_path / "cache").image_path.stat().st_mtime_ns == mtime
+    dataset.normalization = alb.Compose([ClipNormalize(mean=(0.5, 0.5, 500), std=(0.3, 0.3, 300), clip_min=-2,
+                                                       clip_max=2), ToTensorV2()])
+    assert TensorCacheDataset(dataset, path=source_path / "cache").image_path != cached.image_path
+    # samples are served to workers from their own memory maps
+    batches = list(DataLoader(cached, batch_size=2, num_workers=2))
+    assert sum(len(labels) for _, labels in batches) == len(dataset)
+
+
+def test_packed_dataset(preprocessed: Callable):
+    preprocessed(scale=[1, 2])
+    processed = preprocessed(scale=[1, 2], output_format=TileFormat.packed)
+    # the dataset serves the same samples, regardless of the backend
+    files = FloodDataset(processed, subset="train", include_dem=True)
+    packed = FloodDataset(processed, subset="train", include_dem=True, packed=True)
+    assert len(files) == len(packed)
+    order = {name: index for index, name in enumerate(packed.image_files.names())}
+    for index, path in enumerate(files.image_files):
+        image, label = files[index]
+        packed_image, packed_label = packed[order[Path(path).stem]]
+        np.testing.assert_array_equal(image, packed_image)
+        np.testing.assert_array_equal(label, packed_label)
+
+
+def test_virtual_dataset(preprocessed: Callable):
+    preprocessed(scale=[1, 2])
+    processed = preprocessed(scale=[1, 2], output_format=TileFormat.virtual)
+    for subset in ("train", "val", "test"):
+        # the same samples, read as windows of the processed scenes
+        files = FloodDataset(processed, subset=subset, include_dem=True)
+        virtual = FloodDataset(processed, subset=subset, include_dem=True, virtual=True)
+        assert [Path(path).stem for path in files.image_files] == virtual.image_files.names()
+        for index in range(len(files)):
+            image, label = files[index]
+            virtual_image, virtual_label = virtual[index]
+            np.testing.assert_array_equal(image, virtual_image)
+            np.testing.assert_array_equal(label, virtual_label)
+
+
+def test_tile_index(preprocessed: Callable):
+    processed = preprocessed(subset=["train"], scale=[1, 2])
+    subset = processed / "train"
+    dataset = FloodDataset(processed, subset="train", include_dem=True)
+    assert list(dataset.image_files) == sorted(glob(str(subset / "sar" / "*.tif")))
+    assert list(dataset.dem_files) == sorted(glob(str(subset / "dem" / "*.tif")))
+    assert (subset / FILES_INDEX).exists()
+    # the index is reused while the folders are unchanged, then scanned and checked again
+    np.testing.assert_array_equal(index_tiles(subset, groups=["sar", "mask"])["sar"], dataset.image_files.names())
+    dataset.add_mask([i % 2 == 0 for i in range(len(dataset))])
+    assert list(dataset.label_files) == sorted(glob(str(subset / "mask" / "*.tif")))[::2]
+    Path(dataset.label_files[0]).unlink()
+    with pytest.raises(AssertionError):
+        FloodDataset(processed, subset="train")
+
+
+def test_stacked_dataset(source_path: Path, preprocessed: Callable):
+    processed = preprocessed(subset=["train"])
+    generate_pseudolabels(make_config(source_path, denoiser="box"))
+    files = WeightedFloodDataset(processed, subset="train", include_dem=True)
+    samples = [files[index] for index in range(len(files))]
+    names = [Path(path).stem for path in files.image_files]
+    # stacked tiles are picked up by the datasets transparently, with the same samples and weights
+    preprocessed(subset=["train"], output_format=TileFormat.stacked)
+    generate_pseudolabels(make_config(source_path, denoiser="box", output_format=TileFormat.stacked))
+    stacked = WeightedFloodDataset(processed, subset="train", include_dem=True)
+    assert isinstance(stacked.image_files, StackedSequence) and stacked.image_files.names() == names
+    assert list(stacked.image_files.roles) == ["sar", "dem", "mask", "weight"]
+    for index, (image, label, weight) in enumerate(samples):
+        stacked_image, stacked_label, stacked_weight = stacked[index]
+        np.testing.assert_array_equal(image, stacked_image)
+        np.testing.assert_array_equal(label, stacked_label)
+        np.testing.assert_array_equal(weight, stacked_weight)
+
+
+def test_compact_dataset(source_path: Path, preprocessed: Callable):
+    subsets = ("train", "test")
+    processed = preprocessed(subset=list(subsets))
+    reference = {subset: FloodDataset(processed, subset=subset, include_dem=True) for subset in subsets}
+    samples = {subset: [dataset[i] for i in range(len(dataset))] for subset, dataset in reference.items()}
+    preprocessed(subset=list(subsets), compact_tiles=True, compression=Compression.zstd)
+    # half precision SAR, DEM within half a step, identical masks, with or without the cache
+    cache = SharedTileCache(source_path / "cache", max_bytes=2**30)
+    for subset in subsets:
+        for dataset in (FloodDataset(processed, subset=subset, include_dem=True),
+                        FloodDataset(processed, subset=subset, include_dem=True, cache=cache)):
+            for _ in range(2):
+                for (image, label), (compact_image, compact_label) in zip(samples[subset], dataset):
+                    assert compact_image.dtype == np.float32
+                    np.testing.assert_array_equal(image[..., :2].astype(np.float16), compact_image[..., :2])
+                    np.testing.assert_allclose(image[..., 2], compact_image[..., 2], atol=DEM_SCALE / 2)
+                    np.testing.assert_array_equal(label, compact_label)
+    # cached masks are bit-packed, when they only contain background, flood and ignored pixels
+    mask = np.random.default_rng(0).choice([0, 1, 255], size=(1, 37, 51)).astype(np.uint8)
+    packed = pack_mask(mask)
+    assert packed.nbytes < mask.nbytes / 3
+    np.testing.assert_array_equal(unpack_mask(packed), mask)
+    assert pack_mask(mask * 2) is None
+
+
+def test_catalog_dataset(preprocessed: Callable):
+    preprocessed(scale=[1, 2])
+    processed = preprocessed(scale=[1, 2], output_format=TileFormat.packed)
+    # datasets list the same tiles from the catalog, in both formats
+    files = FloodDataset(processed, subset="train", include_dem=True)
+    listed = FloodDataset(processed, subset="train", include_dem=True, catalog=True)
+    assert list(files.image_files) == list(listed.image_files) and list(files.dem_files) == list(listed.dem_files)
+    packed = FloodDataset(processed, subset="train", packed=True, catalog=True)
+    assert list(packed.catalog["name"]) == packed.image_files.names()
+    mask = listed.catalog.flood_ratio() > 0.1
+    listed.add_mask(mask)
+    assert len(listed) == len(listed.catalog) == mask.sum()
@@ -0,0 +1,346 @@
+import json
+import logging
+from glob import glob
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.enums import Resampling
+
+from floods.config.preproc import Compression, StatsConfig, TileFormat
+from floods.datasets.flood import FloodDataset
+from floods import preproc
+from floods.preproc import DEM_SCALE, _read_pyramid, compute_statistics, generate_pseudolabels, preprocess_data
+from floods.utils.catalog import CATALOG_FILE, TileCatalog
+from floods.utils.gis import imread
+from floods.utils.ml import entropy
+from floods.utils.stacked import STACKED_DIR, read_stacked
+from floods.utils.store import PackedTileStore
+from floods.utils.tiling.functional import tile_body_water_ratio
+from tests.conftest import make_config, write_raster
+
+LOG = logging.getLogger(__name__)
+
+
+def tile_names(root: Path, subset: str, group: str) -> list:
+    return sorted(Path(p).name for p in glob(str(root / "processed" / subset / group / "*.tif")))
+
+
+@pytest.mark.parametrize(("workers", "streaming"), [(1, False), (2, False), (1, True)])
+def test_preprocess_tiles(source_path: Path, workers: int, streaming: bool):
+    config = make_config(source_path, scale=[1, 2], workers=workers, streaming=streaming)
+    preprocess_data(config)
+    for subset in ("train", "val", "test"):
+        sar = tile_names(source_path, subset, "sar")
+        assert len(sar) > 0
+        assert sar == tile_names(source_path, subset, "dem") == tile_names(source_path, subset, "mask")
+    # mostly-nan tiles are discarded, nans are replaced by the ignore index
+    for name in tile_names(source_path, "train", "sar"):
+        image = imread(source_path / "processed" / "train" / "sar" / name)
+        mask = imread(source_path / "processed" / "train" / "mask" / name)
+        assert image.shape[1:] == mask.shape[1:] == (256, 256)
+        assert not np.isnan(image).any()
+        assert np.isin(mask, (0, 1, 255)).all()
+    # tiles are georeferenced according to their offsets
+    with rasterio.open(str(source_path / "processed" / "train" / "sar" / "EMSR001-0_444_644.tif")) as src:
+        np.testing.assert_allclose((src.transform.c, src.transform.f), (10.0 + 644 * 1e-4, 45.0 - 444 * 1e-4))
+    # test scenes are kept whole
+    test_image = imread(source_path / "processed" / "test" / "sar" / "EMSR003-0_0_0.tif")
+    assert test_image.shape == (2, 300, 400)
+
+
+def test_read_pyramid(source_path: Path):
+    path = source_path / "source" / "EMSR001" / "s1_raw" / "EMSR001-0.tif"
+    levels, context, profile = _read_pyramid(path, scales=[1, 2, 4], context_size=256)
+    assert levels[1][0].shape == (2, 700, 900)
+    assert levels[2][0].shape == (2, 350, 450)
+    assert levels[4][0].shape == (2, 175, 225)
+    assert context[0].shape == (2, 256, 256)
+    # scaled levels must cover the same geographic extent
+    for image, transform in list(levels.values()) + [context]:
+        _, height, width = image.shape
+        np.testing.assert_allclose(transform * (width, height), profile["transform"] * (900, 700))
+    # same values of the decimated reads from the source file
+    with rasterio.open(str(path)) as src:
+        for image, _ in list(levels.values()) + [context]:
+            np.testing.assert_array_equal(image, src.read(out_shape=image.shape, resampling=Resampling.bilinear))
+
+
+def test_read_pyramid_unit_scale(source_path: Path, monkeypatch: pytest.MonkeyPatch):
+    path = source_path / "source" / "EMSR001" / "s1_raw" / "EMSR001-0.tif"
+    # the default configuration (unit scale, no context) never builds an in-memory copy
+    monkeypatch.setattr(preproc, "MemoryFile", None)
+    levels, context, profile = _read_pyramid(path, scales=[1])
+    assert context is None and levels[1][1] == profile["transform"]
+    np.testing.assert_array_equal(levels[1][0], imread(path))
+
+
+def test_read_pyramid_without_crs(tmp_path: Path):
+    path = tmp_path / "no_crs.tif"
+    data = np.random.rand(2, 64, 64).astype(np.float32)
+    with rasterio.open(str(path), "w", driver="GTiff", height=64, width=64, count=2, dtype="float32") as dst:
+        dst.write(data)
+    levels, context, profile = _read_pyramid(path, scales=[1, 2], resampling=Resampling.nearest, context_size=16)
+    assert profile["crs"] is None
+    np.testing.assert_array_equal(levels[1][0], data)
+    with rasterio.open(str(path)) as src:
+        for image, _ in (levels[2], context):
+            np.testing.assert_array_equal(image, src.read(out_shape=image.shape, resampling=Resampling.nearest))
+
+
+def test_streaming_matches_in_memory(source_path: Path):
+    preprocess_data(make_config(source_path, scale=[1, 2], make_context=True))
+    in_memory = source_path / "processed"
+    streamed = source_path / "streamed"
+    preprocess_data(make_config(source_path, scale=[1, 2], make_context=True, streaming=True).copy(
+        update=dict(data_processed=streamed)))
+    expected = sorted(Path(p).relative_to(in_memory) for p in glob(str(in_memory / "**" / "*.tif"), recursive=True))
+    result = sorted(Path(p).relative_to(streamed) for p in glob(str(streamed / "**" / "*.tif"), recursive=True))
+    assert expected == result
+    for path in expected:
+        np.testing.assert_allclose(imread(in_memory / path), imread(streamed / path), rtol=1e-5)
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_packed_store(source_path: Path, streaming: bool):
+    preprocess_data(make_config(source_path, scale=[1, 2], make_context=True, streaming=streaming))
+    preprocess_data(make_config(source_path,
+                                scale=[1, 2],
+                                make_context=True,
+                                streaming=streaming,
+                                workers=2,
+                                output_format=TileFormat.packed))
+    processed = source_path / "processed"
+    for subset, context in (("train", False), ("val", False), ("val", True), ("test", False)):
+        group_dir = "context" if context else ""
+        store = PackedTileStore(processed / subset / "packed" / group_dir)
+        # same tiles as the single files, with the same content and georeferencing
+        assert sorted(f"{name}.tif" for name in store.tiles) == tile_names(source_path, subset, f"sar/{group_dir}")
+        for index, name in enumerate(store.tiles):
+            for group in ("sar", "dem", "mask"):
+                expected, profile = imread(processed / subset / group / group_dir / f"{name}.tif", return_metadata=True)
+                np.testing.assert_array_equal(store.read(index, group), expected)
+            assert store.transform(index).almost_equals(profile["transform"])
+
+
+@pytest.mark.parametrize("output_format", [TileFormat.tif, TileFormat.packed])
+def test_incremental_preprocessing(source_path: Path, output_format: TileFormat):
+    config = make_config(source_path, subset=["train", "val"], output_format=output_format)
+    processed = source_path / "processed"
+    preprocess_data(config)
+    manifest = processed / "manifest" / "train" / "EMSR001-0.json"
+    with open(manifest) as f:
+        entry = json.load(f)
+    assert len(entry["tiles"]) == entry["counts"]["1"][0] > 0
+    if output_format == TileFormat.tif:
+        assert sorted(entry["tiles"]) == tile_names(source_path, "train", "sar")
+    first_run = {path: path.stat().st_mtime_ns for path in processed.glob("**/*") if path.is_file()}
+    reference = PackedTileStore(processed / "train" / "packed") if output_format == TileFormat.packed else None
+    # nothing changed, nothing is processed again
+    preprocess_data(config)
+    assert manifest.stat().st_mtime_ns == first_run[manifest]
+    # changed sources and interrupted scenes (without entry) are processed again, stale tiles are removed
+    mask_path = source_path / "source" / "EMSR001" / "mask" / "EMSR001-0.tif"
+    write_raster(mask_path, np.zeros((1, 700, 900), dtype=np.uint8))
+    (processed / "manifest" / "val" / "EMSR002-0.json").unlink()
+    leftover = processed / "train" / "sar" / "EMSR001-0_9999_9999.tif"
+    if output_format == TileFormat.tif:
+        leftover.touch()
+    preprocess_data(config)
+    assert manifest.stat().st_mtime_ns != first_run[manifest]
+    assert (processed / "manifest" / "val" / "EMSR002-0.json").exists()
+    assert not leftover.exists()
+    if output_format == TileFormat.tif:
+        for name in tile_names(source_path, "train", "mask"):
+            assert not (imread(processed / "train" / "mask" / name) == 1).any()
+    else:
+        store = PackedTileStore(processed / "train" / "packed")
+        np.testing.assert_array_equal(store.tiles, reference.tiles)
+        for index in range(len(store)):
+            assert not (store.read(index, "mask") == 1).any()
+            np.testing.assert_array_equal(store.read(index, "sar"), reference.read(index, "sar"))
+    # scenes moved out of the subset are removed
+    with open(source_path / "summary.json", "w") as f:
+        json.dump(dict(EMSR001=dict(subset="val"), EMSR002=dict(subset="val"), EMSR003=dict(subset="test")), f)
+    preprocess_data(config)
+    assert not manifest.exists()
+    assert tile_names(source_path, "train", "sar") == []
+    assert (processed / "manifest" / "val" / "EMSR001-0.json").exists()
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_tile_catalog(source_path: Path, streaming: bool):
+    preprocess_data(make_config(source_path, scale=[1, 2], make_context=True, streaming=streaming))
+    preprocess_data(make_config(source_path, scale=[1, 2], streaming=streaming, output_format=TileFormat.packed))
+    processed = source_path / "processed"
+    for subset in ("train", "val", "test"):
+        catalog = TileCatalog(processed / subset / CATALOG_FILE)
+        # context tiles are not part of the catalog, which follows the order of the files
+        assert [f"{name}.tif" for name in catalog["name"]] == tile_names(source_path, subset, "sar")
+        for index, name in enumerate(catalog["sar_path"]):
+            sar = imread(processed / subset / name)
+            label = imread(processed / subset / catalog["mask_path"][index])
+            invalid = label[0] == 255
+            assert catalog["scene"][index] == f"{catalog['emsr'][index]}-0"
+            assert catalog.nan_ratio[index] == invalid.mean()
+            assert catalog["flood"][index] == np.count_nonzero(label == 1)
+            np.testing.assert_allclose(catalog["sar_sum"][index], sar[:, ~invalid].sum(axis=1), rtol=1e-5)
+            assert np.isclose(catalog.entropy()[index], entropy(label))
+            if catalog["flood"][index] > 0 and catalog["background"][index] > 0:
+                assert np.isclose(catalog.flood_ratio(smoothing=0.5)[index], tile_body_water_ratio(label, smoothing=0.5))
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_virtual_tiles(source_path: Path, streaming: bool):
+    preprocess_data(make_config(source_path, scale=[1, 2], streaming=streaming, output_format=TileFormat.virtual))
+    processed = source_path / "processed"
+    # one processed scene for each scale, listed by the catalog, without any tile file
+    for subset in ("train", "val", "test"):
+        catalog = TileCatalog(processed / subset / CATALOG_FILE)
+        assert len(catalog) > 0 and tile_names(source_path, subset, "sar") == []
+    scenes = processed / "train" / "scenes" / "sar"
+    assert sorted(path.name for path in scenes.glob("*.tif")) == ["EMSR001-0.tif", "EMSR001-0_x2.tif"]
+    # scenes moved out of the subset are removed
+    with open(source_path / "summary.json", "w") as f:
+        json.dump(dict(EMSR001=dict(subset="val"), EMSR002=dict(subset="val"), EMSR003=dict(subset="test")), f)
+    preprocess_data(make_config(source_path, subset=["train"], output_format=TileFormat.virtual))
+    assert list(scenes.glob("*.tif")) == []
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_compact_tiles(source_path: Path, streaming: bool):
+    processed = source_path / "processed"
+    preprocess_data(make_config(source_path, subset=["train", "test"], streaming=streaming))
+    names = tile_names(source_path, "train", "dem")
+    sizes = sum(path.stat().st_size for path in processed.glob("*/*/*.tif"))
+    preprocess_data(
+        make_config(source_path,
+                    subset=["train", "test"],
+                    streaming=streaming,
+                    compact_tiles=True,
+                    compression=Compression.zstd))
+    # same tiles, less than half the bytes: half precision SAR, scaled int16 DEM, compressed
+    assert tile_names(source_path, "train", "dem") == names
+    assert sum(path.stat().st_size for path in processed.glob("*/*/*.tif")) < sizes / 2
+    with rasterio.open(processed / "train" / "dem" / names[0]) as src:
+        assert src.dtypes[0] == "int16" and src.scales[0] == DEM_SCALE and src.compression.value == "ZSTD"
+    with rasterio.open(processed / "train" / "sar" / names[0]) as src:
+        assert src.tags(1, ns="IMAGE_STRUCTURE").get("NBITS") == "16"
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_stacked_tiles(source_path: Path, streaming: bool):
+    processed = source_path / "processed"
+    preprocess_data(make_config(source_path, subset=["train"], streaming=streaming))
+    generate_pseudolabels(make_config(source_path, denoiser="box"))
+    names = tile_names(source_path, "train", "sar")
+    reference = compute_statistics(StatsConfig(data_root=processed, output=source_path / "files.json"))
+    # stacked tiles replace the separate folders, with every modality and the weights in the same raster
+    preprocess_data(make_config(source_path, subset=["train"], streaming=streaming, output_format=TileFormat.stacked))
+    generate_pseudolabels(make_config(source_path, denoiser="box", output_format=TileFormat.stacked))
+    assert tile_names(source_path, "train", "sar") == []
+    assert tile_names(source_path, "train", STACKED_DIR) == names
+    for name in names:
+        stack, roles = read_stacked(processed / "train" / STACKED_DIR / name)
+        assert list(roles) == ["sar", "dem", "mask", "weight"] and stack.shape[0] == roles["weight"][1] == 5
+    stats = compute_statistics(StatsConfig(data_root=processed, output=source_path / "stacked.json"))
+    for key in ("mean", "std", "median"):
+        np.testing.assert_allclose(stats[key], reference[key], rtol=1e-5)
+
+
+def test_compute_statistics(source_path: Path):
+    preprocess_data(make_config(source_path, scale=[1, 2]))
+    preprocess_data(make_config(source_path, scale=[1, 2], output_format=TileFormat.packed))
+    processed = source_path / "processed"
+    stats = compute_statistics(StatsConfig(data_root=processed, workers=2, batch_size=3))
+    # pooled statistics over every valid pixel of every tile
+    pixels = list()
+    for name in tile_names(source_path, "train", "sar"):
+        image = np.concatenate([imread(processed / "train" / group / name) for group in ("sar", "dem")])
+        mask = imread(processed / "train" / "mask" / name)[0]
+        pixels.append(image[:, mask != 255])
+    pixels = np.concatenate(pixels, axis=1).astype(np.float64)
+    np.testing.assert_allclose(stats["mean"], np.nanmean(pixels, axis=1), rtol=1e-6)
+    np.testing.assert_allclose(stats["std"], np.nanstd(pixels, axis=1), rtol=1e-6)
+    np.testing.assert_allclose(stats["min"], np.nanmin(pixels, axis=1))
+    np.testing.assert_allclose(stats["max"], np.nanmax(pixels, axis=1))
+    np.testing.assert_allclose(stats["median"], np.nanmedian(pixels, axis=1), rtol=0.02)
+    np.testing.assert_allclose(stats["clip_low"], np.nanpercentile(pixels, 1, axis=1), rtol=0.02)
+    # same results from the packed store, loaded back by the dataset
+    output = processed / "packed_stats.json"
+    packed = compute_statistics(StatsConfig(data_root=processed, packed=True, output=output))
+    np.testing.assert_allclose(packed["mean"], stats["mean"])
+    mean, std = FloodDataset.statistics(output)
+    np.testing.assert_allclose(mean, stats["mean"])
+    np.testing.assert_allclose(std, stats["std"])
+    center, _ = FloodDataset.statistics(output, robust=True)
+    clip_min, clip_max = FloodDataset.clip_limits(output, robust=True)
+    np.testing.assert_allclose(center, stats["median"])
+    assert all(low < 0 < high for low, high in zip(clip_min, clip_max))
+
+
+def test_pseudolabels(source_path: Path):
+    processed = source_path / "processed"
+    preprocess_data(make_config(source_path, subset=["train"]))
+    preprocess_data(make_config(source_path, subset=["train"], output_format=TileFormat.packed))
+    generate_pseudolabels(make_config(source_path, denoiser="lee", workers=2, batch_size=3))
+    generate_pseudolabels(make_config(source_path, denoiser="lee", output_format=TileFormat.packed))
+    # same weights regardless of the storage format
+    store = PackedTileStore(processed / "train" / "packed")
+    assert sorted(f"{name}.tif" for name in store.tiles) == tile_names(source_path, "train", "weight")
+    for index, name in enumerate(store.tiles):
+        weight = imread(processed / "train" / "weight" / f"{name}.tif")
+        np.testing.assert_array_equal(store.read(index, "weight"), weight)
+    # the benchmark reports every denoiser, nlmeans is the reference
+    report = generate_pseudolabels(make_config(source_path, benchmark=2))
+    assert set(report.keys()) == {"nlmeans", "opencv", "lee", "box"}
+    assert report["nlmeans"]["agreement"] == report["nlmeans"]["iou"] == 1.0
+    assert all(stats["tiles_per_sec"] > 0 for stats in report.values())
+
+
+@pytest.mark.parametrize("output_format", [TileFormat.tif, TileFormat.packed])
+def test_scene_pseudolabels(source_path: Path, output_format: TileFormat):
+    processed = source_path / "processed"
+    preprocess_data(make_config(source_path, subset=["train"], scale=[1, 2], output_format=output_format))
+    generate_pseudolabels(make_config(source_path, denoiser="box", output_format=output_format))
+    if output_format == TileFormat.packed:
+        store = PackedTileStore(processed / "train" / "packed")
+        tile_weights = [store.read(index, "weight").copy() for index in range(len(store))]
+    else:
+        names = tile_names(source_path, "train", "weight")
+        tile_weights = [imread(processed / "train" / "weight" / name) for name in names]
+    generate_pseudolabels(make_config(source_path, denoiser="box", output_format=output_format, scene_pseudolabels=True))
+    if output_format == TileFormat.packed:
+        scene_weights = [store.read(index, "weight") for index in range(len(store))]
+    else:
+        assert tile_names(source_path, "train", "weight") == names
+        scene_weights = [imread(processed / "train" / "weight" / name) for name in names]
+    # far from the tile borders, the neighbourhood is the same: results must agree
+    margin = 8
+    for tile_weight, scene_weight in zip(tile_weights, scene_weights):
+        assert tile_weight.shape == scene_weight.shape
+        inner = (slice(None), slice(margin, -margin), slice(margin, -margin))
+        assert (tile_weight[inner] == scene_weight[inner]).mean() > 0.999
+
+
+@pytest.mark.parametrize("otsu_level", ["scene", "emsr"])
+def test_otsu_pseudolabels(source_path: Path, otsu_level: str):
+    processed = source_path / "processed"
+    preprocess_data(make_config(source_path, subset=["train"], decibel=False))
+    preprocess_data(make_config(source_path, subset=["train"], decibel=False, output_format=TileFormat.packed))
+    thresholds = generate_pseudolabels(make_config(source_path, method="otsu", otsu_level=otsu_level, workers=2))
+    packed_thresholds = generate_pseudolabels(
+        make_config(source_path, method="otsu", otsu_level=otsu_level, output_format=TileFormat.packed))
+    assert list(thresholds.keys()) == ["EMSR001-0" if otsu_level == "scene" else "EMSR001"]
+    assert thresholds == packed_thresholds
+    with open(processed / "train" / "otsu_thresholds.json") as f:
+        assert json.load(f) == thresholds
+    # uniform noise in [0, 1): thresholds somewhere in the middle, weights use the same layout
+    assert all(0.2 < value < 0.8 for value in thresholds["EMSR001-0" if otsu_level == "scene" else "EMSR001"])
+    store = PackedTileStore(processed / "train" / "packed")
+    assert sorted(f"{name}.tif" for name in store.tiles) == tile_names(source_path, "train", "weight")
+    for index, name in enumerate(store.tiles):
+        weight = imread(processed / "train" / "weight" / f"{name}.tif")
+        np.testing.assert_array_equal(store.read(index, "weight"), weight)
+        assert np.isin(weight, (0, 1, 2)).all()
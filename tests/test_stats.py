@@ -0,0 +1,56 @@
+import numpy as np
+from skimage.filters import threshold_otsu
+
+from floods.utils.stats import Histogram, Moments, QuantileSketch, otsu_threshold
+
+
+def test_histogram_merge():
+    rng = np.random.default_rng(42)
+    values = rng.normal(0.5, 0.2, size=(2, 10000))
+    values[0, :10] = np.nan
+    full = Histogram(channels=2, bins=64).update(values)
+    merged = Histogram(channels=2, bins=64).update(values[:, :3000])
+    merged.merge(Histogram(channels=2, bins=64).update(values[:, 3000:]))
+    np.testing.assert_array_equal(full.counts, merged.counts)
+    # out of range values are clipped in the outer bins, nans are ignored
+    assert full.counts[0].sum() == 10000 - 10
+    assert full.counts[1].sum() == 10000
+
+
+def test_otsu_threshold():
+    rng = np.random.default_rng(42)
+    # bimodal distribution, water (dark) and land (bright)
+    values = np.concatenate((rng.normal(0.1, 0.03, size=5000), rng.normal(0.6, 0.1, size=15000)))
+    histogram = Histogram(channels=1, bins=256).update(values[np.newaxis])
+    threshold = otsu_threshold(histogram.counts[0], histogram.centers)
+    assert threshold == threshold_otsu(hist=(histogram.counts[0], histogram.centers))
+    assert 0.2 < threshold < 0.4
+
+
+def test_moments_merge():
+    rng = np.random.default_rng(42)
+    values = rng.normal(100.0, 20.0, size=(3, 10000))
+    values[1, :10] = np.nan
+    merged = Moments(channels=3)
+    for chunk in np.array_split(values, 7, axis=1):
+        merged.merge(Moments(channels=3).update(chunk))
+    np.testing.assert_array_equal(merged.count, [10000, 9990, 10000])
+    np.testing.assert_allclose(merged.mean, np.nanmean(values, axis=1))
+    np.testing.assert_allclose(merged.std, np.nanstd(values, axis=1))
+    np.testing.assert_array_equal(merged.min, np.nanmin(values, axis=1))
+    np.testing.assert_array_equal(merged.max, np.nanmax(values, axis=1))
+
+
+def test_quantile_sketch():
+    rng = np.random.default_rng(42)
+    # decibel-like values and DEM-like values, with negatives and zeros
+    values = np.stack((rng.lognormal(-3.0, 1.0, size=100000), rng.normal(100.0, 80.0, size=100000)))
+    values[1, :100] = 0
+    values[0, :10] = np.nan
+    merged = QuantileSketch(channels=2, relative_accuracy=0.01)
+    for chunk in np.array_split(values, 7, axis=1):
+        merged.merge(QuantileSketch(channels=2, relative_accuracy=0.01).update(chunk))
+    np.testing.assert_array_equal(merged.count, [100000 - 10, 100000])
+    quantiles = [0.01, 0.25, 0.5, 0.75, 0.99]
+    expected = np.nanquantile(values, quantiles, axis=1).T
+    np.testing.assert_allclose(merged.quantile(quantiles), expected, rtol=0.02)